@@ -2,6 +2,7 @@
 
 import cv2
 import glob
+import hashlib
 import os
 import shutil
 import numpy as np
@@ -9,6 +10,7 @@ import re
 import time
 import json
 import cv2.aruco as aruco
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 # Creates a set of 13 polygon coordinates
 
@@ -70,27 +72,469 @@ def polygon_from_image_name(image_name):
     return int(re.findall("p(\d+)", image_name)[0])
 
 
+def charuco_board(squaresX, squaresY, square_size, mrk_size):
+    """Returns the aruco dictionary and the charuco board of the calibration target."""
+    aruco_dictionary = aruco.Dictionary_get(aruco.DICT_4X4_1000)
+    board = aruco.CharucoBoard_create(
+            # 22, 16,
+            squaresX, squaresY,
+            square_size,
+            mrk_size,
+            aruco_dictionary)
+    return aruco_dictionary, board
+
+
+def camera_matrix_guess(imsize):
+    """Initial camera matrix of the intrinsics calibration (imsize is (width, height))."""
+    if imsize[1] < 1100:
+        return np.array([[857.1668,    0.0,      643.9126],
+                         [0.0,     856.0823,  387.56018],
+                         [0.0,        0.0,        1.0]])
+    else:
+        return np.array([[3819.8801,    0.0,     1912.8375],
+                         [0.0,     3819.8801, 1135.3433],
+                         [0.0,        0.0,        1.]])
+
+
+def match_charuco_corners(corners_l, ids_l, corners_r, ids_r, board_corners=None):
+    """
+    Corners of the charuco ids detected in both images of a pair (sorted ids intersection).
+    The matches keep the order of the left detections.
+    Returns the left and right corners (N,1,2) and, with the board chessboardCorners,
+    their object points (N,1,3) (else None).
+    """
+    ids_l = np.asarray(ids_l).ravel()
+    ids_r = np.asarray(ids_r).ravel()
+    _, idx_l, idx_r = np.intersect1d(ids_l, ids_r, assume_unique=True, return_indices=True)
+    order = np.argsort(idx_l)
+    idx_l = idx_l[order]
+    idx_r = idx_r[order]
+    left = np.asarray(corners_l, dtype=np.float32).reshape(-1, 1, 2)[idx_l]
+    right = np.asarray(corners_r, dtype=np.float32).reshape(-1, 1, 2)[idx_r]
+    obj_pts = None
+    if board_corners is not None:
+        obj_pts = np.asarray(board_corners, dtype=np.float32)[ids_l[idx_l]].reshape(-1, 1, 3)
+    return left, right, obj_pts
+
+
+def match_charuco_views(allCorners_l, allIds_l, allCorners_r, allIds_r, board_corners):
+    """
+    match_charuco_corners of every view.
+    Returns the lists of object points, left corners and right corners, one array per view.
+    """
+    obj_pts = []
+    left_corners_sampled = []
+    right_corners_sampled = []
+    for corners_l, ids_l, corners_r, ids_r in zip(allCorners_l, allIds_l, allCorners_r, allIds_r):
+        left, right, obj = match_charuco_corners(corners_l, ids_l, corners_r, ids_r, board_corners)
+        obj_pts.append(obj)
+        left_corners_sampled.append(left)
+        right_corners_sampled.append(right)
+    return obj_pts, left_corners_sampled, right_corners_sampled
+
+
+def view_outliers(errors, factor=2.5, min_error=0.5):
+    """
+    Indices of the views whose reprojection error (perViewErrors of a calibration) is
+    above factor times the median error, and above min_error pixels.
+    """
+    errors = np.asarray(errors, dtype=np.float64).ravel()
+    return np.flatnonzero(errors > max(factor * np.median(errors), min_error))
+
+
+def view_coverage(corners, imsize, grid=(8, 5)):
+    """Cells of a grid over the image (imsize: width, height) holding corners, as a flat bool array."""
+    points = np.asarray(corners, dtype=np.float32).reshape(-1, 2)
+    ix = np.clip((points[:, 0] * grid[0] / imsize[0]).astype(np.int32), 0, grid[0] - 1)
+    iy = np.clip((points[:, 1] * grid[1] / imsize[1]).astype(np.int32), 0, grid[1] - 1)
+    cells = np.zeros(grid[0] * grid[1], dtype=bool)
+    cells[iy * grid[0] + ix] = True
+    return cells
+
+
+def select_diverse_views(coverage, rvecs, count, angle_scale=np.radians(20)):
+    """
+    Greedy choice of count views, for the coverage of the frames and the diversity of the
+    board poses: each step adds the view with the most cells not covered yet (relative to
+    the cells of the largest view) plus the angle between its board normal and the nearest
+    chosen one (relative to angle_scale, at most 1).
+    coverage is the (views, cells) bool array of the view_coverage, rvecs the board rotations.
+    Returns the sorted indices of the chosen views.
+    """
+    coverage = np.asarray(coverage, dtype=bool)
+    if count >= len(coverage):
+        return np.arange(len(coverage))
+    normals = np.array([cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))[0][:, 2] for rvec in rvecs])
+    cells = max(int(coverage.sum(axis=1).max()), 1)
+    covered = np.zeros(coverage.shape[1], dtype=bool)
+    angles = np.full(len(coverage), np.pi)
+    chosen = []
+    for _ in range(count):
+        score = (coverage & ~covered).sum(axis=1) / cells + np.minimum(angles / angle_scale, 1.0)
+        score[chosen] = -np.inf
+        best = int(np.argmax(score))
+        chosen.append(best)
+        covered |= coverage[best]
+        angles = np.minimum(angles, np.arccos(np.clip(normals @ normals[best], -1.0, 1.0)))
+    return np.sort(chosen)
+
+
+def epipolar_errors(corners_l, corners_r):
+    """Vertical distances between matched corners of a rectified pair (the epipolar error of each corner)."""
+    corners_l = np.asarray(corners_l, dtype=np.float32).reshape(-1, 2)
+    corners_r = np.asarray(corners_r, dtype=np.float32).reshape(-1, 2)
+    return np.abs(corners_l[:, 1] - corners_r[:, 1])
+
+
+# pixels between the nodes of the rectification meshes
+MESH_CELL_SIZE = 16
+
+
+def mesh_nodes(size, cell_size=MESH_CELL_SIZE):
+    """Pixel positions of the mesh nodes along an axis of size pixels (the node past the end is clamped to the last pixel)."""
+    return np.minimum(np.arange(0, size + 1, cell_size), size - 1)
+
+
+def create_mesh(map_x, map_y, cell_size=MESH_CELL_SIZE):
+    """
+    Mesh of a remap table: the (y, x) source positions of every cell_size-th row and column,
+    interleaved per row (rows padded with a (0, 0) node if the width requires it).
+    Returns a float32 (rows, row length) array, as written to the .calib mesh files.
+    """
+    height, width = map_x.shape
+    nodes_y = mesh_nodes(height, cell_size)
+    nodes_x = mesh_nodes(width, cell_size)
+    pad = 1 if (width % cell_size) % 2 != 0 else 0
+    mesh = np.zeros((len(nodes_y), len(nodes_x) + pad, 2), dtype=np.float32)
+    mesh[:, :len(nodes_x), 0] = map_y[nodes_y][:, nodes_x]
+    mesh[:, :len(nodes_x), 1] = map_x[nodes_y][:, nodes_x]
+    return mesh.reshape(len(nodes_y), -1)
+
+
+def load_mesh(path, calib_size=(1280, 800), cell_size=MESH_CELL_SIZE):
+    """
+    Reads a .calib mesh file created for calib_size (width, height) images.
+    Returns the (rows, cols, 2) mesh of (y, x) source positions.
+    """
+    width, height = calib_size
+    rows = len(mesh_nodes(height, cell_size))
+    cols = len(mesh_nodes(width, cell_size))
+    mesh = np.fromfile(path, dtype=np.float32).reshape(rows, -1, 2)
+    return mesh[:, :cols]
+
+
+def mesh_to_maps(mesh, calib_size=(1280, 800), size=None, cell_size=MESH_CELL_SIZE):
+    """
+    Bilinear upsampling of a mesh (see load_mesh) to the remap tables of size (width, height)
+    images (by default calib_size), the image being scaled as a whole from calib_size.
+    The error against the exact maps grows with the distortion, between the mesh nodes:
+    at 1280x800, about 0.01 px for k1=-0.05 and 0.04 px for k1=-0.2 (half at 640x400).
+    Returns map_x, map_y as float32 arrays, for cv2.remap.
+    """
+    width, height = calib_size
+    out_width, out_height = size if size is not None else calib_size
+    scale_x = width / out_width
+    scale_y = height / out_height
+
+    def weights(out_size, scale, size):
+        # calibration pixel of each output pixel (pixel centers aligned), as a position in the mesh
+        pos = np.clip((np.arange(out_size) + 0.5) * scale - 0.5, 0, size - 1)
+        nodes = mesh_nodes(size, cell_size)
+        grid = np.interp(pos, nodes, np.arange(len(nodes)))
+        index = np.minimum(grid.astype(np.int32), len(nodes) - 2)
+        return index, (grid - index).astype(np.float32)
+
+    iy, wy = weights(out_height, scale_y, height)
+    ix, wx = weights(out_width, scale_x, width)
+    rows = mesh[iy] * (1.0 - wy)[:, None, None] + mesh[iy + 1] * wy[:, None, None]
+    maps = rows[:, ix] * (1.0 - wx)[None, :, None] + rows[:, ix + 1] * wx[None, :, None]
+
+    # source positions back to output pixels
+    map_x = (maps[..., 1] + 0.5) / scale_x - 0.5
+    map_y = (maps[..., 0] + 0.5) / scale_y - 0.5
+    return map_x.astype(np.float32), map_y.astype(np.float32)
+
+
+def scaling_matrix(calib_size, size, crop=None):
+    """
+    Pixel transform from calib_size (width, height) images to size images, obtained by
+    cropping crop (x, y, width, height in calibration pixels, default: the whole image)
+    then resizing (pixel centers aligned).
+    Returns the 3x3 matrix A, the intrinsics of the new images are A @ K.
+    """
+    x, y, crop_width, crop_height = crop if crop is not None else (0, 0) + tuple(calib_size)
+    scale_x = size[0] / crop_width
+    scale_y = size[1] / crop_height
+    return np.array([[scale_x, 0, (0.5 - x) * scale_x - 0.5],
+                     [0, scale_y, (0.5 - y) * scale_y - 0.5],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+class ScaledCalibration(object):
+    """
+    Stereo calibration done at calib_size, derived for other capture sizes and crops:
+    intrinsics, projection matrices and Q are transformed consistently (rotations and
+    distortion are unchanged), and the rectification maps are cached per size.
+    """
+
+    def __init__(self, K1, D1, K2, D2, R1, R2, P1, P2, Q, calib_size=(1280, 800)):
+        self.K1 = np.asarray(K1, dtype=np.float64)
+        self.D1 = np.asarray(D1, dtype=np.float64)
+        self.K2 = np.asarray(K2, dtype=np.float64)
+        self.D2 = np.asarray(D2, dtype=np.float64)
+        self.R1 = np.asarray(R1, dtype=np.float64)
+        self.R2 = np.asarray(R2, dtype=np.float64)
+        self.P1 = np.asarray(P1, dtype=np.float64)
+        self.P2 = np.asarray(P2, dtype=np.float64)
+        self.Q = np.asarray(Q, dtype=np.float64)
+        self.calib_size = tuple(calib_size)
+        self.cache = {}
+
+    def scaled(self, size, crop=None):
+        """
+        Calibration of size (width, height) images (see scaling_matrix for crop).
+        Returns a dict of K1, D1, K2, D2, R1, R2, P1, P2 and Q.
+        """
+        A = scaling_matrix(self.calib_size, size, crop)
+        # (u, v, disparity, 1) of the calibration images -> of the new images
+        B = np.array([[A[0, 0], 0, 0, A[0, 2]],
+                      [0, A[1, 1], 0, A[1, 2]],
+                      [0, 0, A[0, 0], 0],
+                      [0, 0, 0, 1]], dtype=np.float64)
+        return {'K1': A @ self.K1, 'D1': self.D1, 'K2': A @ self.K2, 'D2': self.D2,
+                'R1': self.R1, 'R2': self.R2, 'P1': A @ self.P1, 'P2': A @ self.P2,
+                'Q': self.Q @ np.linalg.inv(B)}
+
+    def maps(self, size, crop=None, m1type=cv2.CV_16SC2):
+        """
+        Rectification maps of size (width, height) images, computed once per size, crop and map type.
+        Returns (left map1, left map2), (right map1, right map2), for cv2.remap.
+        """
+        key = (tuple(size), None if crop is None else tuple(crop), m1type)
+        if key not in self.cache:
+            c = self.scaled(size, crop)
+            self.cache[key] = (
+                cv2.initUndistortRectifyMap(c['K1'], c['D1'], c['R1'], c['P1'][:, :3], tuple(size), m1type),
+                cv2.initUndistortRectifyMap(c['K2'], c['D2'], c['R2'], c['P2'][:, :3], tuple(size), m1type))
+        return self.cache[key]
+
+    def rectify(self, left, right, crop=None, interpolation=cv2.INTER_LINEAR):
+        """Rectified left and right images (with the maps of their size)."""
+        size = (left.shape[1], left.shape[0])
+        (map1_l, map2_l), (map1_r, map2_r) = self.maps(size, crop)
+        return (cv2.remap(left, map1_l, map2_l, interpolation, cv2.BORDER_CONSTANT),
+                cv2.remap(right, map1_r, map2_r, interpolation, cv2.BORDER_CONSTANT))
+
+
+# board of the worker process (opencv objects can't be pickled, they are rebuilt once per process)
+_worker_board = {}
+
+
+def detect_charuco(job):
+    """
+    Charuco detection of one image, run in the worker processes of StereoCalibration.analyze_charuco_sets.
+    job is (image path, board parameters, scale_req, req_resolution).
+    Returns (image shape, marker corners, marker ids, recovered ids, charuco corners, charuco ids, log messages),
+    the charuco corners and ids are None if the image is rejected.
+    """
+    im, board_params, scale_req, req_resolution = job
+    if board_params not in _worker_board:
+        # the detections already run in parallel
+        cv2.setNumThreads(1)
+        _worker_board[board_params] = charuco_board(*board_params)
+    aruco_dictionary, board = _worker_board[board_params]
+
+    messages = ["=> Processing image {0}".format(im)]
+    frame = cv2.imread(im)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    expected_height = gray.shape[0]*(req_resolution[1]/gray.shape[1])
+
+    if scale_req and not (gray.shape[0] == req_resolution[0] and gray.shape[1] == req_resolution[1]):
+        if int(expected_height) == req_resolution[0]:
+            # resizing to have both stereo and rgb to have same
+            # resolution to capture extrinsics of the rgb-right camera
+            gray = cv2.resize(gray, req_resolution[::-1],
+                              interpolation=cv2.INTER_CUBIC)
+        else:
+            # resizing and cropping to have both stereo and rgb to have same resolution
+            # to calculate extrinsics of the rgb-right camera
+            scale_width = req_resolution[1]/gray.shape[1]
+            dest_res = (
+                int(gray.shape[1] * scale_width), int(gray.shape[0] * scale_width))
+            gray = cv2.resize(
+                gray, dest_res, interpolation=cv2.INTER_CUBIC)
+            if gray.shape[0] < req_resolution[0]:
+                raise RuntimeError("resizeed height of rgb is smaller than required. {0} < {1}".format(
+                    gray.shape[0], req_resolution[0]))
+            del_height = (gray.shape[0] - req_resolution[0]) // 2
+            gray = gray[del_height: del_height + req_resolution[0], :]
+
+    return (gray.shape,) + detect_charuco_gray(gray, aruco_dictionary, board, messages, im)
+
+
+def detect_charuco_gray(gray, aruco_dictionary, board, messages, name="image"):
+    """
+    Charuco detection of a grayscale image, log lines are appended to messages.
+    Returns (marker corners, marker ids, recovered ids, charuco corners, charuco ids, messages),
+    the charuco corners and ids are None if the image is rejected.
+    """
+    # SUB PIXEL CORNER DETECTION CRITERION
+    criteria = (cv2.TERM_CRITERIA_EPS +
+                cv2.TERM_CRITERIA_MAX_ITER, 100, 0.00001)
+    marker_corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(
+        gray, aruco_dictionary)
+    marker_corners, ids, refusd, recoverd = cv2.aruco.refineDetectedMarkers(gray, board,
+                                                                            marker_corners, ids, rejectedCorners=rejectedImgPoints)
+    messages.append('{0} number of Markers corners detected in the above image'.format(
+        len(marker_corners)))
+    if len(marker_corners) > 0:
+        res2 = cv2.aruco.interpolateCornersCharuco(
+            marker_corners, ids, gray, board)
+
+        if res2[1] is not None and res2[2] is not None and len(res2[1]) > 3:
+
+            cv2.cornerSubPix(gray, res2[1],
+                             winSize=(5, 5),
+                             zeroZone=(-1, -1),
+                             criteria=criteria)
+            return marker_corners, ids, recoverd, res2[1], res2[2], messages
+        else:
+            messages.append("in else")
+    else:
+        messages.append(name + " Not found")
+    return marker_corners, ids, recoverd, None, None, messages
+
+
+class DetectionCache(object):
+    """
+    On-disk cache of the charuco detections, in a single .npz file. Entries are
+    keyed by the hash of the image content and of the detection parameters (board,
+    scaling), so calibrating again the same dataset skips the detection.
+    save(prune=True) drops the entries not used since the cache was opened
+    (ex: images deleted from the dataset).
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+        if os.path.isfile(path):
+            try:
+                self.load()
+            except (OSError, KeyError, ValueError) as e:
+                print("Ignoring the detection cache {0}: {1}".format(path, e))
+                self.entries = {}
+
+    @staticmethod
+    def key(data, params):
+        """Key of an image content (bytes or contiguous array) detected with params."""
+        digest = hashlib.sha1(repr(params).encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def key_file(self, path, params):
+        with open(path, 'rb') as f:
+            return self.key(f.read(), params)
+
+    def get(self, key):
+        """Returns (image shape, marker corners, marker ids, recovered ids, charuco corners, charuco ids) or None."""
+        detection = self.entries.get(key)
+        if detection is not None:
+            self.used.add(key)
+        return detection
+
+    def put(self, key, detection):
+        self.entries[key] = tuple(detection)
+        self.used.add(key)
+        self.dirty = True
+
+    def load(self):
+        with np.load(self.path) as data:
+            if int(data['version']) != self.version:
+                raise ValueError("version {0}".format(int(data['version'])))
+            # ragged arrays are stored concatenated, with per entry counts
+            splits = {}
+            for name in ('markers', 'recovered', 'corners'):
+                counts = np.maximum(data[name + '_counts'], 0)
+                splits[name] = np.cumsum(counts)[:-1]
+            markers = np.split(data['markers'], splits['markers'])
+            marker_ids = np.split(data['marker_ids'], splits['markers'])
+            recovered = np.split(data['recovered'], splits['recovered'])
+            corners = np.split(data['corners'], splits['corners'])
+            corner_ids = np.split(data['corner_ids'], splits['corners'])
+            for i, key in enumerate(data['keys']):
+                found = data['corners_counts'][i] >= 0
+                self.entries[str(key)] = (
+                    tuple(int(v) for v in data['imsize'][i]),
+                    tuple(marker.reshape(1, 4, 2) for marker in markers[i]),
+                    marker_ids[i].reshape(-1, 1) if len(marker_ids[i]) else None,
+                    recovered[i].reshape(-1, 1),
+                    corners[i].reshape(-1, 1, 2) if found else None,
+                    corner_ids[i].reshape(-1, 1) if found else None)
+
+    def save(self, prune=False):
+        unused = [key for key in self.entries if key not in self.used] if prune else []
+        for key in unused:
+            del self.entries[key]
+        if not self.dirty and not unused:
+            return
+        keys = list(self.entries)
+        entries = [self.entries[key] for key in keys]
+
+        def concat(arrays, shape, dtype):
+            arrays = [np.asarray(a, dtype=dtype).reshape(shape) for a in arrays]
+            return np.concatenate(arrays) if arrays else np.zeros((0,) + shape[1:], dtype)
+
+        data = dict(
+            version=np.array(self.version),
+            keys=np.array(keys, dtype='U40'),
+            imsize=np.array([e[0][:2] for e in entries], dtype=np.int32).reshape(-1, 2),
+            markers=concat([m for e in entries for m in e[1]], (-1, 4, 2), np.float32),
+            markers_counts=np.array([len(e[1]) for e in entries], dtype=np.int32),
+            marker_ids=concat([e[2] for e in entries if e[2] is not None], (-1,), np.int32),
+            recovered=concat([e[3] for e in entries if e[3] is not None], (-1,), np.int32),
+            recovered_counts=np.array([0 if e[3] is None else np.size(e[3]) for e in entries], dtype=np.int32),
+            corners=concat([e[4] for e in entries if e[4] is not None], (-1, 2), np.float32),
+            corner_ids=concat([e[5] for e in entries if e[5] is not None], (-1,), np.int32),
+            corners_counts=np.array([-1 if e[4] is None else len(e[4]) for e in entries], dtype=np.int32))
+        # written next to the cache then renamed, an interrupted run keeps the previous cache
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **data)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
 class StereoCalibration(object):
     """Class to Calculate Calibration and Rectify a Stereo Camera."""
 
-    def __init__(self):
+    def __init__(self, num_workers=None, max_views=None, outlier_factor=2.5):
         """Class to Calculate Calibration and Rectify a Stereo Camera."""
-
-    def calibrate(self, filepath, square_size, mrk_size, squaresX, squaresY, camera_model, calibrate_rgb, enable_disp_rectify):
-        """Function to calculate calibration for stereo camera."""
+        # processes of the charuco detection (None: one per CPU, 1: sequential)
+        self.num_workers = num_workers
+        # views of the stereo calibration, chosen for coverage and pose diversity (None: all)
+        self.max_views = max_views
+        # views with a reprojection error above outlier_factor times the median are dropped (None: none)
+        self.outlier_factor = outlier_factor
+        # (views before the selection, ms of the camera calibrations after dropping views) of select_views
+        self.view_selection = None
+        self.detection_cache = None
+
+    def calibrate(self, filepath, square_size, mrk_size, squaresX, squaresY, camera_model, calibrate_rgb, enable_disp_rectify, use_cache=True):
+        """Function to calculate calibration for stereo camera.
+        With use_cache, the charuco detections are kept in <filepath>/charuco_detections.npz."""
         start_time = time.time()
         # init object data
         self.calibrate_rgb = calibrate_rgb
         self.enable_rectification_disp = enable_disp_rectify
         self.cameraModel  = camera_model
         self.data_path = filepath
-        self.aruco_dictionary = aruco.Dictionary_get(aruco.DICT_4X4_1000)
-        self.board = aruco.CharucoBoard_create(
-                # 22, 16,
-                squaresX, squaresY,
-                square_size,
-                mrk_size,
-                self.aruco_dictionary)
+        self.board_params = (squaresX, squaresY, square_size, mrk_size)
+        self.aruco_dictionary, self.board = charuco_board(*self.board_params)
+        self.detection_cache = DetectionCache(filepath + "/charuco_detections.npz") if use_cache else None
 
         
             # parameters = aruco.DetectorParameters_create()
@@ -181,108 +625,75 @@ class StereoCalibration(object):
 
         self.create_save_mesh()
 
-        if self.calibrate_rgb:
-            return self.test_epipolar_charuco_lr(filepath), self.test_epipolar_charuco_rgbr(filepath), self.calib_data
-        else:
-            return self.test_epipolar_charuco_lr(filepath), None, self.calib_data
+        epipolar_lr = self.test_epipolar_charuco_lr(filepath)
+        epipolar_rgbr = self.test_epipolar_charuco_rgbr(filepath) if self.calibrate_rgb else None
+        if self.detection_cache is not None:
+            self.detection_cache.save(prune=True)
+        return epipolar_lr, epipolar_rgbr, self.calib_data
 
     def analyze_charuco(self, images, scale_req=False, req_resolution=(800, 1280)):
         """
         Charuco base pose estimation.
         """
-        # print("POSE ESTIMATION STARTS:")
-        allCorners = []
-        allIds = []
-        all_marker_corners = []
-        all_marker_ids = []
-        all_recovered = []
-        # decimator = 0
-        # SUB PIXEL CORNER DETECTION CRITERION
-        criteria = (cv2.TERM_CRITERIA_EPS +
-                    cv2.TERM_CRITERIA_MAX_ITER, 100, 0.00001)
-        count = 0
-        for im in images:
-            print("=> Processing image {0}".format(im))
-            frame = cv2.imread(im)
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            # gray = cv2.flip(gray, 0) # TODO(Sachin) : remove this later
-            # width = scale[1]
-            expected_height = gray.shape[0]*(req_resolution[1]/gray.shape[1])
-            # print('expected height -------------------> ' + str(expected_height))
-            # print('required height -------------------> ' +
-            #       str(req_resolution))
-
-            if scale_req and not (gray.shape[0] == req_resolution[0] and gray.shape[1] == req_resolution[1]):
-                # print("scaling----------------------->")
-                if int(expected_height) == req_resolution[0]:
-                    # resizing to have both stereo and rgb to have same
-                    # resolution to capture extrinsics of the rgb-right camera
-                    gray = cv2.resize(gray, req_resolution[::-1],
-                                      interpolation=cv2.INTER_CUBIC)
-                    # print('~~~~~~~~~~ Only resizing.... ~~~~~~~~~~~~~~~~')
-                else:
-                    # resizing and cropping to have both stereo and rgb to have same resolution
-                    # to calculate extrinsics of the rgb-right camera
-                    scale_width = req_resolution[1]/gray.shape[1]
-                    dest_res = (
-                        int(gray.shape[1] * scale_width), int(gray.shape[0] * scale_width))
-                    # print("destination resolution------>")
-                    # print(dest_res)
-                    gray = cv2.resize(
-                        gray, dest_res, interpolation=cv2.INTER_CUBIC)
-                    # print("scaled gray shape")
-                    # print(gray.shape)
-                    if gray.shape[0] < req_resolution[0]:
-                        raise RuntimeError("resizeed height of rgb is smaller than required. {0} < {1}".format(
-                            gray.shape[0], req_resolution[0]))
-                    # print(gray.shape[0] - req_resolution[0])
-                    del_height = (gray.shape[0] - req_resolution[0]) // 2
-                    # gray = gray[: req_resolution[0], :]
-                    gray = gray[del_height: del_height + req_resolution[0], :]
-
-                    # print("del height ??")
-                    # print(del_height)
-                    # print(gray.shape)
-                count += 1
-                # self.parse_frame(gray, 'rgb_resized',
-                #                  'rgb_resized_'+str(count))
-            marker_corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(
-                gray, self.aruco_dictionary)
-            marker_corners, ids, refusd, recoverd = cv2.aruco.refineDetectedMarkers(gray, self.board,
-                                                                                    marker_corners, ids, rejectedCorners=rejectedImgPoints)
-            print('{0} number of Markers corners detected in the above image'.format(
-                len(marker_corners)))
-            if len(marker_corners) > 0:
-                # print(len(marker_corners))
-                # SUB PIXEL DETECTION
-                #             for corner in marker_corners:
-                #                 cv2.cornerSubPix(gray, corner,
-                #                                  winSize = (5,5),
-                #                                  zeroZone = (-1,-1),
-                #                                  criteria = criteria)
-                res2 = cv2.aruco.interpolateCornersCharuco(
-                    marker_corners, ids, gray, self.board)
-
-                # if res2[1] is not None and res2[2] is not None and len(res2[1])>3 and decimator%1==0:
-                if res2[1] is not None and res2[2] is not None and len(res2[1]) > 3:
-
-                    cv2.cornerSubPix(gray, res2[1],
-                                     winSize=(5, 5),
-                                     zeroZone=(-1, -1),
-                                     criteria=criteria)
-                    allCorners.append(res2[1]) # Charco chess corners
-                    allIds.append(res2[2]) # charuco chess corner id's
+        return self.analyze_charuco_sets([images], scale_req, req_resolution)[0]
+
+    def analyze_charuco_sets(self, image_sets, scale_req=False, req_resolution=(800, 1280)):
+        """
+        Charuco base pose estimation of several image sets (ex: left and right),
+        the images of all the sets are processed concurrently on a process pool.
+        Returns one analyze_charuco result per set, in the order of the images.
+        """
+        images_all = [im for images in image_sets for im in images]
+        params = (self.board_params, scale_req, tuple(req_resolution))
+        detections = [None] * len(images_all)
+        keys = [None] * len(images_all)
+        if self.detection_cache is not None:
+            for i, im in enumerate(images_all):
+                keys[i] = self.detection_cache.key_file(im, params)
+                cached = self.detection_cache.get(keys[i])
+                if cached is not None:
+                    detections[i] = cached + (["=> Processing image {0} (cached)".format(im),
+                        '{0} number of Markers corners detected in the above image'.format(len(cached[1]))],)
+
+        missing = [i for i, detection in enumerate(detections) if detection is None]
+        jobs = [(images_all[i], self.board_params, scale_req, req_resolution) for i in missing]
+        num_workers = min(self.num_workers or os.cpu_count() or 1, len(jobs))
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                # map keeps the order of the jobs, whatever the order of completion
+                results = list(pool.map(detect_charuco, jobs,
+                                        chunksize=max(1, len(jobs) // (4 * num_workers))))
+        else:
+            results = [detect_charuco(job) for job in jobs]
+        for i, detection in zip(missing, results):
+            detections[i] = detection
+            if self.detection_cache is not None:
+                self.detection_cache.put(keys[i], detection[:-1])
+        if self.detection_cache is not None:
+            self.detection_cache.save()
+
+        results = []
+        first = 0
+        for images in image_sets:
+            allCorners = []
+            allIds = []
+            all_marker_corners = []
+            all_marker_ids = []
+            all_recovered = []
+            imsize = None
+            for detection in detections[first:first + len(images)]:
+                imsize, marker_corners, ids, recoverd, corners, corner_ids, messages = detection
+                for message in messages:
+                    print(message)
+                if corners is not None:
+                    allCorners.append(corners) # Charco chess corners
+                    allIds.append(corner_ids) # charuco chess corner id's
                     all_marker_corners.append(marker_corners)
                     all_marker_ids.append(ids)
                     all_recovered.append(recoverd)
-                else:
-                    print("in else")
-            else:
-                print(im + " Not found")
-            # decimator+=1
-
-        imsize = gray.shape
-        return allCorners, allIds, all_marker_corners, all_marker_ids, imsize, all_recovered
+            first += len(images)
+            results.append((allCorners, allIds, all_marker_corners, all_marker_ids, imsize, all_recovered))
+        return results
 
     def calibrate_charuco3D(self, filepath):
         self.objpoints = []  # 3d point in real world space
@@ -310,19 +721,19 @@ class StereoCalibration(object):
         # assert len(
         #     images_rgb) != 0, "ERROR: Images not read correctly, check directory"
 
-        print("~~~~~~~~~~~ POSE ESTIMATION LEFT CAMERA ~~~~~~~~~~~~~")
-        allCorners_l, allIds_l, _, _, imsize, _ = self.analyze_charuco(
-            images_left)
-        allCorners_r, allIds_r, _, _, imsize, _ = self.analyze_charuco(
-            images_right)
+        print("~~~~~~~~~~~ POSE ESTIMATION LEFT AND RIGHT CAMERAS ~~~~~~~~~~~~~")
+        (allCorners_l, allIds_l, _, _, imsize, _), (allCorners_r, allIds_r, _, _, imsize, _) = \
+            self.analyze_charuco_sets([images_left, images_right])
         self.img_shape = imsize[::-1]
 
         # self.img_shape_rgb = imsize_rgb[::-1]
         if self.cameraModel == 'perspective':
-            ret_l, self.M1, self.d1, rvecs, tvecs = self.calibrate_camera_charuco(
-                allCorners_l, allIds_l, self.img_shape)
-            ret_r, self.M2, self.d2, rvecs, tvecs = self.calibrate_camera_charuco(
-                allCorners_r, allIds_r, self.img_shape)
+            views, (ret_l, self.M1, self.d1, rvecs, tvecs), (ret_r, self.M2, self.d2, _, _) = self.select_views(
+                allCorners_l, allIds_l, allCorners_r, allIds_r, self.img_shape)
+            allCorners_l = [allCorners_l[i] for i in views]
+            allIds_l = [allIds_l[i] for i in views]
+            allCorners_r = [allCorners_r[i] for i in views]
+            allIds_r = [allIds_r[i] for i in views]
         else:
             ret_l, self.M1, self.d1, rvecs, tvecs = self.calibrate_fisheye(allCorners_l, allIds_l, self.img_shape)
             ret_r, self.M2, self.d2, rvecs, tvecs = self.calibrate_fisheye(allCorners_r, allIds_r, self.img_shape)
@@ -338,6 +749,7 @@ class StereoCalibration(object):
         print(self.d1)
         print(self.d2)
         # if self.cameraModel == 'perspective':
+        stereo_start = time.time()
         ret, self.M1, self.d1, self.M2, self.d2, self.R, self.T, E, F = self.calibrate_stereo(allCorners_l, allIds_l, allCorners_r, allIds_r, self.img_shape, self.M1, self.d1, self.M2, self.d2)
         self.E = E
         self.F = F
@@ -345,6 +757,15 @@ class StereoCalibration(object):
             # ret, self.M1, self.d1, self.M2, self.d2, self.R, self.T = self.calibrate_stereo(allCorners_l, allIds_l, allCorners_r, allIds_r, self.img_shape, self.M1, self.d1, self.M2, self.d2)
         print("~~~~~~~~~~~~~RMS error of L-R~~~~~~~~~~~~~~")
         print(ret)
+        stereo_ms = 1000 * (time.time() - stereo_start)
+        print("Stereo calibration of {} views took {:.0f} ms".format(len(allIds_l), stereo_ms))
+        if self.view_selection is not None:
+            # all the views extrapolated from the cost per view (the solve grows faster: a lower bound)
+            num_views, extra_ms = self.view_selection
+            all_ms = stereo_ms * num_views / max(len(allIds_l), 1)
+            print("Solve time saved by the view selection: at least {:.0f} ms (stereo calibration of all {} views "
+                  "~{:.0f} ms, instead of {:.0f} ms plus {:.0f} ms of camera calibrations after dropping views)".format(
+                      all_ms - stereo_ms - extra_ms, num_views, all_ms, stereo_ms, extra_ms))
         """         
         left_corners_sampled = []
         right_corners_sampled = []
@@ -426,25 +847,77 @@ class StereoCalibration(object):
             # cv2.destroyAllWindows()        
 
 
+    def select_views(self, allCorners_l, allIds_l, allCorners_r, allIds_r, imsize, max_rounds=3, min_views=6):
+        """
+        Views of the stereo calibration. Both cameras are calibrated, and the views with a
+        reprojection error far above the median (outlier_factor, in either camera) are
+        dropped, for at most max_rounds rounds. Of the remaining views, max_views are
+        chosen for their coverage of both frames and the diversity of the board poses.
+        Returns the indices of the chosen views, and the calibrate_camera_charuco results
+        of the left and right cameras (on all the remaining views).
+        """
+        views = np.arange(min(len(allIds_l), len(allIds_r)))
+        left = right = None
+        extra_ms = 0.0
+        for iteration in range(max_rounds + 1):
+            start = time.time()
+            # after dropping views, the solve starts from the previous round
+            left = self.calibrate_camera_views([allCorners_l[i] for i in views], [allIds_l[i] for i in views], imsize,
+                                               left[1:3] if left is not None else None)
+            right = self.calibrate_camera_views([allCorners_r[i] for i in views], [allIds_r[i] for i in views], imsize,
+                                                right[1:3] if right is not None else None)
+            round_ms = 1000 * (time.time() - start)
+            print("Camera calibration of {} views took {:.0f} ms, RMS left {:.3f} right {:.3f}".format(
+                len(views), round_ms, left[0], right[0]))
+            if iteration > 0:
+                # the first round is the calibration of all the views, done without selection too
+                extra_ms += round_ms
+            if self.outlier_factor is None or iteration == max_rounds:
+                break
+            outliers = np.union1d(view_outliers(left[5], self.outlier_factor),
+                                  view_outliers(right[5], self.outlier_factor))
+            if len(outliers) == 0 or len(views) - len(outliers) < min_views:
+                break
+            print("Dropping {} views with reprojection errors (left, right): {}".format(len(outliers), ", ".join(
+                "{:.2f}/{:.2f}".format(float(left[5][i]), float(right[5][i])) for i in outliers)))
+            views = np.delete(views, outliers)
+
+        chosen = views
+        if self.max_views and len(views) > self.max_views:
+            coverage = [np.concatenate((view_coverage(allCorners_l[i], imsize), view_coverage(allCorners_r[i], imsize)))
+                        for i in views]
+            chosen = views[select_diverse_views(coverage, left[3], self.max_views)]
+            print("Stereo calibration on {} of {} views ({} of {} corners)".format(
+                len(chosen), len(views), sum(len(allIds_l[i]) for i in chosen), sum(len(allIds_l[i]) for i in views)))
+        self.view_selection = (min(len(allIds_l), len(allIds_r)), extra_ms)
+        return chosen, left[:5], right[:5]
+
     def calibrate_camera_charuco(self, allCorners, allIds, imsize):
         """
         Calibrates the camera using the dected corners.
         """
+        return self.calibrate_camera_views(allCorners, allIds, imsize)[:5]
+
+    def calibrate_camera_views(self, allCorners, allIds, imsize, guess=None):
+        """
+        calibrate_camera_charuco, also returning the reprojection error of each view.
+        With guess, the (camera matrix, distortion coefficients) of a previous calibration
+        (ex: before dropping views), the solve starts there and stops once they settle.
+        """
         print("CAMERA CALIBRATION")
         print(imsize)
-        if imsize[1] < 1100:
-            cameraMatrixInit = np.array([[857.1668,    0.0,      643.9126],
-                                         [0.0,     856.0823,  387.56018],
-                                         [0.0,        0.0,        1.0]])
+        if guess is None:
+            cameraMatrixInit = camera_matrix_guess(imsize)
+            distCoeffsInit = np.zeros((5, 1))
+            criteria = (cv2.TERM_CRITERIA_EPS & cv2.TERM_CRITERIA_COUNT, 10000, 1e-9)
         else:
-            cameraMatrixInit = np.array([[3819.8801,    0.0,     1912.8375],
-                                         [0.0,     3819.8801, 1135.3433],
-                                         [0.0,        0.0,        1.]])
+            cameraMatrixInit = guess[0].copy()
+            distCoeffsInit = guess[1].copy()
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 1e-6)
         
         print("Camera Matrix initialization.............")
         print(cameraMatrixInit)
 
-        distCoeffsInit = np.zeros((5, 1))
         flags = (cv2.CALIB_USE_INTRINSIC_GUESS + 
                  cv2.CALIB_RATIONAL_MODEL + cv2.CALIB_FIX_ASPECT_RATIO)
     #     flags = (cv2.CALIB_RATIONAL_MODEL)
@@ -459,9 +932,9 @@ class StereoCalibration(object):
             cameraMatrix=cameraMatrixInit,
             distCoeffs=distCoeffsInit,
             flags=flags,
-            criteria=(cv2.TERM_CRITERIA_EPS & cv2.TERM_CRITERIA_COUNT, 10000, 1e-9))
+            criteria=criteria)
 
-        return ret, camera_matrix, distortion_coefficients, rotation_vectors, translation_vectors
+        return ret, camera_matrix, distortion_coefficients, rotation_vectors, translation_vectors, perViewErrors.ravel()
 
     def calibrate_fisheye(self, allCorners, allIds, imsize):
         one_pts = self.board.chessboardCorners
@@ -487,37 +960,11 @@ class StereoCalibration(object):
         return cv2.fisheye.calibrate(obj_points, allCorners, imsize, cameraMatrixInit, distCoeffsInit, flags = flags, criteria = term_criteria)
     
     def calibrate_stereo(self, allCorners_l, allIds_l, allCorners_r, allIds_r, imsize, cameraMatrix_l, distCoeff_l, cameraMatrix_r, distCoeff_r):
-        left_corners_sampled = []
-        right_corners_sampled = []
-        obj_pts = []
-        one_pts = self.board.chessboardCorners
         print('allIds_l')
         print(len(allIds_l))
         print(len(allIds_r))
-        print('allIds_l')
-        # print(allIds_l)
-        print('allIds_r')
-        # print(allIds_r)
-
-        for i in range(len(allIds_l)):
-            left_sub_corners = []
-            right_sub_corners = []
-            obj_pts_sub = []
-        #     if len(allIds_l[i]) < 70 or len(allIds_r[i]) < 70:
-        #         continue
-            for j in range(len(allIds_l[i])):
-                idx = np.where(allIds_r[i] == allIds_l[i][j])
-                if idx[0].size == 0:
-                    continue
-                left_sub_corners.append(allCorners_l[i][j])
-                right_sub_corners.append(allCorners_r[i][idx])
-                obj_pts_sub.append(one_pts[allIds_l[i][j]])
-
-            obj_pts.append(np.array(obj_pts_sub, dtype=np.float32))
-            left_corners_sampled.append(
-                np.array(left_sub_corners, dtype=np.float32))
-            right_corners_sampled.append(
-                np.array(right_sub_corners, dtype=np.float32))
+        obj_pts, left_corners_sampled, right_corners_sampled = match_charuco_views(
+            allCorners_l, allIds_l, allCorners_r, allIds_r, self.board.chessboardCorners)
 
         stereocalib_criteria = (cv2.TERM_CRITERIA_COUNT +
                                 cv2.TERM_CRITERIA_EPS, 100, 1e-5)
@@ -565,16 +1012,13 @@ class StereoCalibration(object):
         images_right.sort()
         images_rgb.sort()
 
-        allCorners_rgb_scaled, allIds_rgb_scaled, _, _, imsize_rgb_scaled, _ = self.analyze_charuco(
-            images_rgb, scale_req=True, req_resolution=(720, 1280))
+        (allCorners_rgb_scaled, allIds_rgb_scaled, _, _, imsize_rgb_scaled, _), (allCorners_r_rgb, allIds_r_rgb, _, _, _, _) = \
+            self.analyze_charuco_sets([images_rgb, images_right], scale_req=True, req_resolution=(720, 1280))
         self.img_shape_rgb_scaled = imsize_rgb_scaled[::-1]
 
         ret_rgb_scaled, self.M3_scaled, self.d3_scaled, rvecs, tvecs = self.calibrate_camera_charuco(
             allCorners_rgb_scaled, allIds_rgb_scaled, imsize_rgb_scaled[::-1])
 
-        allCorners_r_rgb, allIds_r_rgb, _, _, _, _ = self.analyze_charuco(
-            images_right, scale_req=True, req_resolution=(720, 1280))
-
         print("RGB callleded RMS at 720")
         print(ret_rgb_scaled)
         print(imsize_rgb_scaled)
@@ -582,40 +1026,8 @@ class StereoCalibration(object):
         # print(self.M3_scaled)
 
         # sampling common detected corners
-        rgb_scaled_rgb_corners_sampled = []
-        rgb_scaled_right_corners_sampled = []
-        rgb_scaled_obj_pts = []
-        rgb_pts = None
-        right_pts = None
-        one_pts = self.board.chessboardCorners
-        for i in range(len(allIds_rgb_scaled)):
-            rgb_sub_corners = []
-            right_sub_corners = []
-            obj_pts_sub = []
-            # if len(allIds_l[i]) < 70 or len(allIds_r[i]) < 70:
-            #     continue
-            for j in range(len(allIds_rgb_scaled[i])):
-                idx = np.where(allIds_r_rgb[i] == allIds_rgb_scaled[i][j])
-                if idx[0].size == 0:
-                    continue
-                rgb_sub_corners.append(allCorners_rgb_scaled[i][j])
-                right_sub_corners.append(allCorners_r_rgb[i][idx])
-                obj_pts_sub.append(one_pts[allIds_rgb_scaled[i][j]])
-
-            rgb_scaled_obj_pts.append(
-                np.array(obj_pts_sub, dtype=np.float32))
-            rgb_scaled_rgb_corners_sampled.append(
-                np.array(rgb_sub_corners, dtype=np.float32))
-            rgb_scaled_right_corners_sampled.append(
-                np.array(right_sub_corners, dtype=np.float32))
-            if rgb_pts is None:
-                rgb_pts = np.array(rgb_sub_corners, dtype=np.float32)
-                right_pts = np.array(right_sub_corners, dtype=np.float32)
-            else:
-                np.vstack(
-                    (rgb_pts, np.array(rgb_sub_corners, dtype=np.float32)))
-                np.vstack((right_pts, np.array(
-                    right_sub_corners, dtype=np.float32)))
+        rgb_scaled_obj_pts, rgb_scaled_rgb_corners_sampled, rgb_scaled_right_corners_sampled = match_charuco_views(
+            allCorners_rgb_scaled, allIds_rgb_scaled, allCorners_r_rgb, allIds_r_rgb, self.board.chessboardCorners)
 
         self.objpoints_rgb_r = rgb_scaled_obj_pts
         self.imgpoints_rgb = rgb_scaled_rgb_corners_sampled
@@ -659,6 +1071,15 @@ class StereoCalibration(object):
             self.d2_rgb,
             self.img_shape_rgb_scaled, self.R_rgb, self.T_rgb)
 
+    def detect_rectified(self, gray, name):
+        """
+        Charuco detection of a rectified image (not cached: the rectified images
+        change with every calibration).
+        Returns the charuco corners and ids (None if the image is rejected).
+        """
+        detection = detect_charuco_gray(gray, self.aruco_dictionary, self.board, [], name)
+        return detection[3], detection[4]
+
     def test_epipolar_charuco_lr(self, dataset_dir):
         print("<-----------------Epipolar error of LEFT-right camera---------------->")
         images_left = glob.glob(dataset_dir + '/left/*.png')
@@ -668,8 +1089,6 @@ class StereoCalibration(object):
         print("HU IHER")
         assert len(images_left) != 0, "ERROR: Images not read correctly"
         assert len(images_right) != 0, "ERROR: Images not read correctly"
-        criteria = (cv2.TERM_CRITERIA_EPS +
-                    cv2.TERM_CRITERIA_MAX_ITER, 100, 0.00001)
 
         # if not use_homo:
         mapx_l, mapy_l = cv2.initUndistortRectifyMap(
@@ -702,69 +1121,26 @@ class StereoCalibration(object):
             image_data_pairs.append((img_l, img_r))
 
         # compute metrics
-        imgpoints_r = []
-        imgpoints_l = []
+        errors_all = []
         for i, image_data_pair in enumerate(image_data_pairs):
-            #             gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            marker_corners_l, ids_l, rejectedImgPoints = cv2.aruco.detectMarkers(
-                image_data_pair[0], self.aruco_dictionary)
-            marker_corners_l, ids_l, _, _ = cv2.aruco.refineDetectedMarkers(image_data_pair[0], self.board,
-                                                                            marker_corners_l, ids_l,
-                                                                            rejectedCorners=rejectedImgPoints)
-
-            marker_corners_r, ids_r, rejectedImgPoints = cv2.aruco.detectMarkers(
-                image_data_pair[1], self.aruco_dictionary)
-            marker_corners_r, ids_r, _, _ = cv2.aruco.refineDetectedMarkers(image_data_pair[1], self.board,
-                                                                            marker_corners_r, ids_r,
-                                                                            rejectedCorners=rejectedImgPoints)
-
-            res2_l = cv2.aruco.interpolateCornersCharuco(
-                marker_corners_l, ids_l, image_data_pair[0], self.board)
-            res2_r = cv2.aruco.interpolateCornersCharuco(
-                marker_corners_r, ids_r, image_data_pair[1], self.board)
-            if res2_l[1] is not None and res2_l[2] is not None and len(res2_l[1]) > 3:
-
-                cv2.cornerSubPix(image_data_pair[0], res2_l[1],
-                                 winSize=(5, 5),
-                                 zeroZone=(-1, -1),
-                                 criteria=criteria)
-                cv2.cornerSubPix(image_data_pair[1], res2_r[1],
-                                 winSize=(5, 5),
-                                 zeroZone=(-1, -1),
-                                 criteria=criteria)
-
-            # termination criteria
             img_pth = Path(images_right[i])
-            name = img_pth.name
-            print("Image name {}".format(name))
-            corners_l = []
-            corners_r = []
-            for j in range(len(res2_l[2])):
-                idx = np.where(res2_r[2] == res2_l[2][j])
-                if idx[0].size == 0:
-                    continue
-                corners_l.append(res2_l[1][j])
-                corners_r.append(res2_r[1][idx])
-#                 obj_pts_sub.append(one_pts[allIds_l[i][j]])
-
-#             obj_pts.append(np.array(obj_pts_sub, dtype=np.float32))
-#             left_sub_corners_sampled.append(np.array(left_sub_corners, dtype=np.float32))
-#             right_sub_corners_sampled.append(np.array(right_sub_corners, dtype=np.float32))
-
-            imgpoints_l.extend(corners_l)
-            imgpoints_r.extend(corners_r)
-            epi_error_sum = 0
-            for l_pt, r_pt in zip(corners_l, corners_r):
-                epi_error_sum += abs(l_pt[0][1] - r_pt[0][1])
-            
+            corners_l, ids_l = self.detect_rectified(image_data_pair[0], images_left[i])
+            corners_r, ids_r = self.detect_rectified(image_data_pair[1], images_right[i])
+            if corners_l is None or corners_r is None:
+                print("Skipping {0}, board not found after rectification".format(img_pth.name))
+                continue
+            print("Image name {}".format(img_pth.name))
+
+            corners_l, corners_r, _ = match_charuco_corners(corners_l, ids_l, corners_r, ids_r)
+            if len(corners_l) == 0:
+                print("Skipping {0}, no corner found in both images".format(img_pth.name))
+                continue
+            errors = epipolar_errors(corners_l, corners_r)
+            errors_all.append(errors)
             print("Average Epipolar Error per image on host in " + img_pth.name + " : " +
-                  str(epi_error_sum / len(corners_l)))
+                  str(errors.mean()))
 
-        epi_error_sum = 0
-        for l_pt, r_pt in zip(imgpoints_l, imgpoints_r):
-            epi_error_sum += abs(l_pt[0][1] - r_pt[0][1])
-
-        avg_epipolar = epi_error_sum / len(imgpoints_r)
+        avg_epipolar = np.concatenate(errors_all).mean() if errors_all else float('inf')
         print("Average Epipolar Error: " + str(avg_epipolar))
 
         if self.enable_rectification_disp:
@@ -780,9 +1156,6 @@ class StereoCalibration(object):
         print("<-----------------Epipolar error of rgb-right camera---------------->")
         assert len(images_rgb) != 0, "ERROR: Images not read correctly"
         assert len(images_right) != 0, "ERROR: Images not read correctly"
-        # criteria for marker detection/corner detections
-        criteria = (cv2.TERM_CRITERIA_EPS +
-                    cv2.TERM_CRITERIA_MAX_ITER, 100, 0.00001)
         scale_width = 1280/self.img_shape_rgb_scaled[0]
         print('scaled using {0}'.format(self.img_shape_rgb_scaled[0]))
 
@@ -842,62 +1215,25 @@ class StereoCalibration(object):
             count += 1
 
         # compute metrics
-        imgpoints_r = []
-        imgpoints_l = []
+        errors_all = []
         for i, image_data_pair in enumerate(image_data_pairs):
-            #             gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            marker_corners_l, ids_l, rejectedImgPoints = cv2.aruco.detectMarkers(
-                image_data_pair[0], self.aruco_dictionary)
-            marker_corners_l, ids_l, _, _ = cv2.aruco.refineDetectedMarkers(image_data_pair[0], self.board,
-                                                                            marker_corners_l, ids_l,
-                                                                            rejectedCorners=rejectedImgPoints)
-
-            marker_corners_r, ids_r, rejectedImgPoints = cv2.aruco.detectMarkers(
-                image_data_pair[1], self.aruco_dictionary)
-            marker_corners_r, ids_r, _, _ = cv2.aruco.refineDetectedMarkers(image_data_pair[1], self.board,
-                                                                            marker_corners_r, ids_r,
-                                                                            rejectedCorners=rejectedImgPoints)
-
-            res2_l = cv2.aruco.interpolateCornersCharuco(
-                marker_corners_l, ids_l, image_data_pair[0], self.board)
-            res2_r = cv2.aruco.interpolateCornersCharuco(
-                marker_corners_r, ids_r, image_data_pair[1], self.board)
-            if res2_l[1] is not None and res2_l[2] is not None and len(res2_l[1]) > 3:
-
-                cv2.cornerSubPix(image_data_pair[0], res2_l[1],
-                                 winSize=(5, 5),
-                                 zeroZone=(-1, -1),
-                                 criteria=criteria)
-                cv2.cornerSubPix(image_data_pair[1], res2_r[1],
-                                 winSize=(5, 5),
-                                 zeroZone=(-1, -1),
-                                 criteria=criteria)
-
-            # termination criteria
-            corners_l = []
-            corners_r = []
-            for j in range(len(res2_l[2])):
-                idx = np.where(res2_r[2] == res2_l[2][j])
-                if idx[0].size == 0:
-                    continue
-                corners_l.append(res2_l[1][j])
-                corners_r.append(res2_r[1][idx])
-
-            imgpoints_l.extend(corners_l)
-            imgpoints_r.extend(corners_r)
-            epi_error_sum = 0
-            for l_pt, r_pt in zip(corners_l, corners_r):
-                epi_error_sum += abs(l_pt[0][1] - r_pt[0][1])
             img_pth = Path(images_right[i])
-            # name = img_pth.name
+            corners_l, ids_l = self.detect_rectified(image_data_pair[0], images_rgb[i])
+            corners_r, ids_r = self.detect_rectified(image_data_pair[1], images_right[i])
+            if corners_l is None or corners_r is None:
+                print("Skipping {0}, board not found after rectification".format(img_pth.name))
+                continue
+
+            corners_l, corners_r, _ = match_charuco_corners(corners_l, ids_l, corners_r, ids_r)
+            if len(corners_l) == 0:
+                print("Skipping {0}, no corner found in both images".format(img_pth.name))
+                continue
+            errors = epipolar_errors(corners_l, corners_r)
+            errors_all.append(errors)
             print("Average Epipolar Error per image on host in " + img_pth.name + " : " +
-                  str(epi_error_sum / len(corners_l)))
-            
-        epi_error_sum = 0
-        for l_pt, r_pt in zip(imgpoints_l, imgpoints_r):
-            epi_error_sum += abs(l_pt[0][1] - r_pt[0][1])
+                  str(errors.mean()))
 
-        avg_epipolar = epi_error_sum / len(imgpoints_r)
+        avg_epipolar = np.concatenate(errors_all).mean() if errors_all else float('inf')
         print("Average Epipolar Error of rgb_right: " + str(avg_epipolar))
 
         if self.enable_rectification_disp:
@@ -961,64 +1297,143 @@ class StereoCalibration(object):
         print("Mesh path")
         print(curr_path)
 
-        map_x_l, map_y_l = cv2.initUndistortRectifyMap(self.M1, self.d1, self.R1, self.M2, self.img_shape, cv2.CV_32FC1)
-        map_x_r, map_y_r = cv2.initUndistortRectifyMap(self.M2, self.d2, self.R2, self.M2, self.img_shape, cv2.CV_32FC1)
+        # same projection as the rectification maps (ScaledCalibration), so meshes and maps agree
+        map_x_l, map_y_l = cv2.initUndistortRectifyMap(self.M1, self.d1, self.R1, self.P1[:, :3], self.img_shape, cv2.CV_32FC1)
+        map_x_r, map_y_r = cv2.initUndistortRectifyMap(self.M2, self.d2, self.R2, self.P2[:, :3], self.img_shape, cv2.CV_32FC1)
 
-        map_x_l_fp32 = map_x_l.astype(np.float32)
-        map_y_l_fp32 = map_y_l.astype(np.float32)
-        map_x_r_fp32 = map_x_r.astype(np.float32)
-        map_y_r_fp32 = map_y_r.astype(np.float32)
-        
         print("shape of maps")
         print(map_x_l.shape)
         print(map_y_l.shape)
         print(map_x_r.shape)
         print(map_y_r.shape)
 
-        meshCellSize = 16
-        mesh_left = []
-        mesh_right = []
-
-        for y in range(map_x_l.shape[0] + 1):
-            if y % meshCellSize == 0:
-                row_left = []
-                row_right = []
-                for x in range(map_x_l.shape[1] + 1):
-                    if x % meshCellSize == 0:
-                        if y == map_x_l.shape[0] and x == map_x_l.shape[1]:
-                            row_left.append(map_y_l[y - 1, x - 1])
-                            row_left.append(map_x_l[y - 1, x - 1])
-                            row_right.append(map_y_r[y - 1, x - 1])
-                            row_right.append(map_x_r[y - 1, x - 1])
-                        elif y == map_x_l.shape[0]:
-                            row_left.append(map_y_l[y - 1, x])
-                            row_left.append(map_x_l[y - 1, x])
-                            row_right.append(map_y_r[y - 1, x])
-                            row_right.append(map_x_r[y - 1, x])
-                        elif x == map_x_l.shape[1]:
-                            row_left.append(map_y_l[y, x - 1])
-                            row_left.append(map_x_l[y, x - 1])
-                            row_right.append(map_y_r[y, x - 1])
-                            row_right.append(map_x_r[y, x - 1])
-                        else:
-                            row_left.append(map_y_l[y, x])
-                            row_left.append(map_x_l[y, x])
-                            row_right.append(map_y_r[y, x])
-                            row_right.append(map_x_r[y, x])
-                if (map_x_l.shape[1] % meshCellSize) % 2 != 0:
-                            row_left.append(0)
-                            row_left.append(0)
-                            row_right.append(0)
-                            row_right.append(0)
-
-                mesh_left.append(row_left)
-                mesh_right.append(row_right)    
-        
-        mesh_left = np.array(mesh_left)
-        mesh_right = np.array(mesh_right)
+        mesh_left = create_mesh(map_x_l, map_y_l)
+        mesh_right = create_mesh(map_x_r, map_y_r)
         #left_mesh_fpath = str(curr_path) + '/../resources/left_mesh.calib'
         #right_mesh_fpath = str(curr_path) + '/../resources/right_mesh.calib'
         left_mesh_fpath = str(curr_path) + '/../stereo_data/calib/left_mesh.calib'
         right_mesh_fpath = str(curr_path) + '/../stereo_data/calib/right_mesh.calib'
         mesh_left.tofile(left_mesh_fpath)
         mesh_right.tofile(right_mesh_fpath)
+
+
+class IncrementalCalibration(object):
+    """
+    Stereo calibration updated as each pair is captured: the intrinsics
+    (calibrateCameraCharucoExtended) and the extrinsics (stereoCalibrate) are
+    warm-started from the previous solution with a small iteration budget.
+    Each update reports the reprojection errors, the epipolar error of the
+    rectified corners and the relative change of the parameters; the estimate
+    is converged when the change stayed below tolerance for window updates.
+    """
+
+    def __init__(self, board_params, imsize, iterations=20, min_views=3, window=3, tolerance=0.005):
+        self.aruco_dictionary, self.board = charuco_board(*board_params)
+        self.imsize = tuple(imsize)
+        self.iterations = iterations
+        self.min_views = min_views
+        self.window = window
+        self.tolerance = tolerance
+
+        self.corners = ([], [])
+        self.ids = ([], [])
+        self.M = [camera_matrix_guess(self.imsize), camera_matrix_guess(self.imsize)]
+        self.d = [np.zeros((14, 1)), np.zeros((14, 1))]
+        self.R = None
+        self.T = None
+        self.params = None
+        self.changes = []
+        self.solved = False
+
+    def parameters(self):
+        """Parameters compared between updates: focal lengths, principal points and baseline."""
+        return np.concatenate([self.M[0][[0, 1, 0, 1], [0, 1, 2, 2]], self.M[1][[0, 1, 0, 1], [0, 1, 2, 2]],
+                               [np.linalg.norm(self.T)]])
+
+    def converged(self):
+        return len(self.changes) >= self.window and max(self.changes[-self.window:]) < self.tolerance
+
+    def add_pair(self, gray_l, gray_r):
+        """
+        Adds a captured pair and updates the calibration.
+        Returns a status dict (views, rms_left, rms_right, rms_stereo, epipolar, change,
+        converged, time_ms), 'rejected' is set if the board is not found in both images,
+        'error' if the solve failed (the pair is dropped, the previous solution kept).
+        """
+        start = time.time()
+        detections = []
+        for gray in (gray_l, gray_r):
+            _, _, _, corners, ids, _ = detect_charuco_gray(gray, self.aruco_dictionary, self.board, [])
+            detections.append((corners, ids))
+        if any(corners is None for corners, _ in detections):
+            return {'views': len(self.ids[0]), 'rejected': True}
+        for i, (corners, ids) in enumerate(detections):
+            self.corners[i].append(corners)
+            self.ids[i].append(ids)
+
+        status = {'views': len(self.ids[0]), 'rejected': False, 'converged': False}
+        if len(self.ids[0]) < self.min_views:
+            return status
+
+        # (the solvers update the arrays in place)
+        previous = ([m.copy() for m in self.M], [d.copy() for d in self.d],
+                    None if self.R is None else self.R.copy(), None if self.T is None else self.T.copy())
+        try:
+            status.update(self.solve())
+        except cv2.error as e:
+            # ex: a degenerate view, kept it would fail the next solves too
+            for i in range(2):
+                self.corners[i].pop()
+                self.ids[i].pop()
+            self.M, self.d, self.R, self.T = previous
+            status['views'] = len(self.ids[0])
+            status['error'] = str(e).strip().splitlines()[-1]
+        status['time_ms'] = 1000.0 * (time.time() - start)
+        return status
+
+    def solve(self):
+        # the first solve starts from the initial guess, with the full budget
+        iterations = self.iterations if self.solved else 100
+        criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, iterations, 1e-6)
+        flags = (cv2.CALIB_USE_INTRINSIC_GUESS +
+                 cv2.CALIB_RATIONAL_MODEL + cv2.CALIB_FIX_ASPECT_RATIO)
+        rms = []
+        for i in range(2):
+            ret, self.M[i], self.d[i] = cv2.aruco.calibrateCameraCharucoExtended(
+                charucoCorners=self.corners[i], charucoIds=self.ids[i], board=self.board,
+                imageSize=self.imsize, cameraMatrix=self.M[i], distCoeffs=self.d[i],
+                flags=flags, criteria=criteria)[:3]
+            rms.append(ret)
+
+        obj_pts, left, right = match_charuco_views(self.corners[0], self.ids[0], self.corners[1], self.ids[1],
+                                                   self.board.chessboardCorners)
+        views = [i for i in range(len(obj_pts)) if len(obj_pts[i]) > 3]
+        obj_pts = [obj_pts[i] for i in views]
+        left = [left[i] for i in views]
+        right = [right[i] for i in views]
+        # warm start of the extrinsics (stereoCalibrate rejects CALIB_USE_EXTRINSIC_GUESS)
+        flags = cv2.CALIB_FIX_INTRINSIC + cv2.CALIB_RATIONAL_MODEL
+        if self.solved:
+            flags += cv2.CALIB_USE_EXTRINSIC_GUESS
+        else:
+            self.R = np.eye(3)
+            self.T = np.zeros((3, 1))
+        ret, _, _, _, _, self.R, self.T = cv2.stereoCalibrateExtended(
+            obj_pts, left, right, self.M[0], self.d[0], self.M[1], self.d[1], self.imsize,
+            self.R, self.T, flags=flags, criteria=criteria)[:7]
+
+        # epipolar error of the rectified corners (the points are rectified, not the images)
+        R1, R2, P1, P2, _, _, _ = cv2.stereoRectify(self.M[0], self.d[0], self.M[1], self.d[1],
+                                                    self.imsize, self.R, self.T)
+        left = cv2.undistortPoints(np.concatenate(left), self.M[0], self.d[0], R=R1, P=P1)
+        right = cv2.undistortPoints(np.concatenate(right), self.M[1], self.d[1], R=R2, P=P2)
+        epipolar = float(epipolar_errors(left, right).mean())
+
+        params = self.parameters()
+        if self.params is not None:
+            self.changes.append(float(np.max(np.abs(params - self.params) / np.abs(self.params))))
+        self.params = params
+        self.solved = True
+
+        return {'rms_left': rms[0], 'rms_right': rms[1], 'rms_stereo': ret, 'epipolar': epipolar,
+                'change': self.changes[-1] if self.changes else np.inf, 'converged': self.converged()}
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+import traceback
+
+import cv2
+import numpy as np
+
+
+class MarkerDetector(object):
+    """
+    Aruco marker detection of captured frames on a worker thread, so the preview
+    keeps running. The frames are detected on a downscaled copy (scale), the
+    marker corners are returned in full resolution pixels.
+    """
+
+    def __init__(self, aruco_dictionary, scale=0.5):
+        self.aruco_dictionary = aruco_dictionary
+        self.scale = scale
+        self.requests = queue.Queue(maxsize=1)
+        self.results = queue.Queue()
+        self.pending = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def detect(self, frame):
+        """Returns the (marker corners, ids) of a frame."""
+        if self.scale != 1.0:
+            small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        else:
+            small = frame
+        marker_corners, ids, _ = cv2.aruco.detectMarkers(small, self.aruco_dictionary)
+        marker_corners = [corners / self.scale for corners in marker_corners]
+        return marker_corners, ids
+
+    def busy(self):
+        return self.pending > 0
+
+    def submit(self, frames):
+        """Queues a list of frames (ex: left and right) for detection, returns False if a detection is in flight."""
+        if self.busy():
+            return False
+        self.pending += 1
+        self.requests.put(frames)
+        return True
+
+    def poll(self):
+        """Returns (frames, [(marker corners, ids) per frame]) of a finished detection, or None."""
+        try:
+            result = self.results.get_nowait()
+        except queue.Empty:
+            return None
+        self.pending -= 1
+        return result
+
+    def run(self):
+        while True:
+            frames = self.requests.get()
+            if frames is None:
+                break
+            try:
+                detections = [self.detect(frame) for frame in frames]
+            except Exception:
+                # reported as no markers found, the next submit still works
+                traceback.print_exc()
+                detections = [([], None) for frame in frames]
+            self.results.put((frames, detections))
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+class ImageWriter(object):
+    """
+    Image files written on a background thread (PNG encoding is slow at full resolution).
+    compression is the PNG compression level (0: fastest, largest files - 9: slowest, smallest).
+    """
+
+    def __init__(self, compression=3, max_pending=32):
+        self.params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.failed = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, image):
+        """Queues an image (it must not be modified afterwards), blocks if max_pending writes are queued."""
+        self.queue.put((path, image))
+
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                path, image = item
+                if cv2.imwrite(path, image, self.params):
+                    print("py: Saved image as: " + str(path))
+                else:
+                    self.failed.append(path)
+                    print("py: Failed to write " + str(path))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Waits for the queued images to be written."""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class BackgroundWorker(object):
+    """
+    Runs function(*args) for each submitted job, in order, on a worker thread.
+    The results are polled without blocking (None if the job raised).
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, *args):
+        self.requests.put(args)
+
+    def pending(self):
+        return self.requests.unfinished_tasks
+
+    def poll(self):
+        try:
+            return self.results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def run(self):
+        while True:
+            args = self.requests.get()
+            try:
+                if args is None:
+                    break
+                try:
+                    self.results.put(self.function(*args))
+                except Exception:
+                    traceback.print_exc()
+                    self.results.put(None)
+            finally:
+                self.requests.task_done()
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+class AutoCapture(object):
+    """
+    Automatic capture of stable board poses. The marker detections of every Nth
+    frame trigger a capture once the board moved less than max_motion pixels
+    over stable_frames detections, with min_overlap of its markers inside the
+    target polygon. The chessboard corners of the captured images (interpolated
+    from the markers on the charuco board) accumulate in coverage heatmaps (grid
+    cells of each frame), the capture is done when the target fraction of cells
+    is covered in both frames.
+    """
+
+    def __init__(self, width, height, board, stable_frames=5, max_motion=3.0, min_overlap=0.6,
+                 grid=(16, 10), coverage_target=0.7, mask_scale=8):
+        self.width = width
+        self.height = height
+        self.board = board
+        self.stable_frames = stable_frames
+        self.max_motion = max_motion
+        self.min_overlap = min_overlap
+        self.grid = grid
+        self.coverage_target = coverage_target
+        self.mask_scale = mask_scale
+
+        # corner counts per grid cell, of the left and right frames
+        self.heatmaps = np.zeros((2, grid[1], grid[0]), dtype=np.int32)
+        self.masks = {}
+        self.reset()
+
+    def reset(self):
+        """Forgets the board motion (ex: board lost)."""
+        self.previous = None
+        self.stable = 0
+
+    @staticmethod
+    def centers(markers):
+        """Marker ids (M,) and centers (M,2) of a detection."""
+        marker_corners, ids = markers
+        if ids is None or len(marker_corners) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, 2), dtype=np.float32)
+        corners = np.asarray(marker_corners, dtype=np.float32).reshape(-1, 4, 2)
+        return np.asarray(ids).ravel(), corners.mean(axis=1)
+
+    @staticmethod
+    def motion(previous, current):
+        """Median displacement of the markers seen in both detections (inf if none)."""
+        _, idx_p, idx_c = np.intersect1d(previous[0], current[0], return_indices=True)
+        if len(idx_p) == 0:
+            return np.inf
+        return float(np.median(np.linalg.norm(current[1][idx_c] - previous[1][idx_p], axis=1)))
+
+    def overlap(self, points, polygon):
+        """Fraction of points inside polygon (full resolution coordinates)."""
+        if len(points) == 0:
+            return 0.0
+        key = tuple(map(tuple, np.asarray(polygon).reshape(-1, 2)))
+        if key not in self.masks:
+            mask = np.zeros((self.height // self.mask_scale + 1, self.width // self.mask_scale + 1), dtype=np.uint8)
+            cv2.fillPoly(mask, [np.int32(np.asarray(polygon).reshape(-1, 2) / self.mask_scale)], 1)
+            self.masks[key] = mask
+        mask = self.masks[key]
+        cells = np.clip((points / self.mask_scale).astype(np.int32), 0, [mask.shape[1] - 1, mask.shape[0] - 1])
+        return float(mask[cells[:, 1], cells[:, 0]].mean())
+
+    def update(self, detections, polygon):
+        """
+        Feeds the (marker corners, ids) of the left and right frames.
+        Returns True if these frames should be captured.
+        """
+        current = [self.centers(markers) for markers in detections]
+        if self.previous is not None:
+            motion = max(self.motion(p, c) for p, c in zip(self.previous, current))
+        else:
+            motion = np.inf
+        self.previous = current
+        self.stable = self.stable + 1 if motion <= self.max_motion else 0
+        if self.stable < self.stable_frames:
+            return False
+        if self.overlap(current[0][1], polygon) < self.min_overlap:
+            return False
+        # the next capture needs stable_frames new detections
+        self.stable = 0
+        return True
+
+    def add(self, frames, detections):
+        """Adds the chessboard corners of captured left and right frames (and their marker detections) to the heatmaps."""
+        for heatmap, frame, (marker_corners, ids) in zip(self.heatmaps, frames, detections):
+            if ids is None or len(marker_corners) == 0:
+                continue
+            count, charuco_corners, _ = cv2.aruco.interpolateCornersCharuco(marker_corners, ids, frame, self.board)
+            if not count:
+                continue
+            points = charuco_corners.reshape(-1, 2)
+            ix = np.clip((points[:, 0] * self.grid[0] / self.width).astype(np.int32), 0, self.grid[0] - 1)
+            iy = np.clip((points[:, 1] * self.grid[1] / self.height).astype(np.int32), 0, self.grid[1] - 1)
+            np.add.at(heatmap, (iy, ix), 1)
+
+    def coverage(self):
+        """Fraction of covered cells of the left and right frames (the lowest)."""
+        return float((self.heatmaps > 0).mean(axis=(1, 2)).min())
+
+    def done(self):
+        return self.coverage() >= self.coverage_target
+
+    def coverage_mask(self, index, size):
+        """Covered cells of a frame (0: left, 1: right), as a (height, width) bool mask of size (width, height)."""
+        covered = (self.heatmaps[index] > 0).astype(np.uint8)
+        return cv2.resize(covered, size, interpolation=cv2.INTER_NEAREST) > 0
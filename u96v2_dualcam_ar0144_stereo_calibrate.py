@@ -30,6 +30,7 @@ import sys
 import os
 
 import depthai_helpers.calibration_utils as calibUtils
+from depthai_helpers.capture_utils import MarkerDetector, ImageWriter, AutoCapture, BackgroundWorker
 
 from calibration_store import save_stereo_coefficients
 
@@ -110,6 +111,24 @@ def parse_args():
                         required=False, help="Choose between perspective and Fisheye")
     parser.add_argument("-fps", "--fps", default=30, type=int,
                         required=False, help="Set capture FPS for all cameras. Default: %(default)s")
+    parser.add_argument("-ds", "--detectScale", default=0.5, type=float, required=False,
+                        help="Scale of the frames checked for markers when capturing. Default: %(default)s")
+    parser.add_argument("-pc", "--pngCompression", default=3, type=int, choices=range(10), metavar="[0-9]",
+                        help="PNG compression level of the captured images (0: fastest, 9: smallest). Default: %(default)s")
+    parser.add_argument("-ac", "--autoCapture", default=False, action="store_true",
+                        help="Capture automatically when the board is still inside the polygon, until the coverage target is met")
+    parser.add_argument("-ae", "--autoEvery", default=3, type=int, required=False,
+                        help="Auto capture: check the board every N frames. Default: %(default)s")
+    parser.add_argument("-ak", "--autoStable", default=5, type=int, required=False,
+                        help="Auto capture: number of checks the board must stay still before a capture. Default: %(default)s")
+    parser.add_argument("-acov", "--coverageTarget", default=0.7, type=float, required=False,
+                        help="Auto capture: fraction of the frame cells covered by corners (in both cameras) ending the capture. Default: %(default)s")
+    parser.add_argument("-ic", "--incremental", default=False, action="store_true",
+                        help="Update the calibration as the images are captured, showing the running RMS and epipolar errors and when it converged")
+    parser.add_argument("-mv", "--maxViews", default=20, type=int, required=False,
+                        help="Number of views of the stereo calibration, chosen for the coverage and the diversity of the board poses (0: all). Default: %(default)s")
+    parser.add_argument("-ndc", "--noDetectionCache", default=False, action="store_true",
+                        help="Detect the charuco corners again, instead of using the detections cached in stereo_data/charuco_detections.npz")
     
     options = parser.parse_args()
 
@@ -152,18 +171,20 @@ class Main:
 
         self.dualcam = DualCam('ar0144_dual',self.dualcam_id,self.dualcam_width,self.dualcam_height)
 
+        # marker checks and image writes of the captures run in the background
+        self.detector = MarkerDetector(self.aruco_dictionary, self.args.detectScale)
+        self.writer = ImageWriter(self.args.pngCompression)
 
-    def is_markers_found(self, frame):
-        marker_corners, _, _ = cv2.aruco.detectMarkers(
-            frame, self.aruco_dictionary)
-        print("Markers count ... {}".format(len(marker_corners)))
+
+    def is_markers_found(self, markers, verbose=True):
+        marker_corners, _ = markers
+        if verbose:
+            print("Markers count ... {}".format(len(marker_corners)))
         return not (len(marker_corners) < self.args.squaresX*self.args.squaresY / 4)
 
-    def test_camera_orientation(self, frame_l, frame_r):
-        marker_corners_l, id_l, _ = cv2.aruco.detectMarkers(
-            frame_l, self.aruco_dictionary)
-        marker_corners_r, id_r, _ = cv2.aruco.detectMarkers(
-            frame_r, self.aruco_dictionary)
+    def test_camera_orientation(self, markers_l, markers_r):
+        marker_corners_l, id_l = markers_l
+        marker_corners_r, id_r = markers_r
 
         for i, left_id in enumerate(id_l):
             idx = np.where(id_r == left_id)
@@ -176,14 +197,9 @@ class Main:
         return True
 
     def parse_frame(self, frame, stream_name):
-        if not self.is_markers_found(frame):
-            return False
-
         filename = calibUtils.image_filename(
             stream_name, self.current_polygon, self.images_captured)
-        cv2.imwrite("stereo_data/{}/{}".format(stream_name, filename), frame)
-        print("py: Saved image as: " + str(filename))
-        return True
+        self.writer.write("stereo_data/{}/{}".format(stream_name, filename), frame)
 
     def show_info_frame(self):
         info_frame = np.zeros((600, 1000, 3), np.uint8)
@@ -197,7 +213,12 @@ class Main:
 
         show((25, 100), "Information about image capture:")
         show((25, 160), "Press the [ESC] key to abort.")
-        show((25, 220), "Press the [spacebar] key to capture the image.")
+        if self.args.autoCapture:
+            show((25, 220), "Hold the board still in the polygon to capture.")
+        else:
+            show((25, 220), "Press the [spacebar] key to capture the image.")
+        if self.args.incremental:
+            show((25, 260), "Press the [f] key to finish once the calibration converged.")
         show((25, 300), "Polygon on the image represents the desired chessboard")
         show((25, 340), "position, that will provide best calibration score.")
         show((25, 400), "Will take {} total images, {} per each polygon.".format(
@@ -252,13 +273,22 @@ class Main:
         raise Exception(
             "Calibration failed, Camera Might be held upside down. start again!!")
 
+    def display_polygon(self):
+        """Current polygon in the camera frames (the polygons are drawn on the flipped preview)."""
+        polygon = np.array(self.polygons[self.current_polygon], dtype=np.float32)
+        if self.args.invert_h:
+            polygon[:, 0] = self.width - 1 - polygon[:, 0]
+        if self.args.invert_v:
+            polygon[:, 1] = self.height - 1 - polygon[:, 1]
+        return polygon
+
     def capture_images(self):
         finished = False
-        capturing = False
-        captured_left = False
-        captured_right = False
-        tried_left = False
-        tried_right = False
+        failed_frames = 0
+        frame_count = 0
+        auto = None
+        calibrator = None
+        calibration_status = None
         recent_left = None
         recent_right = None
 
@@ -278,40 +308,103 @@ class Main:
                 continue
 
             recent_frames = [('left', recent_left), ('right', recent_right)]
+            frame_count += 1
+
+            if self.polygons is None:
+                self.height, self.width = recent_left.shape
+                print(self.height, self.width)
+                self.polygons = calibUtils.setPolygonCoordinates(
+                    self.height, self.width)
+                if self.args.autoCapture:
+                    _, board = calibUtils.charuco_board(self.args.squaresX, self.args.squaresY,
+                                                        self.args.squareSizeCm, self.args.markerSizeCm)
+                    auto = AutoCapture(self.width, self.height, board, stable_frames=self.args.autoStable,
+                                       coverage_target=self.args.coverageTarget)
+                if self.args.incremental:
+                    # solved in the background, each pair warm-starts from the previous solution
+                    calibrator = BackgroundWorker(calibUtils.IncrementalCalibration(
+                        (self.args.squaresX, self.args.squaresY, self.args.squareSizeCm, self.args.markerSizeCm),
+                        (self.width, self.height)).add_pair)
 
             key = cv2.waitKey(1)
             if key == 27 or key == ord("q"):
                 print("py: Calibration has been interrupted!")
+                self.stop_capture()
                 raise SystemExit(0)
-            elif key == ord(" "):
+            elif key == ord("f") and calibrator is not None and self.images_captured > 0:
+                print("py: Capture finished with {} images".format(self.images_captured))
+                finished = True
+                cv2.destroyAllWindows()
+                break
+            elif key == ord(" ") and not self.detector.busy() and auto is None:
                 if debug:
                     print("setting capture true------------------------")
-                capturing = True
-
-            frame_list = []
+                print("Capturing  ------------------------")
+                # both frames are taken now (the preview draws on them), and checked in the background
+                self.detector.submit([recent_left.copy(), recent_right.copy()])
+            elif auto is not None and frame_count % self.args.autoEvery == 0 and not self.detector.busy():
+                # the checked frames are the captured ones
+                self.detector.submit([recent_left.copy(), recent_right.copy()])
+
+            result = self.detector.poll()
+            if result is not None:
+                (captured_left_frame, captured_right_frame), (markers_left, markers_right) = result
+                found = self.is_markers_found(markers_left, auto is None) and self.is_markers_found(markers_right, auto is None)
+                if auto is not None:
+                    if found:
+                        capture = auto.update((markers_left, markers_right), self.display_polygon())
+                    else:
+                        auto.reset()
+                        capture = False
+                else:
+                    capture = found
+                if capture:
+                    print(f"Images captured --> {self.images_captured}")
+                    if not self.images_captured:
+                        if not self.test_camera_orientation(markers_left, markers_right):
+                            self.show_failed_orientation()
 
-            for packet in recent_frames:
-                frame = packet[1] 
-                if self.polygons is None:
-                    self.height, self.width = frame.shape
-                    print(self.height, self.width)
-                    self.polygons = calibUtils.setPolygonCoordinates(
-                        self.height, self.width)
+                    self.parse_frame(captured_left_frame, 'left')
+                    self.parse_frame(captured_right_frame, 'right')
+                    self.images_captured += 1
+                    self.images_captured_polygon += 1
+                    if calibrator is not None:
+                        calibrator.submit(captured_left_frame, captured_right_frame)
+                    if auto is not None:
+                        auto.add((captured_left_frame, captured_right_frame), (markers_left, markers_right))
+                        print("py: Coverage {:.0f}%".format(100 * auto.coverage()))
+                elif auto is None:
+                    print("py: Capture failed, unable to find chessboard! Fix position and press spacebar again")
+                    failed_frames = 60
 
+                if self.images_captured_polygon == self.args.count:
+                    self.images_captured_polygon = 0
+                    self.current_polygon += 1
 
-                if capturing:
-                    print("Capturing  ------------------------")
-                    if packet[0] == 'left' and not tried_left:
-                        captured_left = self.parse_frame(frame, packet[0])
-                        tried_left = True
-                        captured_left_frame = frame.copy()
-                    elif packet[0] == 'right' and not tried_right:
-                        captured_right = self.parse_frame(frame, packet[0])
-                        tried_right = True
-                        captured_right_frame = frame.copy()
+                if self.current_polygon == len(self.polygons) or (auto is not None and auto.done()):
+                    if auto is not None:
+                        print("py: Capture done, coverage {:.0f}% with {} images".format(100 * auto.coverage(), self.images_captured))
+                    finished = True
+                    cv2.destroyAllWindows()
+                    break
+
+            status = calibrator.poll() if calibrator is not None else None
+            if status is not None:
+                calibration_status = status
+                if status.get('rejected'):
+                    print("py: Incremental calibration, board not found in the pair")
+                elif 'error' in status:
+                    print("py: Incremental calibration failed: " + status['error'])
+                elif 'rms_stereo' in status:
+                    print("py: Incremental calibration with {views} pairs: RMS left {rms_left:.3f} right {rms_right:.3f} "
+                          "stereo {rms_stereo:.3f}, epipolar error {epipolar:.3f}, change {change:.4f} ({time_ms:.0f} ms)".format(**status))
+                    if status['converged']:
+                        print("py: Calibration converged, more images are unlikely to help. Press [f] to finish the capture")
 
+            frame_list = []
 
-                has_success = (packet[0] == "left" and captured_left) or (packet[0] == "right" and captured_right)
+            for index, packet in enumerate(recent_frames):
+                frame = packet[1] 
 
                 if self.args.invert_v and self.args.invert_h:
                     frame = cv2.flip(frame, -1)
@@ -327,52 +420,65 @@ class Main:
                     ),
                     (0, 700), cv2.FONT_HERSHEY_TRIPLEX, 1.0, (255, 0, 0)
                 )
+                if calibration_status is not None and 'rms_stereo' in calibration_status:
+                    cv2.putText(frame, "RMS {:.3f} epipolar {:.3f}{}".format(
+                                    calibration_status['rms_stereo'], calibration_status['epipolar'],
+                                    " - converged, press [f] to finish" if calibration_status['converged'] else ""),
+                                (0, 760), cv2.FONT_HERSHEY_TRIPLEX, 1.0, (255, 0, 0))
+                if failed_frames > 0:
+                    cv2.putText(frame, "Capture failed, unable to find chessboard!",
+                                (50, self.height // 2), cv2.FONT_HERSHEY_TRIPLEX, 1.4, (255, 0, 0), 2)
                 if self.polygons is not None:
+                    if auto is not None:
+                        still = auto.stable > 0
+                    else:
+                        still = self.detector.busy()
                     cv2.polylines(
                         frame, np.array([self.polygons[self.current_polygon]]),
-                        True, (0, 255, 0) if captured_left else (0, 0, 255), 4
+                        True, (0, 255, 0) if still else (0, 0, 255), 4
                     )
 
                 small_frame = cv2.resize(frame, (0, 0), fx=self.output_scale_factor, fy=self.output_scale_factor)
+                if auto is not None:
+                    # covered cells are shown brighter
+                    covered = auto.coverage_mask(index, small_frame.shape[1::-1])
+                    if self.args.invert_v or self.args.invert_h:
+                        covered = cv2.flip(covered.astype(np.uint8), -1 if self.args.invert_v and self.args.invert_h else (0 if self.args.invert_v else 1)) > 0
+                    small_frame[covered] = small_frame[covered] // 2 + 128
+                    cv2.putText(small_frame, "Coverage {:.0f}%".format(100 * auto.coverage()),
+                                (10, 30), cv2.FONT_HERSHEY_TRIPLEX, 0.8, (255, 0, 0))
                 # cv2.imshow(packet.stream_name, small_frame)
                 frame_list.append(small_frame)
 
-                if captured_left and captured_right:
-                    print(f"Images captured --> {self.images_captured}")
-                    if not self.images_captured:
-                        if not self.test_camera_orientation(captured_left_frame, captured_right_frame):
-                            self.show_failed_orientation()
-
-                    self.images_captured += 1
-                    self.images_captured_polygon += 1
-                    capturing = False
-                    tried_left = False
-                    tried_right = False
-                    captured_left = False
-                    captured_right = False
-
-                if self.images_captured_polygon == self.args.count:
-                    self.images_captured_polygon = 0
-                    self.current_polygon += 1
-
-                    if self.current_polygon == len(self.polygons):
-                        finished = True
-                        cv2.destroyAllWindows()
-                        break
-            
+            failed_frames = max(failed_frames - 1, 0)
             combine_img = None
             combine_img = np.vstack((frame_list[0], frame_list[1]))
             cv2.imshow("left + right", combine_img)
             frame_list.clear()
 
+        if calibrator is not None:
+            calibrator.stop()
+        self.stop_capture()
+        if self.writer.failed:
+            print("py: Failed to write {} images, the dataset is incomplete: {}".format(
+                len(self.writer.failed), ", ".join(self.writer.failed)))
+            raise SystemExit(1)
+
+    def stop_capture(self):
+        """Stops the marker detection, and waits for the queued images to be written."""
+        self.detector.stop()
+        print("Waiting for {} images to be written".format(self.writer.pending()))
+        self.writer.close()
+
     def calibrate(self):
         print("Starting image processing")
-        cal_data = calibUtils.StereoCalibration()
+        cal_data = calibUtils.StereoCalibration(max_views=self.args.maxViews or None)
         dest_path = str(Path('stereo_data/calib').absolute())
         self.args.cameraMode = 'perspective' # hardcoded for now
         try:
             epiploar_error, _, calibData = cal_data.calibrate(self.dataset_path, self.args.squareSizeCm,
-                 self.args.markerSizeCm, self.args.squaresX, self.args.squaresY, self.args.cameraMode, False, self.args.rectifiedDisp)
+                 self.args.markerSizeCm, self.args.squaresX, self.args.squaresY, self.args.cameraMode, False, self.args.rectifiedDisp,
+                 use_cache=not self.args.noDetectionCache)
             if epiploar_error > self.args.maxEpiploarError:
                 image = create_blank(900, 512, rgb_color=red)
                 text = "High L-r epiploar_error: " + str(epiploar_error)
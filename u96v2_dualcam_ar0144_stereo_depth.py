@@ -23,6 +23,7 @@ import argparse
 import sys
 import os
 from calibration_store import load_stereo_coefficients
+import depthai_helpers.calibration_utils as calibUtils
 
 sys.path.append(os.path.abspath('../'))
 sys.path.append(os.path.abspath('./'))
@@ -76,8 +77,13 @@ if __name__ == '__main__':
     parser.add_argument('--input', type=int, required=True, help='Input ID')
     parser.add_argument('--width', type=int, required=True, help='Input resolution width')
     parser.add_argument('--height', type=int, required=True, help='Input resolution height')
+    parser.add_argument('--calib_size', type=int, nargs=2, default=[1280, 800], metavar=('WIDTH', 'HEIGHT'), help='Resolution of the calibration images. Default: %(default)s')
+    parser.add_argument('--crop', type=int, nargs=4, required=False, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'), help='Region of the calibration resolution seen by the capture (default: the whole frame, scaled)')
+    parser.add_argument('--mesh_dir', type=str, required=False, help='Directory of the left_mesh.calib and right_mesh.calib rectification meshes (ex: stereo_data/calib), used instead of the calibration matrices')
 
     args = parser.parse_args()
+    if args.mesh_dir is not None and args.crop is not None:
+        parser.error('--crop is not supported with --mesh_dir (the meshes cover the whole calibration frame)')
     print(args)
         
     inputId = args.input
@@ -87,6 +93,9 @@ if __name__ == '__main__':
     dualcam = DualCam('ar0144_dual',inputId,width,height)
 
     K1, D1, K2, D2, R, T, E, F, R1, R2, P1, P2, Q = load_stereo_coefficients(args.calibration_file)  # Get cams params
+    # K/P/Q and rectification maps derived for the capture size (and crop)
+    calibration = calibUtils.ScaledCalibration(K1, D1, K2, D2, R1, R2, P1, P2, Q, calib_size=args.calib_size)
+    mesh_maps = None
 
     while True:  # Loop until 'q' pressed or stream ends
         leftFrame,rightFrame = dualcam.capture_dual()
@@ -95,10 +104,18 @@ if __name__ == '__main__':
         print("size =",height,"X",width, "chan", channel) 
 
         # Undistortion and Rectification part!
-        leftMapX, leftMapY = cv2.initUndistortRectifyMap(K1, D1, R1, P1, (width, height), cv2.CV_32FC1)
-        left_rectified = cv2.remap(leftFrame, leftMapX, leftMapY, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT)
-        rightMapX, rightMapY = cv2.initUndistortRectifyMap(K2, D2, R2, P2, (width, height), cv2.CV_32FC1)
-        right_rectified = cv2.remap(rightFrame, rightMapX, rightMapY, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT)
+        if args.mesh_dir is not None:
+            if mesh_maps is None:
+                # remap tables upsampled from the calibration meshes (of calib_size images), to the capture size
+                mesh_maps = [ calibUtils.mesh_to_maps(calibUtils.load_mesh(os.path.join(args.mesh_dir, name), calib_size=args.calib_size),
+                                                      calib_size=args.calib_size, size=(width, height))
+                              for name in ('left_mesh.calib', 'right_mesh.calib') ]
+            (leftMapX, leftMapY), (rightMapX, rightMapY) = mesh_maps
+            left_rectified = cv2.remap(leftFrame, leftMapX, leftMapY, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT)
+            right_rectified = cv2.remap(rightFrame, rightMapX, rightMapY, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT)
+        else:
+            # the maps are computed on the first frame of each size, then reused
+            left_rectified, right_rectified = calibration.rectify(leftFrame, rightFrame, crop=args.crop)
 
         # We need grayscale for disparity map.
         gray_left = cv2.cvtColor(left_rectified, cv2.COLOR_BGR2GRAY)
@@ -114,7 +131,7 @@ if __name__ == '__main__':
         if key & 0xFF == ord('q'):  # Get key to stop stream. Press q for exit
             break
         elif key & 0xFF == ord('c'):
-            cv2.imwrite("./img_stereo_depth.png", output)
+            cv2.imwrite("./img_stereo_depth.png", output2)
             print("image taken")
 
 
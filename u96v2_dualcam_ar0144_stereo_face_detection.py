@@ -15,7 +15,7 @@ limitations under the License.
 '''
 
 # USAGE
-# python stereo_face_detection.py [--input 0] [--width 640] [--height 480] [--detthreshold 0.55] [--nmsthreshold 0.35]
+# python stereo_face_detection.py [--input 0] [--width 640] [--height 480] [--detthreshold 0.55] [--nmsthreshold 0.35] [--runners 1] [--detinterval 1] [--tiles 0] [--motiongate 0] [--leftonly] [--calibration stereo_data/calib/dualcam_stereo.yml] [--modelpath ./models] [--stats]
 
 from ctypes import *
 from typing import List
@@ -37,6 +37,13 @@ sys.path.append(os.path.abspath('./'))
 from u96v2_sbc_dualcam.dualcam import DualCam
 from vitis_ai_vart.facedetect import FaceDetect
 from vitis_ai_vart.facelandmark import FaceLandmark
+from vitis_ai_vart.modelregistry import ModelRegistry, format_stats
+from vitis_ai_vart.runnerstats import format_runner_stats
+from vitis_ai_vart.facetracker import FaceTracker
+from vitis_ai_vart.tileddetect import TiledFaceDetect
+from vitis_ai_vart.motiongate import MotionGate
+from vitis_ai_vart.facestereo import match_faces, epipolar_search
+from vitis_ai_vart.faceranging import FaceRanging
 from vitis_ai_vart.utils import get_child_subgraph_dpu
 
 
@@ -52,6 +59,22 @@ ap.add_argument("-d", "--detthreshold", required=False,
 	help = "face detector softmax threshold (default = 0.55)")
 ap.add_argument("-n", "--nmsthreshold", required=False,
 	help = "face detector NMS threshold (default = 0.35)")
+ap.add_argument("-r", "--runners", required=False,
+	help = "number of DPU runners per model (default = 1)")
+ap.add_argument("-t", "--detinterval", required=False,
+	help = "run face detection every N frames, track faces with optical flow in between (default = 1)")
+ap.add_argument("-T", "--tiles", required=False,
+	help = "full resolution tiles per frame for small faces, in addition to the global pass (default = 0 : global pass only)")
+ap.add_argument("-g", "--motiongate", required=False,
+	help = "without motion, only run the DPU models every N frames (default = 0 : no motion gating)")
+ap.add_argument("-s", "--leftonly", required=False, action="store_true",
+	help = "detect faces in the left image only, locate them in the right image by epipolar search")
+ap.add_argument("-p", "--modelpath", required=False,
+	help = "xmodel search path(s), separated by ':' (default = ./models:/usr/share/vitis_ai_library/models)")
+ap.add_argument("-S", "--stats", required=False, action="store_true",
+	help = "print DPU job statistics every 100 frames")
+ap.add_argument("-c", "--calibration", required=False,
+	help = "stereo calibration file, for calibrated ranging (default = baseline/focal estimates)")
 args = vars(ap.parse_args())
 
 if not args.get("input",False):
@@ -82,28 +105,75 @@ else:
   nmsThreshold = float(args["nmsthreshold"])
 print('[INFO] face detector - NMS threshold = ',nmsThreshold)
 
+if not args.get("runners",False):
+  nRunners = 1
+else:
+  nRunners = int(args["runners"])
+print('[INFO] DPU runners per model = ',nRunners)
+
+if not args.get("detinterval",False):
+  detInterval = 1
+else:
+  detInterval = int(args["detinterval"])
+print('[INFO] face detection interval = ',detInterval)
+
+if not args.get("tiles",False):
+  nTiles = 0
+else:
+  nTiles = int(args["tiles"])
+print('[INFO] face detection tiles = ',nTiles)
+
+if not args.get("motiongate",False):
+  nIdleInterval = 0
+else:
+  nIdleInterval = int(args["motiongate"])
+print('[INFO] motion gating idle interval = ',nIdleInterval)
+
+bLeftOnly = args.get("leftonly",False)
+print('[INFO] left only face detection = ',bLeftOnly)
+
+if not args.get("calibration",False):
+  face_ranging = None
+else:
+  face_ranging = FaceRanging(args["calibration"],width,height)
+print('[INFO] stereo calibration = ',args.get("calibration",None))
+
+bStats = args.get("stats",False)
+print('[INFO] DPU job statistics = ',bStats)
+
+# Vitis-AI/DPU models are resolved by name and loaded in the background,
+# while the capture pipeline initializes (first use blocks until loaded)
+if not args.get("modelpath",False):
+  model_registry = ModelRegistry(instrument=bStats)
+else:
+  model_registry = ModelRegistry(args["modelpath"].split(':'),instrument=bStats)
+print('[INFO] model search paths = ',model_registry.searchPaths)
+
 # Initialize Vitis-AI/DPU based face detector
-densebox_xmodel = "/usr/share/vitis_ai_library/models/densebox_640_360/densebox_640_360.xmodel"
-densebox_graph = xir.Graph.deserialize(densebox_xmodel)
-densebox_subgraphs = get_child_subgraph_dpu(densebox_graph)
-assert len(densebox_subgraphs) == 1 # only one DPU kernel
-densebox_dpu = vart.Runner.create_runner(densebox_subgraphs[0],"run")
-dpu_face_detector = FaceDetect(densebox_dpu,detThreshold,nmsThreshold)
-dpu_face_detector.start()
+dpu_face_detector = model_registry.load("densebox_640_360",FaceDetect,detThreshold,nmsThreshold,numRunners=nRunners)
 
 # Initialize Vitis-AI/DPU based face landmark
-landmark_xmodel = "/usr/share/vitis_ai_library/models/face_landmark/face_landmark.xmodel"
-landmark_graph = xir.Graph.deserialize(landmark_xmodel)
-landmark_subgraphs = get_child_subgraph_dpu(landmark_graph)
-assert len(landmark_subgraphs) == 1 # only one DPU kernel
-landmark_dpu = vart.Runner.create_runner(landmark_subgraphs[0],"run")
-dpu_face_landmark = FaceLandmark(landmark_dpu)
-dpu_face_landmark.start()
+dpu_face_landmark = model_registry.load("face_landmark",FaceLandmark,numRunners=nRunners)
+
+# Tiled detection (global pass + full resolution tiles around small faces)
+if nTiles > 0:
+  tiled_face_detector = TiledFaceDetect(dpu_face_detector,maxTiles=nTiles)
 
 # Initialize the capture pipeline
 print("[INFO] Initializing the capture pipeline ...")
 dualcam = DualCam('ar0144_dual',inputId,width,height)
 
+# Initialize the left/right face trackers
+left_tracker = FaceTracker(detInterval)
+right_tracker = FaceTracker(detInterval)
+
+# Initialize the left/right motion gates
+if nIdleInterval > 0:
+  left_gate = MotionGate(nIdleInterval)
+  right_gate = MotionGate(nIdleInterval)
+left_landmarks = np.zeros((0,5,2),dtype=np.float32)
+right_landmarks = np.zeros((0,5,2),dtype=np.float32)
+
 # inspired from cvzone.Utils.py
 def cornerRect( img, bbox, l=20, t=5, rt=1, colorR=(255,0,255), colorC=(0,255,0)):
 
@@ -135,6 +205,8 @@ def cornerRect( img, bbox, l=20, t=5, rt=1, colorR=(255,0,255), colorC=(0,255,0)
 
 bUseLandmarks = False
 nLandmarkId = 2
+nFrames = 0
+prevActive = [True, True]
 
 # loop over the frames from the video stream
 while True:
@@ -145,124 +217,115 @@ while True:
 	frame1 = left_frame.copy()
 	frame2 = right_frame.copy()
 
-	# Vitis-AI/DPU based face detector
-	left_faces = dpu_face_detector.process(left_frame)
-	right_faces = dpu_face_detector.process(right_frame)
-
-	# if one face detected in each image, calculate the centroids to detect distance range
-	distance_valid = False
-	if (len(left_faces) == 1) & (len(right_faces) == 1):
-
-		# loop over the left faces
-		for i,(left,top,right,bottom) in enumerate(left_faces):
-			cornerRect(frame2,(left,top,right,bottom),colorR=(255,255,255),colorC=(255,255,255))
- 
-			# centroid
-			if bUseLandmarks == False:  
-				x = int((left+right)/2)
-				y = int((top+bottom)/2)
-				cv2.circle(frame2,(x,y),4,(255,255,255),-1)
-			# get left coordinate (keep float, for full precision)  
-			left_cx = (left+right)/2
-			left_cy = (top+bottom)/2
-
-			# get face landmarks
-			startX = int(left)
-			startY = int(top)
-			endX   = int(right)
-			endY   = int(bottom)      
-			face = left_frame[startY:endY, startX:endX]
-			landmarks = dpu_face_landmark.process(face)
-			if bUseLandmarks == True:  
-				for i in range(5):
-					x = startX + int(landmarks[i,0] * (endX-startX))
-					y = startY + int(landmarks[i,1] * (endY-startY))
-					cv2.circle( frame2, (x,y), 3, (255,255,255), 2)
-				x = startX + int(landmarks[nLandmarkId,0] * (endX-startX))
-				y = startY + int(landmarks[nLandmarkId,1] * (endY-startY))
-				cv2.circle( frame2, (x,y), 4, (255,255,255), -1)
-			# get left coordinate (keep float, for full precision)  
-			left_lx = left   + (landmarks[nLandmarkId,0] * (right-left))
-			left_ly = bottom + (landmarks[nLandmarkId,1] * (bottom-top))  
-
-		# loop over the right faces
-		for i,(left,top,right,bottom) in enumerate(right_faces): 
-			cornerRect(frame2,(left,top,right,bottom),colorR=(255,255,0),colorC=(255,255,0))
-
-			# centroid
-			if bUseLandmarks == False:  
-				x = int((left+right)/2)
-				y = int((top+bottom)/2)
-				cv2.circle(frame2,(x,y),4,(255,255,0),-1)
-			# get right coordinate (keep float, for full precision)  
-			right_cx = (left+right)/2
-			right_cy = (top+bottom)/2
-
-			# get face landmarks
-			startX = int(left)
-			startY = int(top)
-			endX   = int(right)
-			endY   = int(bottom)      
-			face = right_frame[startY:endY, startX:endX]
-			landmarks = dpu_face_landmark.process(face)
-			if bUseLandmarks == True:  
-				for i in range(5):
-					x = startX + int(landmarks[i,0] * (endX-startX))
-					y = startY + int(landmarks[i,1] * (endY-startY))
-					cv2.circle( frame2, (x,y), 3, (255,255,0), 2)  
-				x = startX + int(landmarks[nLandmarkId,0] * (endX-startX))
-				y = startY + int(landmarks[nLandmarkId,1] * (endY-startY))
-				cv2.circle( frame2, (x,y), 4, (255,255,0), -1)  
-			# get right coordinate (keep float, for full precision)  
-			right_lx = left   + (landmarks[nLandmarkId,0] * (right-left))
-			right_ly = bottom + (landmarks[nLandmarkId,1] * (bottom-top))  
-
-		delta_cx = abs(left_cx - right_cx)
-		delta_cy = abs(right_cy - left_cy)
-		message1 = "delta_cx="+str(int(delta_cx))
-
-		delta_lx = abs(left_lx - right_lx)
-		delta_ly = abs(right_ly - left_ly)
-		message2 = "delta_lx="+str(int(delta_lx))
-
-		if bUseLandmarks == False:  
-			delta_x = delta_cx
-			delta_y = delta_cy
-			cv2.putText(frame2,message1,(20,20),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,0),2)
-			cv2.putText(frame2,message2,(20,40),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,255),2)
-
-		if bUseLandmarks == True:  
-			delta_x = delta_lx
-			delta_y = delta_ly
-			cv2.putText(frame2,message1,(20,20),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,255),2)
-			cv2.putText(frame2,message2,(20,40),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,0),2)
-
-		# distance = (baseline * focallength) / disparity
-		#    ref : https://learnopencv.com/introduction-to-epipolar-geometry-and-stereo-vision/
-		#
-		# baseline = 50 mm (measured)
-		# focal length = 2.48mm * (1 pixel / 0.003mm) = 826.67 pixels => gives better results
-		# focal length = 2.48mm * (1280 pixels / 5.565mm) = 570 pixels => 
-		#    ref: http://avnet.me/ias-ar0144-datasheet
-		#
-		disparity = delta_x * (1280 / width) # scale back to active array
-		distance = (50 * 827) / (disparity)
-		#distance = (50 * 570) / (disparity)
+	left_gray = cv2.cvtColor(left_frame,cv2.COLOR_BGR2GRAY)
+	right_gray = cv2.cvtColor(right_frame,cv2.COLOR_BGR2GRAY)
+
+	# Motion gating : on a static scene the previous faces and landmarks are carried forward,
+	# and the DPU models only run every nIdleInterval frames
+	if nIdleInterval > 0:
+		active = [left_gate.update(left_gray), right_gate.update(right_gray)]
+	else:
+		active = [True, True]
+	if bLeftOnly == True:
+		active[1] = active[0]
+	# the trackers were not updated while idle : the first active frame is detected, not propagated
+	for tracker,wasActive,isActive in zip((left_tracker,right_tracker),prevActive,active):
+		if isActive and not wasActive:
+			tracker.reset_flow()
+	prevActive = active
+
+	# Vitis-AI/DPU based face detector, only for the eyes whose tracker needs a detection
+	# (left and right share one job when the xmodel batch allows it,
+	#  otherwise they run concurrently on the pool's runners)
+	trackers = (left_tracker,right_tracker)
+	frames = (left_frame,right_frame)
+	detect = [left_tracker.needs_detection() and active[0], right_tracker.needs_detection() and active[1] and not bLeftOnly]
+	if nTiles == 0:
+		detections = iter(dpu_face_detector.process_batch([frame for frame,d in zip(frames,detect) if d]))
+	else:
+		detections = iter(tiled_face_detector.process_batch([frame for frame,d in zip(frames,detect) if d],
+		                                                    [tracker.boxes() for tracker,d in zip(trackers,detect) if d]))
+
+	# Face trackers (propagate the boxes with optical flow between detections)
+	if active[0] == True:
+		left_faces = left_tracker.update(left_gray, next(detections) if detect[0] else None)
+	else:
+		left_faces = left_tracker.boxes()
+	if bLeftOnly == False:
+		if active[1] == True:
+			right_faces = right_tracker.update(right_gray, next(detections) if detect[1] else None)
+		else:
+			right_faces = right_tracker.boxes()
+	if bLeftOnly == True:
+		# locate the left faces in the right image along their epipolar rows (faces closer than 25cm are not searched)
+		search_faces,search_disparities,_ = epipolar_search(left_gray,right_gray,left_faces,
+		                                                     minDisparity=1,maxDisparity=(50*827/250)/(1280/width))
+		search_valid = np.nonzero(~np.isnan(search_disparities))[0]
+		right_faces = search_faces[search_valid]
+
+	# get face landmarks (all the faces of an eye in one batch, in image coordinates),
+	# and the reference point (centroid or landmark, keep float for full precision) of each face
+	if active[0] == True or len(left_landmarks) != len(left_faces):
+		left_landmarks = dpu_face_landmark.process_batch(left_frame,left_faces)
+	if active[1] == True or len(right_landmarks) != len(right_faces):
+		right_landmarks = dpu_face_landmark.process_batch(right_frame,right_faces)
+	left_points = (left_faces[:,0:2] + left_faces[:,2:4]) / 2
+	right_points = (right_faces[:,0:2] + right_faces[:,2:4]) / 2
+	if bUseLandmarks == True:
+		left_points = np.where(np.isnan(left_landmarks[:,nLandmarkId,:]),left_points,left_landmarks[:,nLandmarkId,:])
+		right_points = np.where(np.isnan(right_landmarks[:,nLandmarkId,:]),right_points,right_landmarks[:,nLandmarkId,:])
+
+	for faces,landmarks,points,color in ((left_faces,left_landmarks,left_points,(255,255,255)),(right_faces,right_landmarks,right_points,(255,255,0))):
+		for i,(left,top,right,bottom) in enumerate(faces):
+			cornerRect(frame2,(left,top,right,bottom),colorR=color,colorC=color)
+			if bUseLandmarks == True:
+				for (x,y) in landmarks[i][~np.isnan(landmarks[i,:,0])]:
+					cv2.circle( frame2, (int(x),int(y)), 3, color, 2)
+			cv2.circle(frame2,(int(points[i,0]),int(points[i,1])),4,color,-1)
+
+	# distance = (baseline * focallength) / disparity
+	#    ref : https://learnopencv.com/introduction-to-epipolar-geometry-and-stereo-vision/
+	#
+	# baseline = 50 mm (measured)
+	# focal length = 2.48mm * (1 pixel / 0.003mm) = 826.67 pixels => gives better results
+	# focal length = 2.48mm * (1280 pixels / 5.565mm) = 570 pixels => 
+	#    ref: http://avnet.me/ias-ar0144-datasheet
+	#
+	# associate the left and right faces (epipolar constraint, size and appearance),
+	# and range each pair (disparity scaled back to the active array)
+	if bLeftOnly == False:
+		pairs,disparities,distances = match_faces(left_faces,right_faces,left_gray,right_gray,
+		                                          left_points,right_points,
+		                                          baseline=50,focal=827,dispScale=(1280/width))
+	if bLeftOnly == True:
+		# the epipolar search already paired the faces, with a sub-pixel disparity
+		pairs = np.stack([search_valid,np.arange(len(search_valid))],axis=1)
+		disparities = search_disparities[search_valid] * (1280/width)
+		distances = (50 * 827) / disparities
+
+	if face_ranging is not None:
+		# calibrated ranging : rectify and triangulate the reference points of each pair
+		disparities,distances = face_ranging.range_pairs(left_points,right_points,pairs)
+
+	distance_valid = np.zeros(len(left_faces),dtype=bool)
+	for k,((l,r),disparity,distance) in enumerate(zip(pairs,disparities,distances)):
 		message1 = "disparity : "+str(int(disparity))+" pixels"
 		message2 = "distance : "+str(int(distance))+" mm"
-		cv2.putText(frame1,message1,(20,20),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,255),2)
-		cv2.putText(frame1,message2,(20,40),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,255),2)
+		cv2.putText(frame1,message1,(20,20+45*k),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,255),2)
+		cv2.putText(frame1,message2,(20,40+45*k),cv2.FONT_HERSHEY_SIMPLEX,0.75,(255,255,255),2)
+		cv2.line(frame2,(int(left_points[l,0]),int(left_points[l,1])),(int(right_points[r,0]),int(right_points[r,1])),(0,255,255),1)
 
 		if ( (distance > 500) & (distance < 1000) ):
-			distance_valid = True
-                    
+			distance_valid[l] = True
+
 	# loop over the left faces
 	for i,(left,top,right,bottom) in enumerate(left_faces): 
 
-		if distance_valid == True:
+		if distance_valid[i] == True:
 			cornerRect(frame1,(left,top,right,bottom),colorR=(0,255,0),colorC=(0,255,0))
-		if distance_valid == False:
+		if distance_valid[i] == False:
 			cornerRect(frame1,(left,top,right,bottom),colorR=(0,0,255),colorC=(0,0,255))
+		cv2.putText(frame1,"id "+str(left_tracker.ids()[i]),(int(left),int(top)-8),cv2.FONT_HERSHEY_SIMPLEX,0.5,(255,255,255),1)
 
 
 	# Display the processed image
@@ -270,6 +333,12 @@ while True:
 	cv2.imshow("Stereo Face Detection", display_frame)
 	key = cv2.waitKey(1) & 0xFF
 
+	# DPU job statistics (utilisation close to 100% : DPU-bound, otherwise CPU-bound)
+	nFrames = nFrames + 1
+	if bStats == True and nFrames % 100 == 0:
+		for name,stats in model_registry.runner_stats().items():
+			print(format_runner_stats(name,stats))
+
 	if key == ord("d"):
 		bUseLandmarks = not bUseLandmarks
 		print("bUseLandmarks = ",bUseLandmarks);
@@ -285,13 +354,12 @@ while True:
 	if key == ord("q"):
 		break
 
-# Stop the face detector
-dpu_face_detector.stop()
-del densebox_dpu
+# Startup latencies of the models
+for name,stats in model_registry.report().items():
+	print("[INFO] model",name,":",format_stats(stats))
 
-# Stop the landmark detector
-dpu_face_landmark.stop()
-del landmark_dpu
+# Stop the face detector and landmark detector
+model_registry.stop()
 
 # Cleanup
 cv2.destroyAllWindows()
@@ -0,0 +1,167 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+from collections import OrderedDict
+import numpy as np
+
+
+def landmark_quality(landmarks):
+    """
+    Frontal pose score of faces, from their 5 landmarks (see FaceLandmark).
+
+    The score is 1.0 for a frontal, upright face : it decreases with the yaw
+    (offset of the nose from the middle of the eyes, relative to the eye distance)
+    and with the roll (angle of the eye line).
+
+    # Arguments
+        landmarks: ndarray, (N,5,2) left eye, right eye, nose, left and right mouth corners
+
+    # Returns
+        quality: ndarray, (N,) scores in [0,1] (0 for missing landmarks)
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float32).reshape(-1,5,2)
+    eyes = landmarks[:,1] - landmarks[:,0]
+    eyeDistance = np.maximum(np.linalg.norm(eyes, axis=1), 1e-6)
+    eyesCentre = (landmarks[:,0] + landmarks[:,1]) / 2
+
+    # nose offset along the eye line
+    yaw = np.abs(np.sum((landmarks[:,2] - eyesCentre) * eyes, axis=1)) / (eyeDistance * eyeDistance)
+    roll = np.abs(eyes[:,1]) / eyeDistance
+
+    quality = np.clip(1.0 - 2.0*yaw, 0.0, 1.0) * np.sqrt(np.clip(1.0 - roll*roll, 0.0, 1.0))
+    return np.nan_to_num(quality, nan=0.0)
+
+
+class CacheEntry():
+  __slots__ = ('embedding','frame','height','quality')
+
+  def __init__(self, embedding, frame, height, quality):
+    self.embedding = embedding
+    self.frame = frame
+    self.height = height
+    self.quality = quality
+
+
+class EmbeddingCache():
+  '''
+  Latest FaceFeature embedding of each track (see FaceTracker), so that identity
+  is computed per track instead of per frame.
+
+  An embedding is recomputed when it is older than maxAge frames, when the face
+  height changed by more than maxScaleChange, or when the pose improved by more
+  than qualityGain. Faces with a pose score below minQuality are not recomputed
+  once an embedding exists. Entries are evicted in least recently used order
+  beyond maxEntries, or beyond maxBytes of embeddings.
+  '''
+
+  def __init__(self, maxEntries=64, maxBytes=None, maxAge=30, maxScaleChange=0.25, qualityGain=0.2, minQuality=0.3):
+
+    self.maxEntries = maxEntries
+    self.maxBytes = maxBytes
+    self.maxAge = maxAge
+    self.maxScaleChange = maxScaleChange
+    self.qualityGain = qualityGain
+    self.minQuality = minQuality
+
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.frame = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, track_id):
+    return track_id in self.entries
+
+  def tick(self):
+    """ Advance the frame counter (once per frame) """
+    self.frame += 1
+
+  def stale(self, track_ids, boxes, landmarks=None):
+    """
+    Select the faces whose embedding must be (re)computed this frame.
+
+    # Arguments
+        track_ids: list, track id of each face (see FaceTracker.ids)
+        boxes: ndarray, (N,4) boxes of the faces
+        landmarks: ndarray, optional (N,5,2) landmarks of the faces
+
+    # Returns
+        indices: ndarray, indices of the faces to recompute
+        quality: ndarray, (N,) pose scores (ones without landmarks)
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1,4)
+    heights = boxes[:,3] - boxes[:,1]
+    if landmarks is None:
+      quality = np.ones(len(boxes), dtype=np.float32)
+    else:
+      quality = landmark_quality(landmarks)
+
+    indices = []
+    for i,track_id in enumerate(track_ids):
+      entry = self.entries.get(track_id)
+      if entry is None:
+        indices.append(i)
+        continue
+      self.entries.move_to_end(track_id)
+      if quality[i] < self.minQuality:
+        continue
+      if self.frame - entry.frame >= self.maxAge \
+         or abs(heights[i] - entry.height) > self.maxScaleChange * entry.height \
+         or quality[i] > entry.quality + self.qualityGain:
+        indices.append(i)
+
+    return np.array(indices, dtype=np.int64), quality
+
+  def update(self, track_ids, embeddings, boxes, quality=None):
+    """ Store the embeddings computed for (a subset of) the faces """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1,4)
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(boxes),-1)
+    if quality is None:
+      quality = np.ones(len(boxes), dtype=np.float32)
+
+    for i,track_id in enumerate(track_ids):
+      entry = self.entries.pop(track_id, None)
+      if entry is not None:
+        self.nbytes -= entry.embedding.nbytes
+      embedding = embeddings[i].copy()
+      self.entries[track_id] = CacheEntry(embedding, self.frame, float(boxes[i,3]-boxes[i,1]), float(quality[i]))
+      self.nbytes += embedding.nbytes
+
+    self.evict()
+
+  def evict(self):
+    while len(self.entries) > self.maxEntries or (self.maxBytes is not None and self.nbytes > self.maxBytes and len(self.entries) > 0):
+      track_id, entry = self.entries.popitem(last=False)
+      self.nbytes -= entry.embedding.nbytes
+
+  def get(self, track_ids):
+    """ Cached embeddings of the tracks, as an (N,512) array (NaN rows for unknown tracks) """
+    rows = [self.entries[t].embedding if t in self.entries else None for t in track_ids]
+    dim = next((len(r) for r in rows if r is not None), 512)
+    embeddings = np.full((len(rows),dim), np.nan, dtype=np.float32)
+    for i,row in enumerate(rows):
+      if row is not None:
+        embeddings[i] = row
+    return embeddings
+
+  def remove(self, track_ids):
+    """ Drop the entries of tracks that ended """
+    for track_id in track_ids:
+      entry = self.entries.pop(track_id, None)
+      if entry is not None:
+        self.nbytes -= entry.embedding.nbytes
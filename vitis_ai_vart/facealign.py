@@ -0,0 +1,136 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import cv2
+import numpy as np
+
+
+# canonical positions (x,y) of the 5 landmarks in a 96x112 face
+# (left eye, right eye, nose, left and right mouth corners)
+CANONICAL_LANDMARKS = np.array([ [30.2946, 51.6963],
+                                 [65.5318, 51.5014],
+                                 [48.0252, 71.7366],
+                                 [33.5493, 92.3655],
+                                 [62.7299, 92.2041] ], dtype=np.float32)
+
+
+def similarity_transforms(src, dst):
+    """
+    Least squares similarity transforms (rotation, uniform scale, translation)
+    mapping each set of src points onto the dst points, for all faces at once.
+
+    # Arguments
+        src: ndarray, (N,P,2) points of each face
+        dst: ndarray, (P,2) target points
+
+    # Returns
+        transforms: ndarray, (N,2,3) affine matrices (NaN for faces with missing points)
+    """
+    src = np.asarray(src, dtype=np.float64).reshape(-1,len(dst),2)
+    dst = np.asarray(dst, dtype=np.float64)
+
+    srcMean = src.mean(axis=1, keepdims=True)
+    dstMean = dst.mean(axis=0)
+    s = src - srcMean
+    d = dst - dstMean
+
+    norm = np.maximum(np.sum(s*s, axis=(1,2)), 1e-12)
+    a = np.sum(s*d, axis=(1,2)) / norm
+    b = np.sum(s[:,:,0]*d[:,1] - s[:,:,1]*d[:,0], axis=1) / norm
+
+    transforms = np.empty((len(src),2,3), dtype=np.float64)
+    transforms[:,0,0] = a
+    transforms[:,0,1] = -b
+    transforms[:,1,0] = b
+    transforms[:,1,1] = a
+    transforms[:,:,2] = dstMean - np.einsum('nij,nj->ni', transforms[:,:,:2], srcMean[:,0])
+    return transforms
+
+
+class FaceAligner():
+  '''
+  Batched face alignment for FaceFeature : the similarity transforms of all faces
+  are estimated at once from their 5 landmarks (see FaceLandmark.process_batch),
+  and all faces are warped by a single cv2.remap into a preallocated stack of
+  canonical (height,width) crops, which FaceFeature.process_aligned consumes directly.
+  '''
+
+  def __init__(self, width=96, height=112, capacity=8):
+
+    self.width = width
+    self.height = height
+    self.template = CANONICAL_LANDMARKS * np.array([width/96.0, height/112.0], dtype=np.float32)
+
+    # homogeneous coordinates of the canonical pixels, (3,height*width)
+    gx, gy = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    self.grid = np.stack([gx.ravel(), gy.ravel(), np.ones(width*height, dtype=np.float32)])
+
+    self.faceStack = np.empty((capacity,height,width,3), dtype=np.uint8)
+    self.mapX = np.empty((capacity*height,width), dtype=np.float32)
+    self.mapY = np.empty((capacity*height,width), dtype=np.float32)
+
+  def reserve(self, nFaces):
+    if len(self.faceStack) < nFaces:
+      self.faceStack = np.empty((nFaces,self.height,self.width,3), dtype=np.uint8)
+      self.mapX = np.empty((nFaces*self.height,self.width), dtype=np.float32)
+      self.mapY = np.empty((nFaces*self.height,self.width), dtype=np.float32)
+
+  def align(self, frame, landmarks):
+    """
+    Warp all faces of a frame into canonical crops.
+
+    # Arguments
+        frame: ndarray, image the landmarks were computed on
+        landmarks: ndarray, (N,5,2) landmarks in image coordinates
+
+    # Returns
+        faces: ndarray, (N,height,width,3) view of the preallocated stack
+               (overwritten by the next call)
+        valid: ndarray, (N,) False for faces with missing landmarks (filled with 128)
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float32).reshape(-1,5,2)
+    nFaces = len(landmarks)
+    self.reserve(nFaces)
+    faces = self.faceStack[:nFaces]
+    if nFaces == 0:
+      return faces, np.zeros(0, dtype=bool)
+
+    transforms = similarity_transforms(landmarks, self.template)
+    valid = np.all(np.isfinite(transforms), axis=(1,2)) & (np.abs(transforms[:,0,0]) + np.abs(transforms[:,1,0]) > 1e-6)
+    transforms[~valid] = [[1,0,0],[0,1,0]]
+
+    # inverse transforms : canonical pixel -> image pixel, for all faces in one product
+    linear = transforms[:,:,:2]
+    det = linear[:,0,0]*linear[:,1,1] - linear[:,0,1]*linear[:,1,0]
+    inverse = np.empty_like(transforms)
+    inverse[:,0,0] = linear[:,1,1] / det
+    inverse[:,0,1] = -linear[:,0,1] / det
+    inverse[:,1,0] = -linear[:,1,0] / det
+    inverse[:,1,1] = linear[:,0,0] / det
+    inverse[:,:,2] = -np.einsum('nij,nj->ni', inverse[:,:,:2], transforms[:,:,2])
+    coords = np.matmul(inverse.astype(np.float32), self.grid)
+
+    # the faces are stacked vertically : one remap warps them all
+    mapX = self.mapX[:nFaces*self.height]
+    mapY = self.mapY[:nFaces*self.height]
+    mapX[...] = coords[:,0].reshape(-1,self.width)
+    mapY[...] = coords[:,1].reshape(-1,self.width)
+    cv2.remap(frame, mapX, mapY, cv2.INTER_LINEAR, dst=faces.reshape(-1,self.width,3),
+              borderMode=cv2.BORDER_REPLICATE)
+    faces[~valid] = 128
+
+    return faces, valid
@@ -25,8 +25,8 @@ import numpy as np
 from numpy import float32
 import math
 
-import vart
 #from utils import get_child_subgraph_dpu
+from vitis_ai_vart.modelengine import ModelEngine
   
 def time_it(msg,start,end):
     print("[INFO] {} took {:.8} seconds".format(msg,end-start))
@@ -112,12 +112,14 @@ class FaceDetect():
   def __init__(self, dpu, detThreshold=0.55, nmsThreshold=0.35):
 
     self.dpu = dpu
+    self.engine = ModelEngine(dpu)
 
     self.detThreshold = detThreshold
     self.nmsThreshold = nmsThreshold
 
     self.inputTensors = []
     self.outputTensors = []
+    self.batchSize = []
     self.inputChannels = []
     self.inputHeight = []
     self.inputWidth = []
@@ -135,56 +137,22 @@ class FaceDetect():
 
   def start(self):
 
-    dpu = self.dpu
-    #print("[INFO] facedetect runner=",dpu)
-
-    inputTensors = dpu.get_input_tensors()
-    #print("[INFO] inputTensors=",inputTensors)
-    outputTensors = dpu.get_output_tensors()
-    #print("[INFO] outputTensors=",outputTensors)
-    
-    #print("[INFO] inputTensors[0]=",inputTensors[0])
-    inputHeight = inputTensors[0].dims[1]
-    inputWidth = inputTensors[0].dims[2]
-    inputChannels = inputTensors[0].dims[3]
-    #print("[INFO] input tensor : format=NHWC, Height=",inputHeight," Width=",inputWidth,", Channels=", inputChannels)
-    
-    #print("[INFO] outputTensors[0]=",outputTensors[0])
-    output0Height = outputTensors[0].dims[1]
-    output0Width = outputTensors[0].dims[2]
-    output0Channels = outputTensors[0].dims[3]
-    #print("[INFO] output[0] tensor : format=NHWC, height=",output0Height," width=",output0Width,", channels=",output0Channels)
-    output1Height = outputTensors[1].dims[1]
-    output1Width = outputTensors[1].dims[2]
-    output1Channels = outputTensors[1].dims[3]
-    #print("[INFO] output[1] tensor : format=NHWC, height=",output1Height," width=",output1Width,", channels=",output1Channels)
-
-    output0Size = output0Height*output0Width*output0Channels
-    output1Size = output1Height*output1Width*output1Channels
-
-    inputShape = (1,inputHeight,inputWidth,inputChannels)
-    #print("[INFO] inputShape=",inputShape)
-    output0Shape = (1,output0Height,output0Width,output0Channels)
-    #print("[INFO] output0Shape=",output0Shape)
-    output1Shape = (1,output1Height,output1Width,output1Channels)
-    #print("[INFO] output1Shape=",output1Shape)
-
-    self.inputTensors = inputTensors
-    self.outputTensors = outputTensors
-    self.inputChannels = inputChannels
-    self.inputHeight = inputHeight
-    self.inputWidth = inputWidth
-    self.inputShape = inputShape
-    self.output0Channels = output0Channels
-    self.output0Height = output0Height
-    self.output0Width = output0Width
-    self.output0Size = output0Size
-    self.output0Shape = output0Shape
-    self.output1Channels = output1Channels
-    self.output1Height = output1Height
-    self.output1Width = output1Width
-    self.output1Size = output1Size
-    self.output1Shape = output1Shape
+    engine = self.engine
+    engine.start()
+    #print("[INFO] facedetect tensors=",engine.inputs,engine.outputs)
+
+    # input tensor : format=NHWC, output tensors : bboxes (NHW4), scores (NHW2)
+    self.inputTensors = [ info.tensor for info in engine.inputs ]
+    self.outputTensors = [ info.tensor for info in engine.outputs ]
+    self.batchSize = engine.batchSize
+    self.inputHeight, self.inputWidth, self.inputChannels = engine.inputs[0].dims
+    self.inputShape = engine.inputs[0].shape
+    self.output0Height, self.output0Width, self.output0Channels = engine.outputs[0].dims
+    self.output0Size = engine.outputs[0].size
+    self.output0Shape = engine.outputs[0].shape
+    self.output1Height, self.output1Width, self.output1Channels = engine.outputs[1].dims
+    self.output1Size = engine.outputs[1].size
+    self.output1Shape = engine.outputs[1].shape
 
   def config(self, detThreshold, nmsThreshold):
     self.detThreshold = detThreshold
@@ -194,60 +162,51 @@ class FaceDetect():
   def process(self,img):
     #print("[INFO] facedetect process")
 
-    dpu = self.dpu
-    #print("[INFO] facedetect runner=",dpu)
+    return self.process_batch([img])[0]
+
+  def preprocess(self,inputs,imgs):
+    """ Image pre-processing : normalize + resize """
+    inputImage = inputs[0]
+    for i,img in enumerate(imgs):
+      inputImage[i,...] = cv2.resize(img - 128.0,(self.inputWidth,self.inputHeight))
+
+  def postprocess_batch(self,outputs,imgs,first):
+    return [ self.postprocess(outputs[0][i],outputs[1][i],img.shape[0],img.shape[1]) for i,img in enumerate(imgs) ]
+
+  def postprocess_batch_scores(self,outputs,imgs,first):
+    return [ self.postprocess(outputs[0][i],outputs[1][i],img.shape[0],img.shape[1],True) for i,img in enumerate(imgs) ]
+
+  def process_batch(self,imgs):
+    #print("[INFO] facedetect process_batch")
+
+    # images are chunked to the xmodel's batch size (see ModelEngine.run)
+    results = self.engine.run(imgs,self.preprocess,self.postprocess_batch)
+    return [faces for chunk_faces in results for faces in chunk_faces]
+
+  def process_batch_scores(self,imgs):
+    #print("[INFO] facedetect process_batch_scores")
+
+    # same as process_batch, with a (faces,scores) tuple per image
+    results = self.engine.run(imgs,self.preprocess,self.postprocess_batch_scores)
+    return [faces for chunk_faces in results for faces in chunk_faces]
+
+  def postprocess(self,output0,output1,imgHeight,imgWidth,return_scores=False):
 
-    inputChannels = self.inputChannels
     inputHeight = self.inputHeight
     inputWidth = self.inputWidth
-    inputShape = self.inputShape
-    output0Channels = self.output0Channels
     output0Height = self.output0Height
     output0Width = self.output0Width
     output0Size = self.output0Size
-    output0Shape = self.output0Shape
-    output1Channels = self.output1Channels
-    output1Height = self.output1Height
-    output1Width = self.output1Width
     output1Size = self.output1Size
-    output1Shape = self.output1Shape
 
-    imgHeight = img.shape[0]
-    imgWidth  = img.shape[1]
     scale_h = imgHeight / inputHeight
     scale_w = imgWidth / inputWidth
-    
-    """ Image pre-processing """
-    #print("[INFO] process - pre-processing - normalize ")
-    # normalize
-    img = img - 128.0
-    #print("[INFO] process - pre-processing - resize ")
-    # resize
-    img = cv2.resize(img,(inputWidth,inputHeight))
-
-    """ Prepare input/output buffers """
-    #print("[INFO] process - prep input buffer ")
-    inputData = []
-    inputData.append(np.empty((inputShape),dtype=np.float32,order='C'))
-    inputImage = inputData[0]
-    inputImage[0,...] = img
-
-    #print("[INFO] process - prep output buffer ")
-    outputData = []
-    outputData.append(np.empty((output0Shape),dtype=np.float32,order='C'))
-    outputData.append(np.empty((output1Shape),dtype=np.float32,order='C'))
-
-    """ Execute model on DPU """
-    #print("[INFO] process - execute ")
-    job_id = dpu.execute_async( inputData, outputData )
-    dpu.wait(job_id)
-
-    """ Retrieve output results """    
+
     #print("[INFO] process - get outputs ")
-    OutputData0 = outputData[0].reshape(1,output0Size)
+    OutputData0 = output0.reshape(1,output0Size)
     bboxes = np.reshape( OutputData0, (-1, 4) )
     #
-    outputData1 = outputData[1].reshape(1,output1Size)
+    outputData1 = output1.reshape(1,output1Size)
     scores = np.reshape( outputData1, (-1, 2))
 
     """ Get original face boxes """
@@ -288,17 +247,20 @@ class FaceDetect():
         ymax = min(face[3] * scale_h, imgHeight )
         faces[i] = ( int(xmin),int(ymin),int(xmax),int(ymax) )
 
+    if return_scores:
+      return faces, prob[face_indices]
     return faces
 
   def stop(self):
     #"""Destroy Runner"""
+    self.engine.stop()
     del self.dpu
 	
     self.dpu = []
     self.inputTensors = []
     self.outputTensors = []
-    self.tensorFormat = []
-    self.input0Channels = []
+    self.batchSize = []
+    self.inputChannels = []
     self.inputHeight = []
     self.inputWidth = []
     self.inputShape = []
@@ -306,9 +268,9 @@ class FaceDetect():
     self.output0Height = []
     self.output0Width = []
     self.output0Size = []
+    self.output0Shape = []
     self.output1Channels = []
     self.output1Height = []
     self.output1Width = []
     self.output1Size = []
-
-
+    self.output1Shape = []
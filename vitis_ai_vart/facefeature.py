@@ -25,8 +25,8 @@ import numpy as np
 from numpy import float32
 import math
 
-import vart
 #from utils import get_child_subgraph_dpu
+from vitis_ai_vart.modelengine import ModelEngine
   
 def time_it(msg,start,end):
     print("[INFO] {} took {:.8} seconds".format(msg,end-start))
@@ -45,9 +45,11 @@ class FaceFeature():
   def __init__(self, dpu):
 
     self.dpu = dpu
-    
+    self.engine = ModelEngine(dpu)
+
     self.inputTensors = []
     self.outputTensors = []
+    self.batchSize = []
     self.inputChannels = []
     self.inputHeight = []
     self.inputWidth = []
@@ -57,102 +59,75 @@ class FaceFeature():
 
   def start(self):
 
-    dpu = self.dpu
-    #print("[INFO] facefeature runner=",dpu)
-
-    inputTensors = dpu.get_input_tensors()
-    #print("[INFO] inputTensors=",inputTensors)
-    outputTensors = dpu.get_output_tensors()
-    #print("[INFO] outputTensors=",outputTensors)
-    
-    inputHeight = inputTensors[0].dims[1]
-    inputWidth = inputTensors[0].dims[2]
-    inputChannels = inputTensors[0].dims[3]
-    #print("[INFO] input tensor : format=NHWC, Height=",inputHeight," Width=",inputWidth,", Channels=", inputChannels)
-    
-    #print("[INFO] outputTensors[0]=",outputTensors[0])
-    outputSize = outputTensors[0].dims[1]
-    #print("[INFO] output[0] tensor : size=",outputSize)
-
-    inputShape = (1,inputHeight,inputWidth,inputChannels)
-    #print("[INFO] inputShape=",inputShape)
-    outputShape = (1,outputSize)
-    #print("[INFO] outputShape=",outputShape)
-
-    self.inputTensors = inputTensors
-    self.outputTensors = outputTensors
-    self.inputChannels = inputChannels
-    self.inputHeight = inputHeight
-    self.inputWidth = inputWidth
-    self.inputShape = inputShape
-    self.outputSize = outputSize
-    self.outputShape = outputShape
+    engine = self.engine
+    engine.start()
+    #print("[INFO] facefeature tensors=",engine.inputs,engine.outputs)
+
+    # input tensor : format=NHWC, output tensor : 512-d embedding
+    self.inputTensors = [ info.tensor for info in engine.inputs ]
+    self.outputTensors = [ info.tensor for info in engine.outputs ]
+    self.batchSize = engine.batchSize
+    self.inputHeight, self.inputWidth, self.inputChannels = engine.inputs[0].dims
+    self.inputShape = engine.inputs[0].shape
+    self.outputSize = engine.outputs[0].size
+    self.outputShape = (self.batchSize,self.outputSize)
 
   def process(self,img):
     #print("[INFO] facefeature process")
 
-    dpu = self.dpu
-    #print("[INFO] facefeature runner=",dpu)
+    return self.process_crops([img])[0:1]
+
+  def postprocess(self,outputs,chunk,first):
+    """ Retrieve output results """
+    OutputData = outputs[0][:len(chunk)].reshape(len(chunk),self.outputSize)
+    return np.reshape( OutputData, (-1, 512) )
+
+  def run(self,faces,preprocess):
+    results = self.engine.run(faces,preprocess,self.postprocess)
+    if len(results) == 0:
+      return np.empty((0,512),dtype=np.float32)
+    return np.concatenate(results,axis=0)
+
+  def process_crops(self,imgs):
+    #print("[INFO] facefeature process_crops")
 
-    inputChannels = self.inputChannels
     inputHeight = self.inputHeight
     inputWidth = self.inputWidth
-    inputShape = self.inputShape
-    outputSize = self.outputSize
-    outputShape = self.outputShape
-
-    imgHeight = img.shape[0]
-    imgWidth  = img.shape[1]
-    scale_h = imgHeight / inputHeight
-    scale_w = imgWidth / inputWidth
-    
-    """ Image pre-processing """
-    #print("[INFO] process - pre-processing - resize ")
-    resize_img = cv2.resize(img,(inputWidth,inputHeight))
-    #print("[INFO] process - pre-processing - convert to float ")
-    input_image = resize_img.astype(np.float)
-    #print("[INFO] process - pre-processing - normalize (-128.0) ")
-    input_image = input_image - 128.0
-    #print("[INFO] process - pre-processing - scale (*0.0078125) ")
-    input_image = input_image * 0.0078125
-
-    """ Prepare input/output buffers """
-    #print("[INFO] process - prep input buffer ")
-    inputData = []
-    inputData.append(np.empty((inputShape),dtype=np.float32,order='C'))
-    inputImage = inputData[0]
-    inputImage[0,...] = input_image
-
-    #print("[INFO] process - prep output buffer ")
-    outputData = []
-    outputData.append(np.empty((outputShape),dtype=np.float32,order='C'))
-
-    """ Execute model on DPU """
-    #print("[INFO] process - execute ")
-    job_id = dpu.execute_async( inputData, outputData )
-    dpu.wait(job_id)
-
-    """ Retrieve output results """    
-    #print("[INFO] process - get output ")
-    OutputData = outputData[0].reshape(1,outputSize)
-    #print(OutputData)
-    features = np.reshape( OutputData, (-1, 512) )
-
-    return features
+
+    def preprocess(inputs,chunk):
+      """ Image pre-processing : resize, normalize (-128.0) and scale (*0.0078125) """
+      inputImage = inputs[0]
+      for i,img in enumerate(chunk):
+        resize_img = cv2.resize(img,(inputWidth,inputHeight))
+        inputImage[i,...] = (resize_img.astype(np.float32) - 128.0) * 0.0078125
+
+    # crops are chunked to the xmodel's batch size (see ModelEngine.run)
+    return self.run(imgs,preprocess)
+
+  def process_aligned(self,faces):
+    #print("[INFO] facefeature process_aligned")
+
+    def preprocess(inputs,chunk):
+      """ Image pre-processing : normalize (-128.0) and scale (*0.0078125) """
+      count = len(chunk)
+      np.subtract(chunk,128.0,out=inputs[0][:count])
+      inputs[0][:count] *= 0.0078125
+
+    # faces are already warped to the input size (see FaceAligner.align)
+    return self.run(faces,preprocess)
 
   def stop(self):
     #"""Destroy Runner"""
+    self.engine.stop()
     del self.dpu
 	
     self.dpu = []
     self.inputTensors = []
     self.outputTensors = []
-    self.tensorFormat = []
-    self.input0Channels = []
+    self.batchSize = []
+    self.inputChannels = []
     self.inputHeight = []
     self.inputWidth = []
     self.inputShape = []
     self.outputSize = []
     self.outputShape = []
-
-
@@ -0,0 +1,234 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import json
+import os
+import numpy as np
+
+
+def l2_normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(scores, k):
+    """ Indices and values of the k best scores of each row, best first """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((len(scores),0), dtype=np.int64), np.zeros((len(scores),0), dtype=np.float32)
+    idx = np.argpartition(-scores, k-1, axis=1)[:, :k]
+    val = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-val, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(val, order, axis=1)
+
+
+class FaceGallery():
+  '''
+  Gallery of enrolled face embeddings (see FaceFeature), for recognition.
+
+  Embeddings are L2-normalized and kept in a memory-mapped (capacity,dim)
+  matrix (embeddings.npy), with the label of each row in gallery.json. A top-k
+  cosine query is a single matrix product with the gallery. Above ivfThreshold
+  rows, queries go through an IVF index instead : a spherical k-means coarse
+  quantizer, and only the rows of the nprobe closest lists are scored.
+  Below it, a float32 copy of the rows is kept between queries (invalidated
+  when the gallery changes), so a query does not convert the whole matrix.
+  '''
+
+  def __init__(self, path, dim=512, dtype=np.float16, capacity=1024, ivfThreshold=20000, nprobe=8):
+
+    self.path = path
+    self.ivfThreshold = ivfThreshold
+    self.nprobe = nprobe
+
+    os.makedirs(path, exist_ok=True)
+    self.matrixFile = os.path.join(path, 'embeddings.npy')
+    self.tableFile = os.path.join(path, 'gallery.json')
+
+    if os.path.exists(self.tableFile):
+      with open(self.tableFile) as f:
+        table = json.load(f)
+      self.labels = table['labels']
+      self.matrix = np.lib.format.open_memmap(self.matrixFile, mode='r+')
+    else:
+      self.labels = []
+      self.matrix = np.lib.format.open_memmap(self.matrixFile, mode='w+', dtype=dtype, shape=(capacity,dim))
+
+    self.count = len(self.labels)
+    self.dim = self.matrix.shape[1]
+
+    # float32 rows of the flat search (built lazily)
+    self.cache = None
+
+    # IVF index (built lazily)
+    self.centroids = None
+    self.listOf = None
+    self.listOrder = None
+    self.listOffsets = None
+    self.trainedCount = 0
+
+  def __len__(self):
+    return self.count
+
+  def grow(self, capacity):
+    """ Re-allocate the memory-mapped matrix with a larger capacity """
+    tmpFile = self.matrixFile + '.tmp.npy'
+    matrix = np.lib.format.open_memmap(tmpFile, mode='w+', dtype=self.matrix.dtype, shape=(capacity,self.dim))
+    matrix[:self.count] = self.matrix[:self.count]
+    matrix.flush()
+    del matrix
+    del self.matrix
+    os.replace(tmpFile, self.matrixFile)
+    self.matrix = np.lib.format.open_memmap(self.matrixFile, mode='r+')
+
+  def enroll(self, label, embeddings):
+    """
+    Add one or several embeddings of an identity.
+
+    # Arguments
+        label: str, identity
+        embeddings: ndarray, (512,) or (N,512) embeddings
+    """
+    embeddings = l2_normalize(np.asarray(embeddings).reshape(-1,self.dim))
+    count = self.count + len(embeddings)
+    if count > len(self.matrix):
+      self.grow(max(count, 2*len(self.matrix)))
+
+    self.matrix[self.count:count] = embeddings
+    self.labels.extend([label]*len(embeddings))
+    self.cache = None
+    if self.centroids is not None:
+      self.listOf = np.concatenate([self.listOf, self.assign(embeddings)])
+      self.listOrder = None
+    self.count = count
+
+  def remove(self, label):
+    """ Remove all the embeddings of an identity (the last rows are moved into the holes) """
+    rows = [i for i,l in enumerate(self.labels) if l == label]
+    for row in reversed(rows):
+      last = self.count - 1
+      if row != last:
+        self.matrix[row] = self.matrix[last]
+        self.labels[row] = self.labels[last]
+        if self.listOf is not None:
+          self.listOf[row] = self.listOf[last]
+      self.labels.pop()
+      self.count -= 1
+    if self.listOf is not None:
+      self.listOf = self.listOf[:self.count]
+      self.listOrder = None
+    if len(rows) > 0:
+      self.cache = None
+    return len(rows)
+
+  def flush(self):
+    """ Persist the gallery (embeddings matrix and label table) """
+    self.matrix.flush()
+    with open(self.tableFile, 'w') as f:
+      json.dump({ 'dim' : self.dim, 'labels' : self.labels }, f)
+
+  def assign(self, embeddings):
+    return np.argmax(embeddings @ self.centroids.T, axis=1)
+
+  def train(self, nlist=None, iterations=10, blockSize=65536, seed=0):
+    """ Train the coarse quantizer (spherical k-means on a sample) and assign all rows to lists """
+    if nlist is None:
+      nlist = int(np.sqrt(self.count))
+    nlist = max(1, min(nlist, self.count))
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(self.count, min(self.count, 64*nlist), replace=False)
+    data = np.asarray(self.matrix[np.sort(sample)], dtype=np.float32)
+
+    centroids = data[rng.choice(len(data), nlist, replace=False)]
+    for it in range(iterations):
+      assigned = np.argmax(data @ centroids.T, axis=1)
+      order = np.argsort(assigned, kind='stable')
+      counts = np.bincount(assigned, minlength=nlist)
+      starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+      sums = centroids.copy()
+      nonempty = counts > 0
+      sums[nonempty] = np.add.reduceat(data[order], starts[nonempty], axis=0)
+      centroids = l2_normalize(sums)
+    self.centroids = centroids
+
+    # assign all rows, by blocks to bound memory
+    listOf = np.empty(self.count, dtype=np.int64)
+    for first in range(0, self.count, blockSize):
+      block = np.asarray(self.matrix[first:first+blockSize], dtype=np.float32)
+      listOf[first:first+len(block)] = self.assign(block[:self.count-first])
+    self.listOf = listOf
+    self.listOrder = None
+    self.trainedCount = self.count
+
+  def build_lists(self):
+    self.listOrder = np.argsort(self.listOf, kind='stable')
+    counts = np.bincount(self.listOf, minlength=len(self.centroids))
+    self.listOffsets = np.concatenate([[0], np.cumsum(counts)])
+
+  def query(self, embeddings, k=5):
+    """
+    Top-k cosine similarity search.
+
+    # Arguments
+        embeddings: ndarray, (512,) or (Q,512) query embeddings (see FaceFeature.process)
+
+    # Returns
+        labels: list of Q lists of k labels, best first (None past the rows found)
+        scores: ndarray, (Q,k) cosine similarities (-1.0 past the rows found)
+    """
+    queries = l2_normalize(np.asarray(embeddings).reshape(-1,self.dim))
+    if self.count == 0:
+      return self.results(np.zeros((len(queries),0), dtype=np.int64), np.zeros((len(queries),0), dtype=np.float32), k)
+
+    if self.count < self.ivfThreshold:
+      self.centroids = None
+      self.listOf = None
+      if self.cache is None:
+        self.cache = np.asarray(self.matrix[:self.count], dtype=np.float32)
+      scores = queries @ self.cache.T
+      idx, val = top_k(scores, k)
+      return self.results(idx, val, k)
+    self.cache = None
+
+    # (re)train when the gallery doubled since the last training
+    if self.centroids is None or self.count > 2*self.trainedCount:
+      self.train()
+    if self.listOrder is None:
+      self.build_lists()
+
+    # all the queries are scored in one product against the rows of the lists probed by any of them,
+    # the rows of the lists a query did not probe are masked out
+    probes = top_k(queries @ self.centroids.T, self.nprobe)[0]
+    probed = np.zeros((len(queries),len(self.centroids)), dtype=bool)
+    np.put_along_axis(probed, probes, True, axis=1)
+    lists = np.flatnonzero(probed.any(axis=0))
+    rows = np.concatenate([ self.listOrder[self.listOffsets[c]:self.listOffsets[c+1]] for c in lists ])
+    rows.sort()
+    scores = queries @ np.asarray(self.matrix[rows], dtype=np.float32).T
+    scores[~probed[:,self.listOf[rows]]] = -np.inf
+    idx, val = top_k(scores, k)
+    return self.results(rows[idx], val, k)
+
+  def results(self, idx, val, k):
+    """ Labels and scores of the top_k rows, padded to k (masked rows, -inf, are not found) """
+    labels = [[None]*k for row in idx]
+    scores = np.full((len(idx),k), -1.0, dtype=np.float32)
+    for q,(row,values) in enumerate(zip(idx,val)):
+      found = np.isfinite(values)
+      labels[q][:np.count_nonzero(found)] = [self.labels[i] for i in row[found]]
+      scores[q,:np.count_nonzero(found)] = values[found]
+    return labels, scores
@@ -25,8 +25,8 @@ import numpy as np
 from numpy import float32
 import math
 
-import vart
 #from utils import get_child_subgraph_dpu
+from vitis_ai_vart.modelengine import ModelEngine
   
 def time_it(msg,start,end):
     print("[INFO] {} took {:.8} seconds".format(msg,end-start))
@@ -44,115 +44,124 @@ class FaceLandmark():
   def __init__(self, dpu):
 
     self.dpu = dpu
-    
+    self.engine = ModelEngine(dpu)
+
     self.inputTensors = []
     self.outputTensors = []
+    self.batchSize = []
     self.inputChannels = []
     self.inputHeight = []
     self.inputWidth = []
     self.inputShape = []
     self.outputSize = []
     self.outputShape = []
+    self.cropStack = []
 
   def start(self):
 
-    dpu = self.dpu
-    #print("[INFO] facelandmark runner=",dpu)
-
-    inputTensors = dpu.get_input_tensors()
-    #print("[INFO] inputTensors=",inputTensors)
-    outputTensors = dpu.get_output_tensors()
-    #print("[INFO] outputTensors=",outputTensors)
-    
-    inputHeight = inputTensors[0].dims[1]
-    inputWidth = inputTensors[0].dims[2]
-    inputChannels = inputTensors[0].dims[3]
-    #print("[INFO] input tensor : format=NHWC, Height=",inputHeight," Width=",inputWidth,", Channels=", inputChannels)
-    
-    #print("[INFO] outputTensors[0]=",outputTensors[0])
-    outputSize = outputTensors[0].dims[1]
-    #print("[INFO] output[0] tensor : size=",outputSize)
-
-    inputShape = (1,inputHeight,inputWidth,inputChannels)
-    #print("[INFO] inputShape=",inputShape)
-    outputShape = (1,outputSize)
-    #print("[INFO] outputShape=",outputShape)
-
-    self.inputTensors = inputTensors
-    self.outputTensors = outputTensors
-    self.inputChannels = inputChannels
-    self.inputHeight = inputHeight
-    self.inputWidth = inputWidth
-    self.inputShape = inputShape
-    self.outputSize = outputSize
-    self.outputShape = outputShape
+    engine = self.engine
+    engine.start()
+    #print("[INFO] facelandmark tensors=",engine.inputs,engine.outputs)
+
+    # input tensor : format=NHWC, output tensor : 5 (x,y) points
+    self.inputTensors = [ info.tensor for info in engine.inputs ]
+    self.outputTensors = [ info.tensor for info in engine.outputs ]
+    self.batchSize = engine.batchSize
+    self.inputHeight, self.inputWidth, self.inputChannels = engine.inputs[0].dims
+    self.inputShape = engine.inputs[0].shape
+    self.outputSize = engine.outputs[0].size
+    self.outputShape = (self.batchSize,self.outputSize)
+
+    # crops of the current chunk (the engine normalizes them into its own buffers)
+    self.cropStack = np.empty((self.batchSize,self.inputHeight,self.inputWidth,self.inputChannels),dtype=np.uint8)
 
   def process(self,img):
     #print("[INFO] facelandmark process")
 
-    dpu = self.dpu
-    #print("[INFO] facelandmark runner=",dpu)
+    return self.process_crops([img])[0]
+
+  def postprocess(self,outputs,chunk,first):
+    """ Retrieve output results """
+    OutputData = outputs[0][:len(chunk)].reshape(len(chunk),self.outputSize)
+    return np.reshape(OutputData,(-1,5,2),order='F')
+
+  def process_crops(self,imgs):
+    #print("[INFO] facelandmark process_crops")
+
+    inputHeight = self.inputHeight
+    inputWidth = self.inputWidth
+
+    def preprocess(inputs,chunk):
+      """ Image pre-processing : resize, normalize (-128.0) and scale (*0.0078125) """
+      inputImage = inputs[0]
+      for i,img in enumerate(chunk):
+        resize_img = cv2.resize(img,(inputWidth,inputHeight))
+        inputImage[i,...] = (resize_img.astype(np.float32) - 128.0) * 0.0078125
+
+    # crops are chunked to the xmodel's batch size (see ModelEngine.run)
+    results = self.engine.run(imgs,preprocess,self.postprocess)
+    if len(results) == 0:
+      return np.empty((0,5,2),dtype=np.float32)
+    return np.concatenate(results,axis=0)
+
+  def process_batch(self,frame,boxes):
+    #print("[INFO] facelandmark process_batch")
 
-    inputChannels = self.inputChannels
     inputHeight = self.inputHeight
     inputWidth = self.inputWidth
-    inputShape = self.inputShape
-    outputSize = self.outputSize
-    outputShape = self.outputShape
-
-    imgHeight = img.shape[0]
-    imgWidth  = img.shape[1]
-    scale_h = imgHeight / inputHeight
-    scale_w = imgWidth / inputWidth
-    
-    """ Image pre-processing """
-    #print("[INFO] process - pre-processing - resize ")
-    resize_img = cv2.resize(img,(inputWidth,inputHeight))
-    #print("[INFO] process - pre-processing - convert to float ")
-    input_image = resize_img.astype(np.float)
-    #print("[INFO] process - pre-processing - normalize (-128.0) ")
-    input_image = input_image - 128.0
-    #print("[INFO] process - pre-processing - scale (*0.0078125) ")
-    input_image = input_image * 0.0078125
-
-    """ Prepare input/output buffers """
-    #print("[INFO] process - prep input buffer ")
-    inputData = []
-    inputData.append(np.empty((inputShape),dtype=np.float32,order='C'))
-    inputImage = inputData[0]
-    inputImage[0,...] = input_image
-
-    #print("[INFO] process - prep output buffer ")
-    outputData = []
-    outputData.append(np.empty((outputShape),dtype=np.float32,order='C'))
-
-    """ Execute model on DPU """
-    #print("[INFO] process - execute ")
-    job_id = dpu.execute_async( inputData, outputData )
-    dpu.wait(job_id)
-
-    """ Retrieve output results """    
-    #print("[INFO] process - get output ")
-    OutputData = outputData[0].reshape(1,outputSize)
-    #print(OutputData)
-    landmark = np.reshape(OutputData,(5,2),order='F')
-    #print(landmark)
-
-    return landmark
+    cropStack = self.cropStack
+
+    imgHeight = frame.shape[0]
+    imgWidth  = frame.shape[1]
+
+    """ Face boxes (clipped to the frame) """
+    boxes = np.asarray(boxes,dtype=np.float32).reshape(-1,4)
+    nFaces = len(boxes)
+    x1 = np.clip(boxes[:,0],0,imgWidth).astype(np.int32)
+    y1 = np.clip(boxes[:,1],0,imgHeight).astype(np.int32)
+    x2 = np.clip(boxes[:,2],0,imgWidth).astype(np.int32)
+    y2 = np.clip(boxes[:,3],0,imgHeight).astype(np.int32)
+    valid = (x2 > x1) & (y2 > y1)
+
+    def preprocess(inputs,chunk):
+      """ Image pre-processing : crop + resize, normalize (-128.0) and scale (*0.0078125) """
+      count = len(chunk)
+      for j,i in enumerate(chunk):
+        if valid[i]:
+          cv2.resize(frame[y1[i]:y2[i],x1[i]:x2[i]],(inputWidth,inputHeight),dst=cropStack[j])
+        else:
+          cropStack[j] = 128
+      np.subtract(cropStack[:count],128.0,out=inputs[0][:count])
+      inputs[0][:count] *= 0.0078125
+
+    # faces are chunked to the xmodel's batch size (see ModelEngine.run)
+    results = self.engine.run(np.arange(nFaces),preprocess,self.postprocess)
+    if len(results) == 0:
+      return np.empty((0,5,2),dtype=np.float32)
+    landmarks = np.concatenate(results,axis=0)
+
+    """ Landmarks to image coordinates """
+    landmarks[:,:,0] = x1[:,None] + landmarks[:,:,0] * (x2-x1)[:,None]
+    landmarks[:,:,1] = y1[:,None] + landmarks[:,:,1] * (y2-y1)[:,None]
+    landmarks[~valid] = np.nan
+
+    return landmarks
 
   def stop(self):
     #"""Destroy Runner"""
+    self.engine.stop()
     del self.dpu
 	
     self.dpu = []
     self.inputTensors = []
     self.outputTensors = []
-    self.tensorFormat = []
-    self.input0Channels = []
+    self.batchSize = []
+    self.inputChannels = []
     self.inputHeight = []
     self.inputWidth = []
     self.inputShape = []
     self.outputSize = []
     self.outputShape = []
+    self.cropStack = []
 
 
@@ -0,0 +1,107 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import cv2
+import numpy as np
+
+from calibration_store import load_stereo_coefficients
+
+
+class FaceRanging():
+  '''
+  Calibrated ranging of a few image points (face centres, landmarks).
+
+  Instead of rectifying full frames (two remaps per frame), only the points of
+  interest are undistorted and rectified (cv2.undistortPoints with R1/P1 and
+  R2/P2, one call per eye), then triangulated with P1/P2.
+  '''
+
+  def __init__(self, calibration_file, width=1280, height=800, calibWidth=1280, calibHeight=800, unitScale=10.0):
+    """
+    # Arguments
+        calibration_file: str, stereo calibration (ex: stereo_data/calib/dualcam_stereo.yml)
+        width, height: int, resolution of the images the points come from
+        calibWidth, calibHeight: int, resolution of the calibration images
+        unitScale: float, scale from calibration units to mm (calibration is done in cm)
+    """
+    K1, D1, K2, D2, R, T, E, F, R1, R2, P1, P2, Q = load_stereo_coefficients(calibration_file)
+    self.K1 = K1
+    self.D1 = D1
+    self.K2 = K2
+    self.D2 = D2
+    self.R1 = R1
+    self.R2 = R2
+    self.P1 = P1
+    self.P2 = P2
+    self.unitScale = unitScale
+
+    # the capture pipeline scales the full 1280x800 active array to width x height
+    self.pointScale = np.array([calibWidth/width, calibHeight/height], dtype=np.float64)
+
+  def rectify(self, left_points, right_points):
+    """
+    Undistort and rectify left and right points.
+
+    # Arguments
+        left_points, right_points: ndarray, (N,2) points in image coordinates
+
+    # Returns
+        left_rect, right_rect: ndarray, (N,2) rectified points (calibration resolution)
+    """
+    left_points = np.asarray(left_points, dtype=np.float64).reshape(-1,1,2) * self.pointScale
+    right_points = np.asarray(right_points, dtype=np.float64).reshape(-1,1,2) * self.pointScale
+    if len(left_points) == 0:
+      return left_points.reshape(-1,2), right_points.reshape(-1,2)
+
+    left_rect = cv2.undistortPoints(left_points, self.K1, self.D1, R=self.R1, P=self.P1)
+    right_rect = cv2.undistortPoints(right_points, self.K2, self.D2, R=self.R2, P=self.P2)
+    return left_rect.reshape(-1,2), right_rect.reshape(-1,2)
+
+  def triangulate(self, left_points, right_points):
+    """
+    3D position of matched left/right points.
+
+    # Returns
+        xyz: ndarray, (N,3) positions in the rectified left camera frame (mm)
+        disparity: ndarray, (N,) rectified disparities (calibration pixels)
+    """
+    left_rect, right_rect = self.rectify(left_points, right_points)
+    if len(left_rect) == 0:
+      return np.zeros((0,3)), np.zeros(0)
+
+    xyzw = cv2.triangulatePoints(self.P1, self.P2, left_rect.T, right_rect.T)
+    xyz = (xyzw[:3] / xyzw[3]).T * self.unitScale
+    disparity = left_rect[:,0] - right_rect[:,0]
+    return xyz, disparity
+
+  def range_pairs(self, left_points, right_points, pairs):
+    """
+    Range paired faces (see facestereo.match_faces).
+
+    # Arguments
+        left_points, right_points: ndarray, (N,2)/(M,2) reference point of each face
+        pairs: ndarray, (K,2) indices of the matched left/right faces
+
+    # Returns
+        disparity: ndarray, (K,) rectified disparities (calibration pixels)
+        distance: ndarray, (K,) depth of each pair (mm)
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1,2)
+    left_points = np.asarray(left_points).reshape(-1,2)[pairs[:,0]]
+    right_points = np.asarray(right_points).reshape(-1,2)[pairs[:,1]]
+    xyz, disparity = self.triangulate(left_points, right_points)
+    return disparity, xyz[:,2]
@@ -0,0 +1,242 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import cv2
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+# cost of the pairs rejected by the epipolar/disparity constraints
+REJECT_COST = 1e6
+
+
+def hungarian(cost):
+    """
+    Minimum cost assignment (Kuhn-Munkres with potentials, O(n^2.m)),
+    used when scipy is not available.
+
+    # Arguments
+        cost: ndarray, (N,M) cost matrix
+
+    # Returns
+        rows, cols: ndarray, indices of the assigned pairs
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    # 1-based arrays, column 0 is a virtual column
+    u = np.zeros(n+1)
+    v = np.zeros(m+1)
+    p = np.zeros(m+1, dtype=np.int64)
+    way = np.zeros(m+1, dtype=np.int64)
+    for i in range(1, n+1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m+1, np.inf)
+        used = np.zeros(m+1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            cur = cost[i0-1] - u[i0] - v[1:]
+            upd = free & (cur < minv[1:])
+            minv[1:][upd] = cur[upd]
+            way[1:][upd] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1-1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0 != 0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+    if transposed:
+        rows, cols = cols, rows
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+    return rows, cols
+
+
+def linear_assignment(cost):
+    """ Optimal assignment, with scipy if available """
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    return hungarian(cost)
+
+
+def face_thumbnails(gray, faces, size=16):
+    """ Zero-mean, unit-norm thumbnails of all faces, as an (N,size*size) matrix """
+    thumbs = np.zeros((len(faces), size*size), dtype=np.float32)
+    imgHeight, imgWidth = gray.shape[:2]
+    for i,(x1,y1,x2,y2) in enumerate(faces):
+        x1 = int(max(x1, 0))
+        y1 = int(max(y1, 0))
+        x2 = int(min(x2, imgWidth))
+        y2 = int(min(y2, imgHeight))
+        if x2 > x1 and y2 > y1:
+            thumbs[i] = cv2.resize(gray[y1:y2,x1:x2], (size,size), interpolation=cv2.INTER_AREA).ravel()
+    thumbs -= thumbs.mean(axis=1, keepdims=True)
+    thumbs /= np.maximum(np.linalg.norm(thumbs, axis=1, keepdims=True), 1e-6)
+    return thumbs
+
+
+def match_faces(left_faces, right_faces, left_gray=None, right_gray=None,
+                left_points=None, right_points=None,
+                maxDy=0.25, minDisparity=0.0, maxDisparity=None,
+                sizeWeight=1.0, appearanceWeight=1.0,
+                baseline=50.0, focal=827.0, dispScale=1.0):
+    """
+    Associate left and right faces and range each pair.
+
+    The cost of each left/right pair is the vertical offset of the box centres
+    (epipolar constraint, relative to the face height), plus the log ratio of
+    the face heights, plus (when the grayscale images are given) one minus the
+    normalized correlation of the face thumbnails. Pairs with a vertical offset
+    above maxDy, or with a disparity outside [minDisparity,maxDisparity], are
+    rejected. The assignment is optimal (Hungarian algorithm).
+
+    # Arguments
+        left_faces, right_faces: ndarray, (N,4) and (M,4) boxes
+        left_points, right_points: ndarray, optional (N,2)/(M,2) points used for
+            the disparity instead of the box centres (ex: a landmark)
+        baseline: float, stereo baseline (mm)
+        focal: float, focal length (pixels of the active array)
+        dispScale: float, scale from image to active array pixels (ex: 1280/width)
+
+    # Returns
+        pairs: ndarray, (K,2) indices of the matched left/right faces
+        disparity: ndarray, (K,) disparities (active array pixels)
+        distance: ndarray, (K,) distances (mm)
+    """
+    left_faces = np.asarray(left_faces, dtype=np.float32).reshape(-1,4)
+    right_faces = np.asarray(right_faces, dtype=np.float32).reshape(-1,4)
+    if len(left_faces) == 0 or len(right_faces) == 0:
+        return np.zeros((0,2), dtype=np.int64), np.zeros(0), np.zeros(0)
+
+    left_c = (left_faces[:,0:2] + left_faces[:,2:4]) / 2
+    right_c = (right_faces[:,0:2] + right_faces[:,2:4]) / 2
+    if left_points is None:
+        left_points = left_c
+    if right_points is None:
+        right_points = right_c
+    left_points = np.asarray(left_points, dtype=np.float32).reshape(-1,2)
+    right_points = np.asarray(right_points, dtype=np.float32).reshape(-1,2)
+
+    left_h = np.maximum(left_faces[:,3] - left_faces[:,1], 1.0)
+    right_h = np.maximum(right_faces[:,3] - right_faces[:,1], 1.0)
+    mean_h = (left_h[:,None] + right_h[None,:]) / 2
+
+    dy = np.abs(left_c[:,None,1] - right_c[None,:,1]) / mean_h
+    disparity = (left_points[:,None,0] - right_points[None,:,0]) * dispScale
+    cost = dy + sizeWeight * np.abs(np.log(left_h[:,None] / right_h[None,:]))
+    if left_gray is not None and right_gray is not None:
+        similarity = face_thumbnails(left_gray, left_faces) @ face_thumbnails(right_gray, right_faces).T
+        cost = cost + appearanceWeight * (1.0 - similarity)
+
+    rejected = (dy > maxDy) | (disparity <= minDisparity)
+    if maxDisparity is not None:
+        rejected |= disparity > maxDisparity
+    cost = np.where(rejected, REJECT_COST, cost)
+
+    rows, cols = linear_assignment(cost)
+    keep = cost[rows, cols] < REJECT_COST
+    pairs = np.stack([rows[keep], cols[keep]], axis=1).astype(np.int64)
+
+    disparity = disparity[pairs[:,0], pairs[:,1]]
+    distance = (baseline * focal) / disparity
+
+    return pairs, disparity, distance
+
+
+def epipolar_search(left_gray, right_gray, left_faces, minDisparity=1.0, maxDisparity=160.0,
+                    band=4, margin=0.15, minScore=0.5):
+    """
+    Locate the left faces in the right image by normalized cross-correlation
+    along their epipolar row band, so the detector only needs to run on the left eye.
+
+    The images must be row-aligned (rectified, or mechanically aligned as on the
+    dual camera mezzanine) : band is the residual vertical offset searched (pixels).
+
+    # Arguments
+        left_faces: ndarray, (N,4) boxes detected in the left image
+        minDisparity, maxDisparity: float, disparity range searched (image pixels)
+        margin: float, fraction of the box trimmed on each side of the template (background)
+        minScore: float, correlation below which no match is reported
+
+    # Returns
+        right_faces: ndarray, (N,4) boxes in the right image
+        disparity: ndarray, (N,) sub-pixel disparities (image pixels), NaN when not found
+        score: ndarray, (N,) correlation scores
+    """
+    left_faces = np.asarray(left_faces, dtype=np.float32).reshape(-1,4)
+    imgHeight, imgWidth = right_gray.shape[:2]
+
+    right_faces = left_faces.copy()
+    disparity = np.full(len(left_faces), np.nan)
+    score = np.zeros(len(left_faces))
+    for i,(x1,y1,x2,y2) in enumerate(left_faces):
+        mx = (x2 - x1) * margin
+        my = (y2 - y1) * margin
+        tx1, ty1, tx2, ty2 = int(x1+mx), int(y1+my), int(x2-mx), int(y2-my)
+        if tx2 - tx1 < 8 or ty2 - ty1 < 8 or tx1 < 0 or ty1 < 0 or tx2 > imgWidth or ty2 > imgHeight:
+            continue
+        template = left_gray[ty1:ty2, tx1:tx2]
+
+        # strip of the right image covering the disparity range and the row band
+        sx1 = max(tx1 - int(np.ceil(maxDisparity)), 0)
+        sx2 = min(tx2 - int(minDisparity), imgWidth)
+        sy1 = max(ty1 - band, 0)
+        sy2 = min(ty2 + band, imgHeight)
+        if sx2 - sx1 < tx2 - tx1 or sy2 - sy1 < ty2 - ty1:
+            continue
+        result = cv2.matchTemplate(right_gray[sy1:sy2, sx1:sx2], template, cv2.TM_CCOEFF_NORMED)
+        _, best, _, (px, py) = cv2.minMaxLoc(result)
+        if best < minScore:
+            continue
+
+        # sub-pixel peak : parabola through the horizontal neighbours
+        offset = 0.0
+        if 0 < px < result.shape[1]-1:
+            l, c, r = result[py, px-1], result[py, px], result[py, px+1]
+            denom = l - 2*c + r
+            if denom < 0:
+                offset = 0.5 * (l - r) / denom
+
+        disparity[i] = tx1 - (sx1 + px + offset)
+        score[i] = best
+        dy = (sy1 + py) - ty1
+        right_faces[i] = ( max(x1 - disparity[i], 0), max(y1 + dy, 0),
+                           min(x2 - disparity[i], imgWidth), min(y2 + dy, imgHeight) )
+
+    return right_faces, disparity, score
@@ -0,0 +1,228 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import cv2
+import numpy as np
+
+
+def iou_matrix(boxes1, boxes2):
+    """
+    Intersection over union of all pairs of boxes.
+
+    # Arguments
+        boxes1: ndarray, (N,4) boxes (xmin,ymin,xmax,ymax)
+        boxes2: ndarray, (M,4) boxes (xmin,ymin,xmax,ymax)
+
+    # Returns
+        iou: ndarray, (N,M) matrix
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32).reshape(-1,4)
+    boxes2 = np.asarray(boxes2, dtype=np.float32).reshape(-1,4)
+
+    xx1 = np.maximum(boxes1[:,None,0], boxes2[None,:,0])
+    yy1 = np.maximum(boxes1[:,None,1], boxes2[None,:,1])
+    xx2 = np.minimum(boxes1[:,None,2], boxes2[None,:,2])
+    yy2 = np.minimum(boxes1[:,None,3], boxes2[None,:,3])
+    inter = np.maximum(0.0, xx2 - xx1) * np.maximum(0.0, yy2 - yy1)
+
+    areas1 = (boxes1[:,2]-boxes1[:,0]) * (boxes1[:,3]-boxes1[:,1])
+    areas2 = (boxes2[:,2]-boxes2[:,0]) * (boxes2[:,3]-boxes2[:,1])
+    union = areas1[:,None] + areas2[None,:] - inter
+
+    return inter / np.maximum(union, 1e-6)
+
+
+class FaceTrack():
+  '''
+  Per-track state : stable id, current box, flow points and bookkeeping.
+  '''
+  __slots__ = ('id','box','points','age','misses','confidence')
+
+  def __init__(self, track_id, box):
+    self.id = track_id
+    self.box = np.array(box[:4], dtype=np.float32)
+    self.points = None
+    self.age = 0
+    self.misses = 0
+    self.confidence = 1.0
+
+
+class FaceTracker():
+  '''
+  Detect-then-track : the face detector only runs every detectInterval frames
+  (or as soon as a track loses confidence), and boxes are propagated in between
+  with sparse pyramidal Lucas-Kanade optical flow on a few points per box.
+  '''
+
+  def __init__(self, detectInterval=5, minConfidence=0.5, iouThreshold=0.3, maxMisses=2, maxPoints=9):
+
+    self.detectInterval = detectInterval
+    self.minConfidence = minConfidence
+    self.iouThreshold = iouThreshold
+    self.maxMisses = maxMisses
+    self.maxPoints = maxPoints
+
+    self.lkParams = dict( winSize=(15,15), maxLevel=2,
+                          criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03) )
+
+    self.tracks = []
+    self.nextId = 0
+    self.frameCount = 0
+    self.prevGray = None
+
+  def needs_detection(self):
+    """ True if the detector must run on the next frame passed to update() """
+    if self.prevGray is None or self.frameCount % self.detectInterval == 0:
+      return True
+    for track in self.tracks:
+      if track.confidence < self.minConfidence:
+        return True
+    return False
+
+  def reset_flow(self):
+    """ Forget the previous frame (ex: the tracker was not updated for a while) : the next frame needs a detection """
+    self.prevGray = None
+    for track in self.tracks:
+      track.points = None
+
+  def update(self, gray, faces=None):
+    """
+    Advance the tracker by one frame.
+
+    # Arguments
+        gray: ndarray, grayscale frame
+        faces: ndarray, detector boxes for this frame, or None to propagate the tracks by optical flow
+
+    # Returns
+        boxes: ndarray, (N,4) boxes of the current tracks (same layout as FaceDetect.process)
+    """
+    if faces is not None:
+      self.associate(faces)
+    elif self.prevGray is not None:
+      self.propagate(gray)
+
+    self.tracks = [track for track in self.tracks if track.misses <= self.maxMisses]
+    self.prevGray = gray
+    self.frameCount += 1
+
+    # flow points are only needed if the next frame is propagated (never with detectInterval=1)
+    propagate = not self.needs_detection()
+    for track in self.tracks:
+      track.age += 1
+      track.points = self.select_points(gray, track.box) if propagate else None
+
+    return self.boxes()
+
+  def boxes(self):
+    if len(self.tracks) == 0:
+      return np.zeros((0,4), dtype=np.float32)
+    return np.array([track.box for track in self.tracks], dtype=np.float32)
+
+  def ids(self):
+    return [track.id for track in self.tracks]
+
+  def associate(self, faces):
+    """ Match detections to tracks (greedy on IoU), keeping the ids of matched tracks """
+    faces = np.asarray(faces, dtype=np.float32).reshape(-1,4)
+
+    matched_tracks = set()
+    matched_faces = set()
+    if len(self.tracks) > 0 and len(faces) > 0:
+      iou = iou_matrix(self.boxes(), faces)
+      for flat in np.argsort(-iou, axis=None):
+        t, f = np.unravel_index(flat, iou.shape)
+        if iou[t,f] < self.iouThreshold:
+          break
+        if t in matched_tracks or f in matched_faces:
+          continue
+        track = self.tracks[t]
+        track.box[:] = faces[f]
+        track.misses = 0
+        track.confidence = 1.0
+        matched_tracks.add(t)
+        matched_faces.add(f)
+
+    for t,track in enumerate(self.tracks):
+      if t not in matched_tracks:
+        track.misses += 1
+        track.confidence = 0.0
+
+    for f,face in enumerate(faces):
+      if f not in matched_faces:
+        self.tracks.append(FaceTrack(self.nextId, face))
+        self.nextId += 1
+
+  def propagate(self, gray):
+    """ Move all boxes with a single forward-backward optical flow call """
+    tracks = [track for track in self.tracks if track.points is not None and len(track.points) > 0]
+    if len(tracks) == 0:
+      return
+
+    counts = [len(track.points) for track in tracks]
+    p0 = np.concatenate([track.points for track in tracks]).reshape(-1,1,2)
+    p1, st1, _ = cv2.calcOpticalFlowPyrLK(self.prevGray, gray, p0, None, **self.lkParams)
+    p0r, st0, _ = cv2.calcOpticalFlowPyrLK(gray, self.prevGray, p1, None, **self.lkParams)
+    fb_error = np.linalg.norm((p0 - p0r).reshape(-1,2), axis=1)
+    good = (st1.ravel() == 1) & (st0.ravel() == 1) & (fb_error < 1.0)
+
+    imgHeight, imgWidth = gray.shape[:2]
+    p0 = p0.reshape(-1,2)
+    p1 = p1.reshape(-1,2)
+    first = 0
+    for track,count in zip(tracks,counts):
+      sl = slice(first, first+count)
+      first += count
+      old = p0[sl][good[sl]]
+      new = p1[sl][good[sl]]
+      track.confidence = len(old) / count
+      if len(old) < 2:
+        track.misses += 1
+        continue
+
+      # translation = median displacement, scale = median ratio of point distances
+      dx, dy = np.median(new - old, axis=0)
+      d_old = np.linalg.norm(old[:,None,:] - old[None,:,:], axis=2)
+      d_new = np.linalg.norm(new[:,None,:] - new[None,:,:], axis=2)
+      valid = d_old > 1.0
+      scale = np.median(d_new[valid] / d_old[valid]) if np.any(valid) else 1.0
+
+      cx = (track.box[0] + track.box[2]) / 2 + dx
+      cy = (track.box[1] + track.box[3]) / 2 + dy
+      hw = (track.box[2] - track.box[0]) / 2 * scale
+      hh = (track.box[3] - track.box[1]) / 2 * scale
+      track.box[:] = ( max(cx-hw,0), max(cy-hh,0), min(cx+hw,imgWidth), min(cy+hh,imgHeight) )
+      if track.box[2] - track.box[0] < 2 or track.box[3] - track.box[1] < 2:
+        track.misses = self.maxMisses + 1
+
+  def select_points(self, gray, box):
+    """ A few corners inside the central part of the box (regular grid as fallback) """
+    imgHeight, imgWidth = gray.shape[:2]
+    x1, y1, x2, y2 = box
+    mx = (x2 - x1) * 0.2
+    my = (y2 - y1) * 0.2
+    x1 = int(max(x1 + mx, 0))
+    y1 = int(max(y1 + my, 0))
+    x2 = int(min(x2 - mx, imgWidth))
+    y2 = int(min(y2 - my, imgHeight))
+    if x2 - x1 < 4 or y2 - y1 < 4:
+      return None
+
+    corners = cv2.goodFeaturesToTrack(gray[y1:y2,x1:x2], self.maxPoints, 0.01, 3)
+    if corners is None or len(corners) < 3:
+      gx, gy = np.meshgrid(np.linspace(x1, x2-1, 3), np.linspace(y1, y2-1, 3))
+      return np.stack([gx.ravel(), gy.ravel()], axis=1).astype(np.float32)
+    return corners.reshape(-1,2) + np.array([x1,y1], dtype=np.float32)
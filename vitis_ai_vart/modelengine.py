@@ -0,0 +1,229 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import queue
+import time
+import numpy as np
+
+from vitis_ai_vart.utils import get_child_subgraph_dpu
+
+
+def load_graph(xmodel):
+    """
+    Deserialize an xmodel.
+
+    # Arguments
+        xmodel: str, path of the .xmodel file
+
+    # Returns
+        graph: xir.Graph (keep a reference while the subgraph is in use)
+        subgraph: xir.Subgraph, its (single) DPU subgraph
+    """
+    # imported here so the engine can also run off-board runners (see simrunner)
+    import xir
+    graph = xir.Graph.deserialize(xmodel)
+    subgraphs = get_child_subgraph_dpu(graph)
+    assert len(subgraphs) == 1 # only one DPU kernel
+    return graph, subgraphs[0]
+
+
+def load_subgraph(xmodel):
+    """ Deserialize an xmodel and return its (single) DPU subgraph """
+    return load_graph(xmodel)[1]
+
+
+class TensorInfo():
+  '''
+  Introspected input/output tensor : name, dims (batch first) and fix point scale.
+  '''
+
+  def __init__(self, tensor):
+    self.tensor = tensor
+    self.name = tensor.name
+    self.shape = tuple(tensor.dims)
+    self.dims = self.shape[1:]
+    self.size = int(np.prod(self.dims))
+    self.fixPoint = tensor.get_attr("fix_point") if tensor.has_attr("fix_point") else 0
+    # float value = fixed point value * scale
+    self.scale = 2.0 ** -self.fixPoint
+
+  def __repr__(self):
+    return "TensorInfo(name={}, shape={}, fix_point={})".format(self.name,self.shape,self.fixPoint)
+
+
+class BufferSet():
+  '''
+  One set of input/output buffers for a job. With fixed point (int8) buffers,
+  pre-processors still write floats into the "inputs" staging arrays and
+  post-processors read floats from the "outputs" arrays : conversion happens
+  in quantize/dequantize. With float32 buffers, they are the runner buffers.
+  '''
+
+  def __init__(self, inputInfos, outputInfos, dtype):
+    self.inputData = [ np.empty(info.shape,dtype=dtype,order='C') for info in inputInfos ]
+    self.outputData = [ np.empty(info.shape,dtype=dtype,order='C') for info in outputInfos ]
+    self.fixed = np.dtype(dtype) != np.float32
+    if self.fixed:
+      self.inputs = [ np.empty(info.shape,dtype=np.float32,order='C') for info in inputInfos ]
+      self.outputs = [ np.empty(info.shape,dtype=np.float32,order='C') for info in outputInfos ]
+      self.inputScales = [ 1.0/info.scale for info in inputInfos ]
+      self.outputScales = [ info.scale for info in outputInfos ]
+    else:
+      self.inputs = self.inputData
+      self.outputs = self.outputData
+
+  def quantize(self):
+    if self.fixed:
+      for src,dst,scale in zip(self.inputs,self.inputData,self.inputScales):
+        info = np.iinfo(dst.dtype)
+        np.clip(np.rint(src*scale),info.min,info.max,out=src)
+        dst[...] = src
+
+  def dequantize(self):
+    if self.fixed:
+      for src,dst,scale in zip(self.outputData,self.outputs,self.outputScales):
+        np.multiply(src,scale,out=dst)
+
+
+class ModelEngine():
+  '''
+  Shared execution engine of the model wrappers (FaceDetect, FaceLandmark,
+  FaceFeature) : tensor introspection, pooled job buffers, sync/async/batch
+  execution and timing.
+
+  run() chunks the items to the xmodel's batch size, and pre-processes chunk
+  k+1 while the DPU executes chunk k (numBuffers >= 2).
+  '''
+
+  def __init__(self, dpu, dtype=np.float32, numBuffers=2):
+
+    self.dpu = dpu
+    self.dtype = dtype
+    self.numBuffers = numBuffers
+
+    self.inputs = []
+    self.outputs = []
+    self.batchSize = []
+    self.buffers = None
+    self.timing = {}
+
+  def start(self):
+
+    dpu = self.dpu
+    self.inputs = [ TensorInfo(tensor) for tensor in dpu.get_input_tensors() ]
+    self.outputs = [ TensorInfo(tensor) for tensor in dpu.get_output_tensors() ]
+    self.batchSize = self.inputs[0].shape[0]
+
+    self.buffers = queue.Queue()
+    for i in range(self.numBuffers):
+      self.buffers.put(BufferSet(self.inputs,self.outputs,self.dtype))
+
+    self.reset_timing()
+
+  def reset_timing(self):
+    self.timing = { 'jobs' : 0, 'items' : 0, 'preprocess' : 0.0, 'execute' : 0.0, 'postprocess' : 0.0 }
+
+  def acquire(self):
+    """ Take a free buffer set (blocks until one is released) """
+    return self.buffers.get()
+
+  def release(self, buffers):
+    self.buffers.put(buffers)
+
+  def execute_async(self, buffers):
+    """ Start a job on a filled buffer set, returns a handle for wait() """
+    buffers.quantize()
+    job_id = self.dpu.execute_async( buffers.inputData, buffers.outputData )
+    return (job_id, time.perf_counter())
+
+  def wait(self, job, buffers):
+    job_id, start = job
+    self.dpu.wait(job_id)
+    buffers.dequantize()
+    self.timing['execute'] += time.perf_counter() - start
+    self.timing['jobs'] += 1
+
+  def execute(self, buffers):
+    """ Run a job synchronously on a filled buffer set """
+    self.wait(self.execute_async(buffers),buffers)
+
+  def run(self, items, preprocess, postprocess):
+    """
+    Batched execution of a list of items.
+
+    # Arguments
+        items: list (or array) of items to process
+        preprocess: function(inputs, chunk), fills inputs[k][:len(chunk)] (float arrays)
+        postprocess: function(outputs, chunk, first), returns the results of a chunk
+
+    # Returns
+        results: list of the postprocess results, one per chunk
+    """
+    batchSize = self.batchSize
+    timing = self.timing
+
+    results = []
+    pending = None
+    for first in range(0,len(items),batchSize):
+      chunk = items[first:first+batchSize]
+
+      start = time.perf_counter()
+      buffers = self.acquire()
+      preprocess(buffers.inputs,chunk)
+      # unused slots are padded
+      for inputArray in buffers.inputs:
+        inputArray[len(chunk):,...] = 0.0
+      timing['preprocess'] += time.perf_counter() - start
+      timing['items'] += len(chunk)
+
+      job = self.execute_async(buffers)
+      if pending is not None:
+        results.append(self.complete(pending,postprocess))
+      pending = (buffers,job,chunk,first)
+
+    if pending is not None:
+      results.append(self.complete(pending,postprocess))
+    return results
+
+  def complete(self, pending, postprocess):
+    buffers, job, chunk, first = pending
+    try:
+      self.wait(job,buffers)
+      start = time.perf_counter()
+      result = postprocess(buffers.outputs,chunk,first)
+      self.timing['postprocess'] += time.perf_counter() - start
+    finally:
+      self.release(buffers)
+    return result
+
+  def timing_report(self):
+    """ Mean pre-processing, execution and post-processing times per job (ms) """
+    jobs = max(self.timing['jobs'],1)
+    return { 'jobs' : self.timing['jobs'],
+             'items' : self.timing['items'],
+             'preprocess_ms' : 1000.0 * self.timing['preprocess'] / jobs,
+             'execute_ms' : 1000.0 * self.timing['execute'] / jobs,
+             'postprocess_ms' : 1000.0 * self.timing['postprocess'] / jobs }
+
+  def stop(self):
+    del self.dpu
+
+    self.dpu = []
+    self.inputs = []
+    self.outputs = []
+    self.batchSize = []
+    self.buffers = None
@@ -0,0 +1,203 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vitis_ai_vart.modelengine import load_graph
+from vitis_ai_vart.runnerpool import RunnerPool, create_runners
+from vitis_ai_vart.runnerstats import RunnerStats, InstrumentedRunner
+
+
+# searched in order, after the paths of the VITIS_AI_MODEL_PATH environment variable
+DEFAULT_SEARCH_PATHS = [ "./models", "/usr/share/vitis_ai_library/models" ]
+
+# model methods whose first call is reported as the first inference
+INFERENCE_METHODS = ( 'process', 'process_batch', 'process_batch_scores', 'process_crops', 'process_aligned' )
+
+
+def format_stats(stats):
+    return ", ".join( "{} = {}".format(key, value if isinstance(value,str) else "{:.1f}".format(value))
+                      for key,value in stats.items() )
+
+
+class LazyModel():
+  '''
+  Handle on a model being loaded in the background (see ModelRegistry.load).
+  Attribute accesses are forwarded to the model's RunnerPool, and block until
+  it is ready. The first inference call is timed.
+  '''
+
+  def __init__(self, registry, name, future):
+    self._registry = registry
+    self._name = name
+    self._future = future
+    self._pool = None
+    self._inferred = False
+
+  def wait(self):
+    """ Block until the model is loaded, returns its RunnerPool """
+    if self._pool is None:
+      start = time.perf_counter()
+      self._pool = self._future.result()
+      self._registry.record(self._name, wait_ms=1000.0*(time.perf_counter()-start))
+    return self._pool
+
+  def __getattr__(self, attr):
+    value = getattr(self.wait(), attr)
+    if attr in INFERENCE_METHODS and not self._inferred:
+      return self._first_inference(value)
+    return value
+
+  def _first_inference(self, method):
+    def timed(*args, **kwargs):
+      start = time.perf_counter()
+      result = method(*args, **kwargs)
+      if not self._inferred:
+        self._inferred = True
+        self._registry.record(self._name, first_inference_ms=1000.0*(time.perf_counter()-start))
+      return result
+    return timed
+
+
+class ModelRegistry():
+  '''
+  Resolves models by name from search paths, and loads them in background
+  threads (xmodel deserialization, runner creation, wrapper start), so that
+  loading overlaps the rest of the initialization (ex: DualCam). Deserialized
+  graphs are cached per xmodel file. Load, wait and first inference
+  latencies are reported per model. With instrument=True, the runners are
+  wrapped to collect job statistics (see runner_stats).
+  '''
+
+  def __init__(self, searchPaths=None, verbose=True, instrument=False):
+
+    paths = []
+    if os.environ.get("VITIS_AI_MODEL_PATH"):
+      paths += os.environ["VITIS_AI_MODEL_PATH"].split(os.pathsep)
+    paths += searchPaths if searchPaths is not None else DEFAULT_SEARCH_PATHS
+    self.searchPaths = paths
+    self.verbose = verbose
+    self.instrument = instrument
+
+    self.lock = threading.Lock()
+    self.graphs = {}
+    self.graphLocks = {}
+    self.models = {}
+    self.stats = {}
+    self.runnerStats = {}
+    self.executor = ThreadPoolExecutor(max_workers=4)
+
+  def resolve(self, name):
+    """
+    Path of a model's xmodel : name can be a path, or a model name
+    searched as <path>/<name>/<name>.xmodel or <path>/<name>.xmodel
+    """
+    if name.endswith(".xmodel"):
+      if os.path.isfile(name):
+        return name
+      name = os.path.splitext(os.path.basename(name))[0]
+    for path in self.searchPaths:
+      for candidate in ( os.path.join(path,name,name+".xmodel"), os.path.join(path,name+".xmodel") ):
+        if os.path.isfile(candidate):
+          return candidate
+    raise FileNotFoundError("model {} not found in {}".format(name,self.searchPaths))
+
+  def subgraph(self, xmodel):
+    """ DPU subgraph of an xmodel, deserialized once """
+    with self.lock:
+      graphLock = self.graphLocks.setdefault(xmodel,threading.Lock())
+    with graphLock:
+      if xmodel not in self.graphs:
+        self.graphs[xmodel] = load_graph(xmodel)
+      return self.graphs[xmodel][1]
+
+  def record(self, name, **values):
+    with self.lock:
+      self.stats.setdefault(name,{}).update(values)
+    if self.verbose:
+      print("[INFO] model {} : {}".format(name,format_stats(values)))
+
+  def _load(self, name, modelClass, numRunners, args, kwargs):
+    start = time.perf_counter()
+    xmodel = self.resolve(name)
+    subgraph = self.subgraph(xmodel)
+    loaded = time.perf_counter()
+    runners = create_runners(subgraph,numRunners)
+    if self.instrument:
+      stats = RunnerStats(name)
+      runners = [ InstrumentedRunner(dpu,stats) for dpu in runners ]
+      self.runnerStats[name] = stats
+    created = time.perf_counter()
+    pool = RunnerPool(runners,modelClass,*args,**kwargs)
+    done = time.perf_counter()
+    self.record(name, xmodel=xmodel,
+                      deserialize_ms=1000.0*(loaded-start),
+                      runners_ms=1000.0*(created-loaded),
+                      start_ms=1000.0*(done-created))
+    return pool
+
+  def load(self, name, modelClass, *args, numRunners=1, **kwargs):
+    """
+    Start loading a model in the background.
+
+    # Arguments
+        name: str, model name (ex: densebox_640_360) or xmodel path
+        modelClass: wrapper class (FaceDetect, FaceLandmark, FaceFeature)
+        args, kwargs: extra wrapper arguments
+        numRunners: int, runners in the model's RunnerPool
+
+    # Returns
+        model: LazyModel, usable as the RunnerPool (blocks on first use until loaded)
+    """
+    future = self.executor.submit(self._load,name,modelClass,numRunners,args,kwargs)
+    model = LazyModel(self,name,future)
+    self.models[name] = model
+    return model
+
+  def report(self):
+    """ Per-model latencies (ms) : deserialize, runners, start, wait (blocked at first use), first inference """
+    with self.lock:
+      return { name : dict(values) for name,values in self.stats.items() }
+
+  def runner_stats(self):
+    """
+    Rolling job statistics of the loaded models (see RunnerStats.snapshot),
+    with the mean host pre/post-processing time per job (see ModelEngine.timing_report)
+    """
+    report = {}
+    for name,stats in list(self.runnerStats.items()):
+      snapshot = stats.snapshot()
+      timings = [ model.engine.timing_report() for model in self.models[name].wait().models ]
+      jobs = max(sum(t['jobs'] for t in timings),1)
+      snapshot['preprocess_ms'] = sum(t['preprocess_ms']*t['jobs'] for t in timings) / jobs
+      snapshot['postprocess_ms'] = sum(t['postprocess_ms']*t['jobs'] for t in timings) / jobs
+      report[name] = snapshot
+    return report
+
+  def stop(self):
+    """ Stop all the loaded models and release the runners and graphs (a failed load does not stop the others) """
+    self.executor.shutdown(wait=True)
+    for name,model in self.models.items():
+      try:
+        model.wait().stop()
+      except Exception as e:
+        print("[ERROR] model {} : {}".format(name,e))
+    self.models = {}
+    self.graphs = {}
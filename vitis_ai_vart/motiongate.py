@@ -0,0 +1,88 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import cv2
+import numpy as np
+
+
+class MotionGate():
+  '''
+  Cheap motion detector gating the DPU inferences : the luma frame is
+  downscaled to a thumbnail (ex: 80x50) and compared to a running average
+  background. While nothing changes, inference only runs every idleInterval
+  frames (the previous results are carried forward) ; on motion it resumes
+  at full rate immediately, and stays active for holdFrames frames.
+  '''
+
+  def __init__(self, idleInterval=15, width=80, height=50, alpha=0.05, threshold=12.0, minFraction=0.002, holdFrames=10):
+    """
+    # Arguments
+        idleInterval: int, frames between inferences without motion (0 : never)
+        width, height: int, size of the thumbnail compared to the background
+        alpha: float, background update rate
+        threshold: float, luma difference of a changed thumbnail pixel
+        minFraction: float, fraction of changed pixels that is motion
+        holdFrames: int, frames kept active after the last motion
+    """
+    self.idleInterval = idleInterval
+    self.size = (width, height)
+    self.alpha = alpha
+    self.threshold = threshold
+    self.minFraction = minFraction
+    self.holdFrames = holdFrames
+
+    self.background = None
+    self.thumbnail = np.empty((height,width), dtype=np.float32)
+    self.difference = np.empty((height,width), dtype=np.float32)
+    self.fraction = 0.0
+    self.motion = False
+    self.idleFrames = 0
+    self.holdCount = 0
+
+  def update(self, gray):
+    """
+    Feed a grayscale frame.
+
+    # Returns
+        active: bool, True if the inference must run on this frame
+    """
+    self.thumbnail[...] = cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA)
+    if self.background is None:
+      self.background = self.thumbnail.copy()
+      self.idleFrames = 0
+      return True
+
+    cv2.absdiff(self.thumbnail, self.background, dst=self.difference)
+    self.fraction = np.count_nonzero(self.difference > self.threshold) / self.difference.size
+    self.motion = self.fraction > self.minFraction
+    cv2.accumulateWeighted(self.thumbnail, self.background, self.alpha)
+
+    if self.motion:
+      self.holdCount = self.holdFrames
+    elif self.holdCount > 0:
+      self.holdCount -= 1
+
+    if self.motion or self.holdCount > 0:
+      self.idleFrames = 0
+      return True
+
+    # static scene : throttled inference
+    self.idleFrames += 1
+    if self.idleInterval > 0 and self.idleFrames >= self.idleInterval:
+      self.idleFrames = 0
+      return True
+    return False
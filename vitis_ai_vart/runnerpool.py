@@ -0,0 +1,115 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def create_runners(subgraph, numRunners):
+    """
+    Create several DPU runners for the same xmodel subgraph.
+
+    # Arguments
+        subgraph: xir.Subgraph, DPU subgraph (see get_child_subgraph_dpu)
+        numRunners: int, number of runners to create
+
+    # Returns
+        runners: list of vart.Runner
+    """
+    # imported here so the pool can also wrap off-board runners (see simrunner)
+    import vart
+    return [vart.Runner.create_runner(subgraph,"run") for i in range(numRunners)]
+
+
+class RunnerPool():
+  '''
+  Thread-safe pool of model wrappers (FaceDetect, FaceLandmark, FaceFeature),
+  one per runner. Idle wrappers are handed to the worker threads through a
+  queue, so each runner only ever has one caller at a time, and several jobs
+  can be in flight on multi-core DPU configurations.
+  '''
+
+  def __init__(self, runners, modelClass, *args, **kwargs):
+
+    self.models = []
+    self.idleModels = queue.Queue()
+    for dpu in runners:
+      model = modelClass(dpu,*args,**kwargs)
+      model.start()
+      self.models.append(model)
+      self.idleModels.put(model)
+
+    self.batchSize = self.models[0].batchSize
+    self.executor = ThreadPoolExecutor(max_workers=len(self.models))
+
+  def _run(self, method, *args):
+    model = self.idleModels.get()
+    try:
+      return getattr(model,method)(*args)
+    finally:
+      self.idleModels.put(model)
+
+  def submit_call(self, method, *args):
+    """ Run model.<method>(*args) on the next idle runner, returns a Future """
+    return self.executor.submit(self._run,method,*args)
+
+  def submit(self, img):
+    """ Run model.process(img) on the next idle runner, returns a Future """
+    return self.submit_call('process',img)
+
+  def _split(self, method, *args):
+    # the batched items are the last argument : one job per xmodel batch, spread over all runners
+    items = args[-1]
+    batchSize = self.batchSize
+    if len(items) <= batchSize:
+      return self._run(method,*args)
+    futures = [ self.submit_call(method,*(args[:-1]+(items[first:first+batchSize],)))
+                for first in range(0,len(items),batchSize) ]
+    results = [future.result() for future in futures]
+    if isinstance(results[0],np.ndarray):
+      return np.concatenate(results,axis=0)
+    return [result for chunk_results in results for result in chunk_results]
+
+  def process(self, img):
+    return self.submit(img).result()
+
+  def process_batch(self, *args):
+    """ FaceDetect.process_batch(imgs) or FaceLandmark.process_batch(frame,boxes) """
+    return self._split('process_batch',*args)
+
+  def process_batch_scores(self, imgs):
+    """ FaceDetect.process_batch_scores(imgs) """
+    return self._split('process_batch_scores',imgs)
+
+  def process_crops(self, imgs):
+    return self._split('process_crops',imgs)
+
+  def process_aligned(self, faces):
+    """ FaceFeature.process_aligned(faces) """
+    return self._split('process_aligned',faces)
+
+  def config(self, *args):
+    for model in self.models:
+      model.config(*args)
+
+  def stop(self):
+    self.executor.shutdown(wait=True)
+    for model in self.models:
+      model.stop()
+    self.models = []
+    self.idleModels = queue.Queue()
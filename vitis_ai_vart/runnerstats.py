@@ -0,0 +1,173 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+from collections import deque
+import threading
+import time
+import numpy as np
+
+
+# a wait() returning faster than this found its job already done (s)
+BLOCKED_WAIT_S = 0.0005
+
+# upper edges of the job latency histogram bins (ms), the last bin is open
+LATENCY_BINS_MS = np.array([ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000 ], dtype=np.float64)
+
+
+class RunnerStats():
+  '''
+  Job statistics of all the runners of a model : per-job submit/complete
+  timestamps, in-flight count, latency histogram, and rolling rates over the
+  last "window" seconds. A job completes when the DPU finished it (as estimated
+  by InstrumentedRunner), not when the host collects it. The utilisation is the
+  fraction of the window covered by the jobs' submit-to-completion intervals :
+  close to 1.0 the model is DPU-bound, well below it the host
+  (pre/post-processing, capture) is the bottleneck.
+  '''
+
+  def __init__(self, name, window=5.0):
+
+    self.name = name
+    self.window = window
+
+    self.lock = threading.Lock()
+    self.jobs = deque()
+    self.inflight = 0
+    self.maxInflight = 0
+    self.totalJobs = 0
+    self.histogram = np.zeros(len(LATENCY_BINS_MS)+1, dtype=np.int64)
+
+  def submit(self):
+    """ Record a job submission, returns its timestamp """
+    now = time.monotonic()
+    with self.lock:
+      self.inflight += 1
+      self.maxInflight = max(self.maxInflight, self.inflight)
+    return now
+
+  def complete(self, submitted, completed=None):
+    """ Record the completion (at "completed", by default now) of a job submitted at "submitted" """
+    now = time.monotonic() if completed is None else completed
+    with self.lock:
+      self.inflight -= 1
+      self.totalJobs += 1
+      self.jobs.append((submitted, now))
+      self.histogram[np.searchsorted(LATENCY_BINS_MS, 1000.0*(now-submitted))] += 1
+      self.prune(now)
+
+  def prune(self, now):
+    start = now - self.window
+    while len(self.jobs) > 0 and self.jobs[0][1] < start:
+      self.jobs.popleft()
+
+  def snapshot(self):
+    """
+    Rolling statistics over the last window.
+
+    # Returns
+        stats: dict, jobs_per_s, latency_ms (mean), latency_p50_ms, latency_p95_ms,
+               latency_max_ms, inflight, max_inflight, utilisation, total_jobs, histogram
+    """
+    now = time.monotonic()
+    with self.lock:
+      self.prune(now)
+      jobs = np.array(self.jobs, dtype=np.float64).reshape(-1,2)
+      inflight = self.inflight
+      maxInflight = self.maxInflight
+      totalJobs = self.totalJobs
+      histogram = self.histogram.copy()
+
+    start = now - self.window
+    latency = 1000.0 * (jobs[:,1] - jobs[:,0])
+    # union of the job intervals (jobs of several runners overlap)
+    busyTime = 0.0
+    busyEnd = start
+    for begin,end in jobs[np.argsort(jobs[:,0])]:
+      if end > busyEnd:
+        busyTime += end - max(begin, busyEnd)
+        busyEnd = end
+    if len(latency) == 0:
+      latency = np.zeros(1)
+
+    return { 'jobs_per_s' : len(jobs) / self.window,
+             'latency_ms' : float(np.mean(latency)),
+             'latency_p50_ms' : float(np.percentile(latency, 50)),
+             'latency_p95_ms' : float(np.percentile(latency, 95)),
+             'latency_max_ms' : float(np.max(latency)),
+             'inflight' : inflight,
+             'max_inflight' : maxInflight,
+             'utilisation' : min(busyTime / self.window, 1.0),
+             'total_jobs' : totalJobs,
+             'histogram' : histogram }
+
+
+class InstrumentedRunner():
+  '''
+  vart.Runner wrapper recording each job in a (shared) RunnerStats. All the
+  runner calls stay on the caller's thread. A job collected by a blocking
+  wait() completed when wait() returned. A job already done when wait() is
+  called (ex: ModelEngine.run pre-processes the next chunk first) completed
+  during host work : its DPU latency is taken as the last measured one (until
+  one is measured, it completed when wait() was called, an upper bound).
+  '''
+
+  def __init__(self, dpu, stats):
+    self.dpu = dpu
+    self.stats = stats
+    self.pending = {}
+    self.latency = None
+
+  def get_input_tensors(self):
+    return self.dpu.get_input_tensors()
+
+  def get_output_tensors(self):
+    return self.dpu.get_output_tensors()
+
+  def execute_async(self, inputData, outputData):
+    submitted = self.stats.submit()
+    job_id = self.dpu.execute_async( inputData, outputData )
+    self.pending[job_id] = submitted
+    return job_id
+
+  def wait(self, job_id, *args):
+    submitted = self.pending.pop(job_id)
+    waitStart = time.monotonic()
+    result = self.dpu.wait(job_id, *args)
+    now = time.monotonic()
+    if now - waitStart > BLOCKED_WAIT_S:
+      completed = now
+      self.latency = now - submitted
+    elif self.latency is not None:
+      completed = min(submitted + self.latency, waitStart)
+    else:
+      # no blocking wait measured yet : at the latest when wait() was called
+      completed = waitStart
+    self.stats.complete(submitted, completed)
+    return result
+
+  def __getattr__(self, attr):
+    return getattr(self.dpu, attr)
+
+
+def format_runner_stats(name, stats):
+    """ One line summary of a snapshot (see RunnerStats.snapshot, ModelRegistry.runner_stats) """
+    line = "[INFO] {} : {:.1f} jobs/s, latency {:.1f} ms (p95 {:.1f}), in flight {} (max {}), DPU utilisation {:.0f}%".format(
+           name, stats['jobs_per_s'], stats['latency_ms'], stats['latency_p95_ms'],
+           stats['inflight'], stats['max_inflight'], 100.0*stats['utilisation'])
+    if 'preprocess_ms' in stats:
+      line += ", pre/post-processing {:.1f}/{:.1f} ms per job".format(stats['preprocess_ms'], stats['postprocess_ms'])
+    return line
@@ -0,0 +1,234 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# CPU stand-in for vart.Runner, to exercise the vitis_ai_vart wrappers off-board
+#
+# USAGE (benchmark of the face pipeline on a plain Linux host)
+# python -m vitis_ai_vart.simrunner [--frames 100] [--latency 10.0] [--runners 1]
+
+import threading
+import time
+import numpy as np
+
+
+# tensor dims of the models used by the examples (batch,...)
+SIM_MODELS = {
+  'densebox_640_360' : ( [(1,360,640,3)], [(1,90,160,4),(1,90,160,2)] ),
+  'face_landmark'    : ( [(1,60,60,3)],   [(1,10)] ),
+  'facerec_resnet20' : ( [(1,112,96,3)],  [(1,512)] ),
+}
+
+
+class SimTensor():
+  '''
+  Subset of xir.Tensor used by the wrappers : name, dims and attributes.
+  '''
+
+  def __init__(self, name, dims, fix_point=0):
+    self.name = name
+    self.dims = list(dims)
+    self.ndim = len(dims)
+    self.dtype = 'xint8'
+    self.attrs = { 'fix_point' : fix_point }
+
+  def has_attr(self, name):
+    return name in self.attrs
+
+  def get_attr(self, name):
+    return self.attrs[name]
+
+  def __repr__(self):
+    return "SimTensor(name={}, dims={})".format(self.name,self.dims)
+
+
+class SimRunner():
+  '''
+  Software implementation of the parts of vart.Runner used by the wrappers.
+
+  Outputs are either deterministic synthetic data (seeded, identical for every
+  job) or replayed, job after job, from a .npz file recorded with
+  RecordingRunner. Each job completes "latency" seconds after the previous
+  one, as on a single DPU core.
+  '''
+
+  def __init__(self, inputDims, outputDims, latency=0.0, seed=0, replayFile=None, syntheticData=None):
+
+    self.inputTensors = [ SimTensor("input"+str(i),dims) for i,dims in enumerate(inputDims) ]
+    self.outputTensors = [ SimTensor("output"+str(i),dims) for i,dims in enumerate(outputDims) ]
+    self.latency = latency
+
+    if syntheticData is None:
+      rng = np.random.RandomState(seed)
+      syntheticData = [ rng.standard_normal(tuple(dims)).astype(np.float32) for dims in outputDims ]
+    self.syntheticData = syntheticData
+
+    self.replayData = None
+    if replayFile is not None:
+      with np.load(replayFile) as recording:
+        self.replayData = [ recording[tensor.name] for tensor in self.outputTensors ]
+
+    self.lock = threading.Lock()
+    self.jobCount = 0
+    self.busyUntil = 0.0
+    self.jobs = {}
+
+  def get_input_tensors(self):
+    return self.inputTensors
+
+  def get_output_tensors(self):
+    return self.outputTensors
+
+  def execute_async(self, inputData, outputData):
+    with self.lock:
+      job_id = self.jobCount
+      self.jobCount += 1
+
+      for i,output in enumerate(outputData):
+        if self.replayData is not None:
+          recorded = self.replayData[i]
+          output[...] = recorded[job_id % len(recorded)]
+        else:
+          output[...] = self.syntheticData[i]
+
+      done = max(time.monotonic(),self.busyUntil) + self.latency
+      self.busyUntil = done
+      self.jobs[job_id] = done
+
+    return job_id
+
+  def wait(self, job_id, timeout=-1):
+    with self.lock:
+      done = self.jobs.pop(job_id)
+    delay = done - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    return 0
+
+
+def densebox_synthetic_data(outputDims, seed=0, numFaces=2):
+    """
+    Plausible densebox outputs : background everywhere, except a few 40x48 faces.
+
+    # Returns
+        outputs: list of ndarray, bbox and score tensors
+    """
+    bboxDims, scoreDims = outputDims
+    bboxes = np.zeros(bboxDims, dtype=np.float32)
+    scores = np.zeros(scoreDims, dtype=np.float32)
+    scores[...,0] = 4.0
+    scores[...,1] = -4.0
+    rng = np.random.RandomState(seed)
+    for i in range(numFaces):
+      y = rng.randint(6,bboxDims[1]-6)
+      x = rng.randint(6,bboxDims[2]-6)
+      bboxes[:,y,x,:] = (-20.0,-24.0,20.0,24.0)
+      scores[:,y,x,:] = (-4.0,4.0)
+    return [bboxes, scores]
+
+
+def create_sim_runner(model, latency=0.0, seed=0, replayFile=None, batchSize=None):
+    """
+    Create a SimRunner with the tensor dims of a known model.
+
+    # Arguments
+        model: str, key of SIM_MODELS (ex: 'densebox_640_360')
+        latency: float, synthetic job latency in seconds
+
+    # Returns
+        runner: SimRunner
+    """
+    inputDims, outputDims = SIM_MODELS[model]
+    if batchSize is not None:
+      inputDims = [ [batchSize]+list(dims[1:]) for dims in inputDims ]
+      outputDims = [ [batchSize]+list(dims[1:]) for dims in outputDims ]
+    syntheticData = None
+    if model.startswith('densebox'):
+      syntheticData = densebox_synthetic_data(outputDims, seed)
+    return SimRunner(inputDims, outputDims, latency, seed, replayFile, syntheticData)
+
+
+class RecordingRunner():
+  '''
+  Wraps a (real) runner and keeps a copy of every job's outputs, to be saved
+  with save() and replayed later with SimRunner(replayFile=...).
+  '''
+
+  def __init__(self, dpu):
+    self.dpu = dpu
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.recorded = [ [] for tensor in dpu.get_output_tensors() ]
+
+  def get_input_tensors(self):
+    return self.dpu.get_input_tensors()
+
+  def get_output_tensors(self):
+    return self.dpu.get_output_tensors()
+
+  def execute_async(self, inputData, outputData):
+    job_id = self.dpu.execute_async(inputData, outputData)
+    with self.lock:
+      self.pending[str(job_id)] = outputData
+    return job_id
+
+  def wait(self, job_id, timeout=-1):
+    status = self.dpu.wait(job_id)
+    with self.lock:
+      outputData = self.pending.pop(str(job_id))
+      for i,output in enumerate(outputData):
+        self.recorded[i].append(np.copy(output))
+    return status
+
+  def save(self, path):
+    outputTensors = self.dpu.get_output_tensors()
+    np.savez_compressed(path, **{ tensor.name : np.stack(self.recorded[i])
+                                  for i,tensor in enumerate(outputTensors) })
+
+
+if __name__ == '__main__':
+    import argparse
+    from vitis_ai_vart.facedetect import FaceDetect
+    from vitis_ai_vart.facelandmark import FaceLandmark
+    from vitis_ai_vart.runnerpool import RunnerPool
+
+    ap = argparse.ArgumentParser(description='Face pipeline benchmark with simulated DPU runners')
+    ap.add_argument("-f", "--frames", type=int, default=100, help="number of stereo frames (default = 100)")
+    ap.add_argument("-l", "--latency", type=float, default=10.0, help="densebox job latency in ms (default = 10.0)")
+    ap.add_argument("-r", "--runners", type=int, default=1, help="number of runners per model (default = 1)")
+    args = ap.parse_args()
+
+    densebox_dpus = [ create_sim_runner('densebox_640_360',args.latency/1000.0) for i in range(args.runners) ]
+    landmark_dpus = [ create_sim_runner('face_landmark',args.latency/10000.0) for i in range(args.runners) ]
+    dpu_face_detector = RunnerPool(densebox_dpus,FaceDetect,0.55,0.35)
+    dpu_face_landmark = RunnerPool(landmark_dpus,FaceLandmark)
+
+    rng = np.random.RandomState(0)
+    left_frame = rng.randint(0,256,(800,1280,3)).astype(np.uint8)
+    right_frame = rng.randint(0,256,(800,1280,3)).astype(np.uint8)
+
+    start = time.time()
+    nFaces = 0
+    for n in range(args.frames):
+      left_faces,right_faces = dpu_face_detector.process_batch([left_frame,right_frame])
+      crops = [ left_frame[int(y1):int(y2),int(x1):int(x2)] for (x1,y1,x2,y2) in left_faces[:8] if x2 > x1 and y2 > y1 ]
+      landmarks = dpu_face_landmark.process_crops(crops)
+      nFaces += len(crops)
+    end = time.time()
+
+    print("[INFO] {} frames, {} faces, {:.2f} fps".format(args.frames,nFaces,args.frames/(end-start)))
+
+    dpu_face_detector.stop()
+    dpu_face_landmark.stop()
@@ -0,0 +1,197 @@
+'''
+Copyright 2021 Avnet Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+
+import numpy as np
+
+
+def tile_grid(imgWidth, imgHeight, tileWidth, tileHeight, overlap=0.2):
+    """
+    Overlapping tiles covering an image.
+
+    # Returns
+        tiles: ndarray, (T,4) tiles (xmin,ymin,xmax,ymax), empty if the image fits in one tile
+    """
+    if imgWidth <= tileWidth and imgHeight <= tileHeight:
+        return np.zeros((0,4), dtype=np.int32)
+
+    def starts(size, tile):
+        if size <= tile:
+            return [0]
+        count = int(np.ceil((size - tile*overlap) / (tile*(1.0-overlap))))
+        return np.linspace(0, size-tile, max(count,2)).astype(np.int32).tolist()
+
+    tiles = [ (x, y, min(x+tileWidth,imgWidth), min(y+tileHeight,imgHeight))
+              for y in starts(imgHeight,tileHeight) for x in starts(imgWidth,tileWidth) ]
+    return np.array(tiles, dtype=np.int32)
+
+
+def merge_detections(boxes, scores, nmsThreshold=0.35, containThreshold=0.8):
+    """
+    NMS over detections from several scales : a box is also suppressed when it
+    is mostly contained in a higher scored box (ex: the same face seen by two
+    tiles and the global pass, with different box extents).
+
+    # Returns
+        keep: ndarray, indices of the kept boxes (best first)
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1,4)
+    areas = np.maximum(boxes[:,2]-boxes[:,0], 0) * np.maximum(boxes[:,3]-boxes[:,1], 0)
+    order = np.argsort(-np.asarray(scores))
+
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        xx1 = np.maximum(boxes[i,0], boxes[rest,0])
+        yy1 = np.maximum(boxes[i,1], boxes[rest,1])
+        xx2 = np.minimum(boxes[i,2], boxes[rest,2])
+        yy2 = np.minimum(boxes[i,3], boxes[rest,3])
+        inter = np.maximum(0.0, xx2-xx1) * np.maximum(0.0, yy2-yy1)
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        contained = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-6)
+        order = rest[(iou <= nmsThreshold) & (contained <= containThreshold)]
+
+    return np.array(keep, dtype=np.int64)
+
+
+class TiledFaceDetect():
+  '''
+  Tiled multi-scale face detection, for faces too small once the whole frame
+  is squeezed into the DenseBox input : one global (downscaled) pass, plus
+  overlapping tiles at full resolution (the size of the DenseBox input).
+
+  To bound the cost, at most maxTiles tiles run per frame : tiles centred on
+  the small faces of the previous detections (or tracks), then grid tiles
+  visited in turn, to discover new distant faces. All the crops of a call are
+  submitted as one batch (see RunnerPool.process_batch_scores).
+  '''
+
+  def __init__(self, detector, tileWidth=640, tileHeight=360, overlap=0.2, maxTiles=2,
+               smallFace=48, nmsThreshold=0.35, minGlobalFace=24):
+    """
+    # Arguments
+        detector: FaceDetect or RunnerPool of FaceDetect
+        tileWidth, tileHeight: int, tile size (DenseBox input size : full resolution tiles)
+        maxTiles: int, tiles per frame (in addition to the global pass)
+        smallFace: int, face height (pixels) below which a face gets a focus tile
+        minGlobalFace: int, face height in the global pass input below which its score is lowered
+    """
+    self.detector = detector
+    self.tileWidth = tileWidth
+    self.tileHeight = tileHeight
+    self.overlap = overlap
+    self.maxTiles = maxTiles
+    self.smallFace = smallFace
+    self.nmsThreshold = nmsThreshold
+    self.minGlobalFace = minGlobalFace
+
+    self.nextTile = 0
+
+  def select_tiles(self, imgWidth, imgHeight, previous=None):
+    """ Tiles of the next frame : focus tiles on small previous faces, then grid tiles in turn """
+    grid = tile_grid(imgWidth, imgHeight, self.tileWidth, self.tileHeight, self.overlap)
+    if len(grid) == 0 or self.maxTiles == 0:
+      return grid[:0]
+
+    tiles = []
+    if previous is not None and len(previous) > 0:
+      previous = np.asarray(previous, dtype=np.float32).reshape(-1,4)
+      heights = previous[:,3] - previous[:,1]
+      for box in previous[np.argsort(heights)]:
+        if box[3] - box[1] >= self.smallFace or len(tiles) >= self.maxTiles:
+          break
+        # skip faces already inside a selected tile
+        cx, cy = (box[0]+box[2])/2, (box[1]+box[3])/2
+        if any(t[0] <= box[0] and t[2] >= box[2] and t[1] <= box[1] and t[3] >= box[3] for t in tiles):
+          continue
+        x1 = int(np.clip(cx - self.tileWidth/2, 0, max(imgWidth-self.tileWidth,0)))
+        y1 = int(np.clip(cy - self.tileHeight/2, 0, max(imgHeight-self.tileHeight,0)))
+        tiles.append((x1, y1, min(x1+self.tileWidth,imgWidth), min(y1+self.tileHeight,imgHeight)))
+
+    while len(tiles) < min(self.maxTiles, len(grid)):
+      tiles.append(tuple(grid[self.nextTile % len(grid)]))
+      self.nextTile += 1
+
+    return np.array(tiles, dtype=np.int32).reshape(-1,4)
+
+  def process(self, img, previous=None):
+    return self.process_batch([img], [previous])[0]
+
+  def process_batch(self, imgs, previous=None):
+    """
+    Tiled detection on several frames, in a single batch of crops.
+
+    # Arguments
+        imgs: list of images
+        previous: list (one per image) of previous boxes (or None) used to place the tiles
+
+    # Returns
+        faces: list of (N,4) boxes, as FaceDetect.process_batch
+    """
+    if previous is None:
+      previous = [None] * len(imgs)
+
+    crops = []
+    origins = []
+    owners = []
+    for k,(img,prev) in enumerate(zip(imgs,previous)):
+      imgHeight, imgWidth = img.shape[:2]
+      crops.append(img)
+      origins.append(None)
+      owners.append(k)
+      for (x1,y1,x2,y2) in self.select_tiles(imgWidth, imgHeight, prev):
+        crops.append(img[y1:y2,x1:x2])
+        origins.append((x1,y1,x2,y2))
+        owners.append(k)
+
+    results = self.detector.process_batch_scores(crops)
+
+    all_faces = []
+    for k,img in enumerate(imgs):
+      imgHeight, imgWidth = img.shape[:2]
+      globalScale = max(imgWidth / self.tileWidth, imgHeight / self.tileHeight)
+      boxes = []
+      scores = []
+      for (faces,prob),origin,owner in zip(results,origins,owners):
+        if owner != k or len(faces) == 0:
+          continue
+        faces = np.asarray(faces, dtype=np.float32).reshape(-1,4)
+        prob = np.asarray(prob, dtype=np.float32).copy()
+        if origin is None:
+          # global pass : small faces (in the model input) are less reliable than at full resolution
+          heights = (faces[:,3] - faces[:,1]) / globalScale
+          prob *= np.clip(heights / self.minGlobalFace, 0.5, 1.0)
+        else:
+          # tile : faces cut by an inner tile border are partial (dropped, the tiles overlap)
+          x1, y1, x2, y2 = origin
+          cut = ((faces[:,0] <= 1) & (x1 > 0)) | ((faces[:,1] <= 1) & (y1 > 0)) \
+              | ((faces[:,2] >= x2-x1-1) & (x2 < imgWidth)) | ((faces[:,3] >= y2-y1-1) & (y2 < imgHeight))
+          faces = faces[~cut] + np.array([x1,y1,x1,y1], dtype=np.float32)
+          prob = prob[~cut]
+        boxes.append(faces)
+        scores.append(prob)
+
+      if len(boxes) == 0:
+        all_faces.append(np.zeros((0,4), dtype=np.float32))
+        continue
+      boxes = np.concatenate(boxes)
+      scores = np.concatenate(scores)
+      keep = merge_detections(boxes, scores, self.nmsThreshold)
+      all_faces.append(boxes[keep])
+
+    return all_faces